@@ -0,0 +1,619 @@
+#!/usr/bin/env python3
+# Copyright    2023                            (authors: Feiteng Li)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Micro-benchmarks of the inference code paths.
+
+Usage example:
+    python3 bin/benchmark.py --benchmark ar-step-overhead \
+        --text-len 64 --prompt-len 225 --num-steps 750
+
+    python3 bin/benchmark.py --benchmark kv-cache-int8 \
+        --decoder-dim 1024 --nhead 16 --num-decoder-layers 12 \
+        --checkpoint exp/valle/best-valid-loss.pt
+
+    python3 bin/benchmark.py --benchmark sampler --batch-size 16
+
+    python3 bin/benchmark.py --benchmark early-exit \
+        --decoder-dim 1024 --nhead 16 --num-decoder-layers 12 \
+        --ar-exit-layers 4,8 --early-exit-threshold 0.9 \
+        --checkpoint exp/valle/best-valid-loss.pt
+
+    python3 bin/benchmark.py --benchmark nar-window \
+        --decoder-dim 1024 --nhead 16 --num-decoder-layers 12 \
+        --num-frames 2250,4500 --nar-window-size 300 --nar-window-context 32
+
+    python3 bin/benchmark.py --benchmark num-output-quantizers \
+        --decoder-dim 1024 --nhead 16 --num-decoder-layers 12 \
+        --num-output-quantizers 2,4,8 --checkpoint exp/valle/best-valid-loss.pt
+
+    python3 bin/benchmark.py --benchmark int8-dynamic --device cpu \
+        --decoder-dim 1024 --nhead 16 --num-decoder-layers 12 \
+        --checkpoint exp/valle/best-valid-loss.pt
+"""
+import argparse
+import copy
+import logging
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from valle.data import AudioTokenizer
+from valle.models import add_model_arguments, get_model, quantize_dynamic
+from valle.models.macros import NUM_AUDIO_TOKENS, NUM_TEXT_TOKENS
+from valle.models.valle import _ar_attn_mask
+from valle.modules.kv_cache import KVCache
+from valle.modules.sampling import Sampler
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--benchmark",
+        type=str,
+        default="ar-step-overhead",
+        choices=[
+            "ar-step-overhead",
+            "kv-cache-int8",
+            "sampler",
+            "early-exit",
+            "nar-window",
+            "num-output-quantizers",
+            "int8-dynamic",
+        ],
+        help="The benchmark to run.",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        help="The device to run on.",
+    )
+
+    # model
+    add_model_arguments(parser)
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default="",
+        help="Path to the saved checkpoint, the model is randomly initialized "
+        "if empty, which only makes sense for speed and memory benchmarks.",
+    )
+    parser.add_argument(
+        "--num-utterances",
+        type=int,
+        default=10,
+        help="Number of random utterances of the quality checks.",
+    )
+    parser.add_argument(
+        "--text-len",
+        type=int,
+        default=64,
+        help="Number of text tokens.",
+    )
+    parser.add_argument(
+        "--prompt-len",
+        type=int,
+        default=225,
+        help="Number of frames of the audio prompt.",
+    )
+    parser.add_argument(
+        "--num-steps",
+        type=int,
+        default=750,
+        help="Number of AR steps.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=16,
+        help="Number of rows of the sampler benchmark.",
+    )
+    parser.add_argument(
+        "--early-exit-threshold",
+        type=float,
+        default=0.9,
+        help="The confidence threshold of the early exit benchmark.",
+    )
+    parser.add_argument(
+        "--num-frames",
+        type=str,
+        default="2250,4500",
+        help="Comma separated numbers of generated frames of the Non-AR "
+        "window benchmark, 2250 frames are 30s.",
+    )
+    parser.add_argument(
+        "--nar-window-size",
+        type=int,
+        default=300,
+        help="The window size of the Non-AR window benchmark.",
+    )
+    parser.add_argument(
+        "--nar-window-context",
+        type=int,
+        default=32,
+        help="The window context of the Non-AR window benchmark.",
+    )
+    parser.add_argument(
+        "--num-output-quantizers",
+        type=str,
+        default="1,2,4,8",
+        help="Comma separated numbers of output quantizers of the "
+        "num-output-quantizers benchmark.",
+    )
+
+    return parser.parse_args()
+
+
+def _synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _ar_step_overhead_legacy(args, device: torch.device) -> float:
+    """The per-step bookkeeping of the AR loop before preallocation:
+    growing `y`/`xy_pos` by concatenation, building the attention mask on the
+    host and reading the EOS decision back every step."""
+    x = torch.zeros((1, args.text_len, args.decoder_dim), device=device)
+    y = torch.zeros((1, args.prompt_len), dtype=torch.int64, device=device)
+    logits = torch.randn((1, NUM_AUDIO_TOKENS + 1), device=device)
+    x_attn_mask = torch.zeros((args.text_len, args.text_len), dtype=torch.bool)
+
+    _synchronize(device)
+    start = time.perf_counter()
+    for _ in range(args.num_steps):
+        samples = torch.argmax(logits, dim=-1, keepdim=True)
+        if (
+            torch.argmax(logits, dim=-1)[0] == NUM_AUDIO_TOKENS
+            or samples[0, 0] == NUM_AUDIO_TOKENS
+        ):
+            break
+        y = torch.concat([y, samples], dim=1)
+
+        y_len = y.shape[1]
+        y_pos = torch.zeros((1, y_len, args.decoder_dim), device=device)
+        _ = torch.concat([x, y_pos], dim=1)
+        x_attn_mask_pad = F.pad(x_attn_mask, (0, y_len), value=True)
+        y_attn_mask = F.pad(
+            torch.triu(torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1),
+            (args.text_len, 0),
+            value=False,
+        )
+        _ = torch.concat([x_attn_mask_pad, y_attn_mask], dim=0).to(device)
+    _synchronize(device)
+    return (time.perf_counter() - start) / args.num_steps
+
+
+def _ar_step_overhead_preallocated(args, device: torch.device) -> float:
+    """The per-step bookkeeping of the AR loop with preallocated buffers, a
+    mask built once and the EOS decision kept on the device."""
+    max_y_len = args.prompt_len + args.num_steps + 1
+    y = torch.zeros((1, max_y_len), dtype=torch.int64, device=device)
+    xy_pos = torch.zeros(
+        (1, args.text_len + max_y_len, args.decoder_dim), device=device
+    )
+    logits = torch.randn((1, NUM_AUDIO_TOKENS + 1), device=device)
+    xy_attn_mask = _ar_attn_mask(args.text_len, max_y_len, device)
+    finished = torch.zeros((1,), dtype=torch.bool, device=device)
+    eos_len = torch.zeros((1,), dtype=torch.int64, device=device)
+
+    _synchronize(device)
+    start = time.perf_counter()
+    y_len = args.prompt_len
+    for _ in range(args.num_steps):
+        samples = torch.argmax(logits, dim=-1, keepdim=True)
+        eos = (torch.argmax(logits, dim=-1) == NUM_AUDIO_TOKENS) | (
+            samples[:, 0] == NUM_AUDIO_TOKENS
+        )
+        eos_len += (eos & ~finished) * y_len
+        finished |= eos
+        y[:, y_len : y_len + 1] = samples
+        y_len += 1
+
+        _ = xy_pos[:, : args.text_len + y_len]
+        _ = xy_attn_mask[: args.text_len + y_len, : args.text_len + y_len]
+    finished.item()
+    _synchronize(device)
+    return (time.perf_counter() - start) / args.num_steps
+
+
+def benchmark_ar_step_overhead(args):
+    device = torch.device(args.device)
+    for name, fn in [
+        ("legacy", _ar_step_overhead_legacy),
+        ("preallocated", _ar_step_overhead_preallocated),
+    ]:
+        fn(args, device)  # warmup
+        logging.info(
+            f"AR step overhead [{name:>12}]: "
+            f"{fn(args, device) * 1e6:.1f} us/step"
+        )
+
+
+def _load_model(args, device: torch.device):
+    model = get_model(args)
+    if args.checkpoint:
+        checkpoint = torch.load(args.checkpoint, map_location=device)
+        model.load_state_dict(checkpoint["model"], strict=True)
+    model.to(device)
+    model.eval()
+    return model
+
+
+def _random_utterances(args, device: torch.device):
+    rng = np.random.RandomState(0)
+    for _ in range(args.num_utterances):
+        x = torch.from_numpy(
+            rng.randint(0, NUM_TEXT_TOKENS, size=[1, args.text_len])
+        ).to(device)
+        y = torch.from_numpy(
+            rng.randint(
+                0,
+                NUM_AUDIO_TOKENS,
+                size=[1, args.prompt_len, args.num_quantizers],
+            )
+        ).to(device)
+        yield x, torch.tensor([args.text_len], device=device), y
+
+
+@torch.no_grad()
+def benchmark_kv_cache_int8(args):
+    device = torch.device(args.device)
+    head_dim = args.decoder_dim // args.nhead
+    seq_len = args.text_len + args.prompt_len + args.num_steps
+    for int8 in [False, True]:
+        cache = KVCache(args.num_decoder_layers, int8=int8)
+        for layer in range(args.num_decoder_layers):
+            cache.update(
+                layer,
+                torch.randn(1, args.nhead, seq_len, head_dim, device=device),
+                torch.randn(1, args.nhead, seq_len, head_dim, device=device),
+            )
+        logging.info(
+            f"KV cache [{'int8' if int8 else 'fp32':>4}]: "
+            f"{cache.nbytes() / 2**20:.1f} MB per sequence of "
+            f"{seq_len} positions"
+        )
+
+    # token agreement of greedy decoding
+    model = _load_model(args, device)
+    num_agree, num_total = 0, 0
+    for x, x_lens, y in _random_utterances(args, device):
+        codes = [
+            model.inference(
+                x,
+                x_lens,
+                y,
+                enroll_x_lens=torch.tensor([1]),
+                top_k=1,
+                use_kv_cache=True,
+                int8_kv_cache=int8,
+            )[0, :, 0]
+            for int8 in [False, True]
+        ]
+        length = min(len(codes[0]), len(codes[1]))
+        num_agree += (codes[0][:length] == codes[1][:length]).sum().item()
+        num_total += max(len(codes[0]), len(codes[1]))
+    logging.info(
+        f"KV cache int8 vs fp32 greedy token agreement: "
+        f"{num_agree / num_total:.4f} ({num_agree}/{num_total})"
+    )
+
+
+def _legacy_topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0):
+    """topk_sampling() before valle.modules.sampling: scalar parameters, a full
+    sort for top-p and softmax + multinomial even for greedy decoding."""
+    if temperature != 1.0:
+        logits = logits / temperature
+    if top_k > 0:
+        top_k = min(top_k, logits.size(-1))
+        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
+        logits[indices_to_remove] = -float("Inf")
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = torch.cumsum(
+            F.softmax(sorted_logits, dim=-1), dim=-1
+        )
+        sorted_indices_to_remove = cumulative_probs > top_p
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[
+            ..., :-1
+        ].clone()
+        sorted_indices_to_remove[..., 0] = 0
+        indices_to_remove = sorted_indices_to_remove.scatter(
+            1, sorted_indices, sorted_indices_to_remove
+        )
+        logits[indices_to_remove] = -float("Inf")
+    return torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+
+
+def benchmark_sampler(args):
+    device = torch.device(args.device)
+    batch_size, num_steps = args.batch_size, args.num_steps
+    logits = torch.randn((batch_size, NUM_AUDIO_TOKENS + 1), device=device)
+    # a batch mixing the settings of the requests
+    top_k = torch.tensor([1, 10, -100, 50] * batch_size)[:batch_size]
+    top_p = torch.tensor([1.0, 1.0, 0.9, 0.8] * batch_size)[:batch_size]
+    temperature = torch.tensor([1.0, 0.8, 1.0, 1.2] * batch_size)[:batch_size]
+
+    def legacy_mixed(logits):
+        return torch.concat(
+            [
+                _legacy_topk_sampling(
+                    logits[b : b + 1].clone(),
+                    top_k=top_k[b].item(),
+                    top_p=top_p[b].item(),
+                    temperature=temperature[b].item(),
+                )
+                for b in range(batch_size)
+            ]
+        )
+
+    for name, legacy, sampler in [
+        (
+            "greedy",
+            lambda logits: _legacy_topk_sampling(logits.clone(), top_k=1),
+            Sampler(top_k=1),
+        ),
+        (
+            "top-k 10",
+            lambda logits: _legacy_topk_sampling(logits.clone(), top_k=10),
+            Sampler(top_k=10),
+        ),
+        (
+            "top-p 0.9",
+            lambda logits: _legacy_topk_sampling(
+                logits.clone(), top_k=-100, top_p=0.9
+            ),
+            Sampler(top_k=-100, top_p=0.9),
+        ),
+        (
+            "mixed rows",
+            legacy_mixed,
+            Sampler(top_k=top_k, top_p=top_p, temperature=temperature),
+        ),
+    ]:
+        timings = []
+        for fn in [legacy, sampler]:
+            fn(logits)  # warmup
+            _synchronize(device)
+            start = time.perf_counter()
+            for _ in range(num_steps):
+                fn(logits)
+            _synchronize(device)
+            timings.append((time.perf_counter() - start) / num_steps)
+        logging.info(
+            f"sampling [{name:>10}] of {batch_size} rows: "
+            f"legacy {timings[0] * 1e6:.1f} us/step, "
+            f"Sampler {timings[1] * 1e6:.1f} us/step"
+        )
+
+
+@torch.no_grad()
+def benchmark_early_exit(args):
+    device = torch.device(args.device)
+    model = _load_model(args, device)
+    assert model.ar_exit_layers, "--ar-exit-layers is required"
+
+    timings = []
+    for threshold in [0.0, args.early_exit_threshold]:
+        model.early_exit_stats = {"frames": 0, "layers": 0}
+        num_frames = 0
+        _synchronize(device)
+        start = time.perf_counter()
+        for x, x_lens, y in _random_utterances(args, device):
+            codes = model.inference(
+                x,
+                x_lens,
+                y,
+                enroll_x_lens=torch.tensor([1]),
+                top_k=1,
+                use_kv_cache=True,
+                early_exit_threshold=threshold,
+            )
+            num_frames += codes.shape[1]
+        _synchronize(device)
+        timings.append(time.perf_counter() - start)
+        stats = model.early_exit_stats
+        num_layers = (
+            stats["layers"] / stats["frames"]
+            if stats["frames"]
+            else model.ar_decoder.num_layers
+        )
+        logging.info(
+            f"early exit threshold {threshold}: {num_frames} frames in "
+            f"{timings[-1]:.2f}s, {num_layers:.2f} of "
+            f"{model.ar_decoder.num_layers} AR Decoder layers per frame"
+        )
+    logging.info(f"early exit speedup: {timings[0] / timings[1]:.2f}x")
+
+
+@torch.no_grad()
+def benchmark_nar_window(args):
+    device = torch.device(args.device)
+    model = _load_model(args, device)
+    assert model.num_quantizers > 1
+
+    rng = np.random.RandomState(0)
+    x, _, y = next(_random_utterances(args, device))
+    nar_x, prompt_pos = model._nar_inputs(x, y, torch.tensor([1]))
+    for num_frames in map(int, args.num_frames.split(",")):
+        codes = torch.from_numpy(
+            rng.randint(0, NUM_AUDIO_TOKENS, size=[1, num_frames])
+        ).to(device)
+        outputs = []
+        for window_size in [0, args.nar_window_size]:
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+            _synchronize(device)
+            start = time.perf_counter()
+            outputs.append(
+                model._nar_windowed(
+                    nar_x,
+                    y,
+                    prompt_pos,
+                    codes,
+                    window_size,
+                    args.nar_window_context,
+                )
+            )
+            _synchronize(device)
+            elapsed = time.perf_counter() - start
+            memory = ""
+            if device.type == "cuda":
+                peak = torch.cuda.max_memory_allocated(device) / 2 ** 20
+                memory = f", peak memory {peak:.1f} MB"
+            name = f"window {window_size}" if window_size > 0 else "full"
+            logging.info(
+                f"NAR [{name:>11}] {num_frames} frames: {elapsed:.2f}s, "
+                f"{num_frames / elapsed:.1f} frames/s{memory}"
+            )
+        agreement = (outputs[0] == outputs[1]).float().mean().item()
+        logging.info(
+            f"NAR window vs full code agreement of {num_frames} frames: "
+            f"{agreement:.4f}"
+        )
+
+
+@torch.no_grad()
+def benchmark_num_output_quantizers(args):
+    """Latency and quality of the outputs of fewer quantizers. The quality is
+    the SNR of the EnCodec audio of k quantizers w.r.t. the audio of the
+    largest k, for the same (greedy) AR codes."""
+    device = torch.device(args.device)
+    model = _load_model(args, device)
+    audio_tokenizer = AudioTokenizer(device)
+
+    references = []
+    logging.info(
+        "quantizers | kbps | model (s) | codec (s) | audio (s) | SNR (dB)"
+    )
+    for k in sorted(map(int, args.num_output_quantizers.split(",")))[::-1]:
+        model_time, codec_time, num_frames = 0.0, 0.0, 0
+        signal, noise = 0.0, 0.0
+        for n, (x, x_lens, y) in enumerate(_random_utterances(args, device)):
+            _synchronize(device)
+            start = time.perf_counter()
+            codes = model.inference(
+                x,
+                x_lens,
+                y,
+                enroll_x_lens=torch.tensor([1]),
+                top_k=1,
+                use_kv_cache=True,
+                num_output_quantizers=k,
+            )
+            _synchronize(device)
+            model_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            samples = audio_tokenizer.decode([(codes.transpose(2, 1), None)])
+            _synchronize(device)
+            codec_time += time.perf_counter() - start
+            num_frames += codes.shape[1]
+
+            # the largest k goes first and is the reference
+            if len(references) <= n:
+                references.append(samples)
+            reference = references[n]
+            length = min(samples.shape[-1], reference.shape[-1])
+            signal += reference[..., :length].pow(2).sum().item()
+            noise += (
+                (reference[..., :length] - samples[..., :length])
+                .pow(2)
+                .sum()
+                .item()
+            )
+        snr = 10 * np.log10(signal / max(noise, 1e-12))
+        logging.info(
+            f"{k:>10} | {audio_tokenizer.bandwidth(k):>4.2f} | "
+            f"{model_time:>9.2f} | {codec_time:>9.2f} | "
+            f"{num_frames / 75:>9.2f} | {snr:>8.2f}"
+        )
+
+
+@torch.no_grad()
+def benchmark_int8_dynamic(args):
+    """RTF and accuracy of the dynamically quantized (int8) model w.r.t. the
+    fp32 model on CPU, the accuracy being the agreement of the greedy codes of
+    the same (random, fixed) prompts."""
+    device = torch.device("cpu")
+    models = {"fp32": _load_model(args, device)}
+    models["int8"] = quantize_dynamic(copy.deepcopy(models["fp32"]))
+
+    outputs = {}
+    for name, model in models.items():
+        elapsed, num_frames = 0.0, 0
+        outputs[name] = []
+        for x, x_lens, y in _random_utterances(args, device):
+            start = time.perf_counter()
+            codes = model.inference(
+                x,
+                x_lens,
+                y,
+                enroll_x_lens=torch.tensor([1]),
+                top_k=1,
+                use_kv_cache=True,
+            )
+            elapsed += time.perf_counter() - start
+            num_frames += codes.shape[1]
+            outputs[name].append(codes[0])
+        # 75 frames per second of EnCodec 24kHz
+        logging.info(
+            f"[{name}] {num_frames} frames in {elapsed:.2f}s, "
+            f"RTF {elapsed / max(num_frames / 75, 1e-6):.3f}"
+        )
+
+    ar_agree, nar_agree, num_total = 0, 0, 0
+    for codes, int8_codes in zip(outputs["fp32"], outputs["int8"]):
+        length = min(len(codes), len(int8_codes))
+        agree = codes[:length] == int8_codes[:length]
+        ar_agree += agree[:, 0].sum().item()
+        nar_agree += agree[:, 1:].all(dim=-1).sum().item()
+        num_total += max(len(codes), len(int8_codes))
+    logging.info(
+        f"int8 vs fp32 greedy AR code agreement: "
+        f"{ar_agree / num_total:.4f} ({ar_agree}/{num_total}), "
+        f"NAR code agreement: {nar_agree / num_total:.4f}"
+    )
+
+
+def main():
+    args = get_args()
+    if args.benchmark == "ar-step-overhead":
+        benchmark_ar_step_overhead(args)
+    elif args.benchmark == "kv-cache-int8":
+        benchmark_kv_cache_int8(args)
+    elif args.benchmark == "sampler":
+        benchmark_sampler(args)
+    elif args.benchmark == "early-exit":
+        benchmark_early_exit(args)
+    elif args.benchmark == "nar-window":
+        benchmark_nar_window(args)
+    elif args.benchmark == "num-output-quantizers":
+        benchmark_num_output_quantizers(args)
+    elif args.benchmark == "int8-dynamic":
+        benchmark_int8_dynamic(args)
+    else:
+        raise NotImplementedError(f"{args.benchmark}")
+
+
+if __name__ == "__main__":
+    formatter = (
+        "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    )
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
@@ -20,6 +20,10 @@
 This file displays duration statistics of utterances in the manifests.
 You can use the displayed value to choose minimum/maximum duration
 to remove short and long utterances during the training.
+
+With --length-budget, it also writes the frames per text token statistics of
+the train manifest, which bound the AR Decoder output length in inference,
+see bin/infer.py --runaway-guard.
 """
 
 import argparse
@@ -27,6 +31,8 @@ from pathlib import Path
 
 from lhotse import load_manifest_lazy
 
+from valle.modules.guard import LengthBudget
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -36,6 +42,18 @@ def get_args():
         default=Path("data/tokenized"),
         help="Path to the tokenized manifests.",
     )
+    parser.add_argument(
+        "--length-budget",
+        type=Path,
+        default=None,
+        help="If set, write the length budget of the train manifest to it.",
+    )
+    parser.add_argument(
+        "--length-budget-quantile",
+        type=float,
+        default=0.99,
+        help="The quantile of the frames per text token of the length budget.",
+    )
     return parser.parse_args()
 
 
@@ -48,6 +66,17 @@ def main():
         cuts.describe()
         print("\n")
 
+    if args.length_budget:
+        cuts = load_manifest_lazy(manifest_dir / "cuts_train.jsonl.gz")
+        budget = LengthBudget.from_cuts(
+            cuts, quantile=args.length_budget_quantile
+        )
+        print(
+            f"length budget: {budget.frames_per_token:.2f} frames per text "
+            f"token (quantile {budget.quantile})"
+        )
+        budget.save(args.length_budget)
+
 
 if __name__ == "__main__":
     main()
@@ -27,22 +27,34 @@ Usage example:
 import argparse
 import logging
 import os
+import time
+import wave
 from pathlib import Path
+from typing import Callable, Iterator, Optional
 
 os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
 
 import torch
 import torchaudio
-from icefall.utils import str2bool
+from icefall.utils import AttributeDict, str2bool
 
 from valle.data import (
     AudioTokenizer,
+    StreamingAudioDecoder,
     TextTokenizer,
     tokenize_audio,
     tokenize_text,
 )
 from valle.data.collation import get_text_token_collater
-from valle.models import add_model_arguments, get_model
+from valle.models import (
+    INT8_DYNAMIC,
+    add_model_arguments,
+    get_model,
+    quantize_dynamic,
+)
+from valle.modules.guard import LengthBudget, RunawayGuard
+from valle.modules.nar_executor import NarBatchExecutor
+from valle.modules.prompt_cache import PromptCache
 
 
 def get_args():
@@ -89,7 +101,8 @@ def get_args():
         "--checkpoint",
         type=str,
         default="exp/vallf_nano_full/checkpoint-100000.pt",
-        help="Path to the saved checkpoint.",
+        help="Path to the saved checkpoint, or to the int8 model of "
+        "bin/quantize.py which runs on CPU.",
     )
 
     parser.add_argument(
@@ -113,6 +126,197 @@ def get_args():
         help="The temperature of AR Decoder top_k sampling.",
     )
 
+    parser.add_argument(
+        "--use-kv-cache",
+        type=str2bool,
+        default=True,
+        help="Whether AR Decoder reuses the key/value states of the previous steps.",
+    )
+
+    parser.add_argument(
+        "--int8-kv-cache",
+        type=str2bool,
+        default=False,
+        help="Whether AR Decoder stores the cached key/value states in int8.",
+    )
+
+    parser.add_argument(
+        "--draft-checkpoint",
+        type=str,
+        default="",
+        help="Path to the saved checkpoint of a small VALL-E, "
+        "which proposes the AR Decoder tokens (speculative decoding).",
+    )
+    parser.add_argument(
+        "--draft-decoder-dim",
+        type=int,
+        default=256,
+        help="Embedding dimension in the decoder model of --draft-checkpoint.",
+    )
+    parser.add_argument(
+        "--draft-nhead",
+        type=int,
+        default=4,
+        help="Number of attention heads in the Decoder layers of --draft-checkpoint.",
+    )
+    parser.add_argument(
+        "--draft-num-decoder-layers",
+        type=int,
+        default=2,
+        help="Number of Decoder layers of --draft-checkpoint.",
+    )
+    parser.add_argument(
+        "--num-draft-tokens",
+        type=int,
+        default=4,
+        help="Number of tokens the draft model proposes per step.",
+    )
+
+    parser.add_argument(
+        "--use-mtp-heads",
+        type=str2bool,
+        default=False,
+        help="Whether the multi-token prediction heads(--num-mtp-heads) propose "
+        "the AR Decoder tokens, which are verified in the next step.",
+    )
+
+    parser.add_argument(
+        "--num-candidates",
+        type=int,
+        default=1,
+        help="Number of VALL-E AR Decoder hypotheses sampled in parallel, "
+        "the most likely one is synthesized.",
+    )
+
+    parser.add_argument(
+        "--prompt-cache-bytes",
+        type=int,
+        default=1 << 30,
+        help="Size bound of the LRU cache of the tokenized prompts and the prompt "
+        "embeddings, shared by the synthesized texts. 0 disables it.",
+    )
+
+    parser.add_argument(
+        "--kv-cache-bytes",
+        type=int,
+        default=0,
+        help="If > 0, --batch-size decodes VALL-E AR Decoder with a paged key/value "
+        "cache of this many bytes, admitting and preempting texts to fit in it.",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of texts(separated by | in --text) synthesized together.",
+    )
+    parser.add_argument(
+        "--nar-batch-size",
+        type=int,
+        default=1,
+        help="If > 1, the Non-AR Decoders of the lines of a --text file run in "
+        "batches of this many lines, after their AR Decoders.",
+    )
+
+    parser.add_argument(
+        "--early-exit-threshold",
+        type=float,
+        default=0.0,
+        help="If > 0, a VALL-E AR Decoder frame skips the remaining layers once "
+        "an early exit head(--ar-exit-layers) is this confident.",
+    )
+    parser.add_argument(
+        "--nar-window-size",
+        type=int,
+        default=0,
+        help="If > 0, the VALL-E Non-AR Decoders decode the generated frames "
+        "in windows of this many frames, to bound the memory of long outputs.",
+    )
+    parser.add_argument(
+        "--nar-window-context",
+        type=int,
+        default=32,
+        help="Number of context frames on each side of the Non-AR windows.",
+    )
+    parser.add_argument(
+        "--num-output-quantizers",
+        type=int,
+        default=0,
+        help="If > 0, run the Non-AR Decoders of the first "
+        "num_output_quantizers - 1 stages only, EnCodec decodes the codes at "
+        "0.75 kbps per quantizer (2: 1.5kbps, 4: 3kbps, 8: 6kbps).",
+    )
+
+    parser.add_argument(
+        "--runaway-guard",
+        type=str2bool,
+        default=False,
+        help="Whether to detect runaway AR Decoder generation: exceeding the "
+        "length budget(--length-budget), looping n-grams or long silence.",
+    )
+    parser.add_argument(
+        "--length-budget",
+        type=str,
+        default="",
+        help="Path to the length budget of the training manifests, see "
+        "bin/display_manifest_statistics.py --length-budget.",
+    )
+    parser.add_argument(
+        "--max-ngram-repeats",
+        type=int,
+        default=6,
+        help="A runaway is detected once an n-gram of acoustic tokens is "
+        "repeated back to back this many times.",
+    )
+    parser.add_argument(
+        "--max-silence-frames",
+        type=int,
+        default=150,
+        help="A runaway is detected after this many silence frames in a row.",
+    )
+    parser.add_argument(
+        "--runaway-policy",
+        type=str,
+        default="abort",
+        choices=["abort", "retry"],
+        help="abort: keep the tokens before the runaway. retry: sample again "
+        "up to --max-retries times, then abort.",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=2,
+        help="Number of retries of --runaway-policy retry.",
+    )
+
+    parser.add_argument(
+        "--streaming",
+        type=str2bool,
+        default=False,
+        help="Whether VALL-E synthesizes and writes the audio chunk by chunk, "
+        "the first chunk is audible long before the whole text is decoded.",
+    )
+    parser.add_argument(
+        "--stream-chunk-size",
+        type=int,
+        default=40,
+        help="Number of frames of the --streaming chunks(75 frames/second).",
+    )
+    parser.add_argument(
+        "--stream-left-context",
+        type=int,
+        default=40,
+        help="Number of previous frames the Non-AR Decoders of a --streaming "
+        "chunk attend over.",
+    )
+    parser.add_argument(
+        "--stream-decoder-context",
+        type=int,
+        default=10,
+        help="Number of previous frames EnCodec decodes again with a "
+        "--streaming chunk, to smooth the chunk boundaries.",
+    )
+
     parser.add_argument(
         "--continual",
         type=str2bool,
@@ -123,6 +327,44 @@ def get_args():
     return parser.parse_args()
 
 
+def stream_audio(
+    chunks: Iterator[torch.Tensor],
+    decoder: StreamingAudioDecoder,
+    on_audio: Callable[[torch.Tensor], None],
+) -> Optional[float]:
+    """Decode the code chunks of VALLE.inference_stream() to audio and pass
+    the samples (channels, num_samples) to `on_audio` as soon as they are
+    decoded. Returns the time to the first audio in seconds, None if no chunk
+    is generated."""
+    start = time.perf_counter()
+    time_to_first_audio = None
+    for codes in chunks:
+        on_audio(decoder.decode(codes))
+        if time_to_first_audio is None:
+            time_to_first_audio = time.perf_counter() - start
+    tail = decoder.flush()
+    if tail is not None:
+        on_audio(tail)
+    return time_to_first_audio
+
+
+class WavWriter:
+    """Write 16-bit PCM to a wav file incrementally, see stream_audio()."""
+
+    def __init__(self, filename: str, sample_rate: int, channels: int = 1):
+        self.wav = wave.open(filename, "wb")
+        self.wav.setnchannels(channels)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(sample_rate)
+
+    def __call__(self, samples: torch.Tensor) -> None:
+        pcm = (samples.clamp(-1.0, 1.0) * 32767).to(torch.int16)
+        self.wav.writeframes(pcm.t().contiguous().cpu().numpy().tobytes())
+
+    def close(self) -> None:
+        self.wav.close()
+
+
 @torch.no_grad()
 def main():
     args = get_args()
@@ -136,7 +378,12 @@ def main():
 
     model = get_model(args)
     if args.checkpoint:
-        checkpoint = torch.load(args.checkpoint, map_location=device)
+        checkpoint = torch.load(args.checkpoint, map_location="cpu")
+        if checkpoint.get("quantization") == INT8_DYNAMIC:
+            # the dynamically quantized layers run on CPU only
+            device = torch.device("cpu")
+            model.eval()
+            quantize_dynamic(model)
         missing_keys, unexpected_keys = model.load_state_dict(
             checkpoint["model"], strict=True
         )
@@ -147,6 +394,80 @@ def main():
     model.to(device)
     model.eval()
 
+    decode_kwargs = {}
+    if args.draft_checkpoint:
+        assert args.model_name.lower() in ["vall-e", "valle"]
+        draft_params = AttributeDict(vars(args))
+        draft_params.decoder_dim = args.draft_decoder_dim
+        draft_params.nhead = args.draft_nhead
+        draft_params.num_decoder_layers = args.draft_num_decoder_layers
+        draft_params.num_mtp_heads = 0
+        draft_model = get_model(draft_params)
+        checkpoint = torch.load(args.draft_checkpoint, map_location=device)
+        missing_keys, unexpected_keys = draft_model.load_state_dict(
+            checkpoint["model"], strict=True
+        )
+        assert not missing_keys
+        draft_model.to(device)
+        draft_model.eval()
+        decode_kwargs = dict(
+            draft_model=draft_model, num_draft_tokens=args.num_draft_tokens
+        )
+    elif args.use_mtp_heads:
+        assert args.model_name.lower() in ["vall-e", "valle"]
+        decode_kwargs = dict(use_mtp_heads=True)
+    elif args.num_candidates > 1:
+        assert args.model_name.lower() in ["vall-e", "valle"]
+        decode_kwargs = dict(num_candidates=args.num_candidates)
+
+    if args.early_exit_threshold > 0:
+        assert args.model_name.lower() in ["vall-e", "valle"]
+        decode_kwargs["early_exit_threshold"] = args.early_exit_threshold
+
+    num_output_quantizers = None
+    if args.num_output_quantizers > 0:
+        assert not args.continual
+        num_output_quantizers = args.num_output_quantizers
+        decode_kwargs["num_output_quantizers"] = num_output_quantizers
+        logging.info(
+            f"{num_output_quantizers} output quantizers, "
+            f"{audio_tokenizer.bandwidth(num_output_quantizers)} kbps"
+        )
+
+    if args.kv_cache_bytes > 0:
+        # the paged key/value cache
+        assert args.model_name.lower() in ["vall-e", "valle"]
+        assert not args.int8_kv_cache
+
+    if args.nar_window_size > 0:
+        assert args.model_name.lower() in ["vall-e", "valle"]
+        decode_kwargs["nar_window_size"] = args.nar_window_size
+        decode_kwargs["nar_window_context"] = args.nar_window_context
+
+    guard = None
+    if args.runaway_guard:
+        assert args.model_name.lower() in [
+            "vall-e",
+            "valle",
+            "vall-f",
+            "vallf",
+        ]
+        guard = RunawayGuard(
+            budget=LengthBudget.load(args.length_budget)
+            if args.length_budget
+            else None,
+            max_ngram_repeats=args.max_ngram_repeats,
+            max_silence_frames=args.max_silence_frames,
+            policy=args.runaway_policy,
+            max_retries=args.max_retries,
+        )
+        decode_kwargs["guard"] = guard
+
+    prompt_cache = None
+    if args.prompt_cache_bytes > 0:
+        prompt_cache = PromptCache(max_bytes=args.prompt_cache_bytes)
+        decode_kwargs["prompt_cache"] = prompt_cache
+
     Path(args.output_dir).mkdir(parents=True, exist_ok=True)
 
     text_prompts = " ".join(args.text_prompts.split("|"))
@@ -168,6 +489,22 @@ def main():
         audio_prompts = audio_prompts.to(device)
 
     if os.path.isfile(args.text):  # for demos
+        nar_executor, audio_paths = None, {}
+        if args.nar_batch_size > 1:
+            nar_executor = NarBatchExecutor(
+                model,
+                max_batch_size=args.nar_batch_size,
+                prompt_cache=prompt_cache,
+                num_output_quantizers=num_output_quantizers,
+            )
+
+        def save(encoded_frames: torch.Tensor, audio_path: str):
+            samples = audio_tokenizer.decode(
+                [(encoded_frames.transpose(2, 1), None)]
+            )
+            # store
+            torchaudio.save(audio_path, samples[0].cpu(), 24000)
+
         # https://github.com/lifeiteng/lifeiteng.github.com/blob/main/valle/prepare.py
         with open(args.text) as f:
             for line in f:
@@ -182,16 +519,28 @@ def main():
                         )
                     ]
                 )
-                _, enroll_x_lens = text_collater(
-                    [
-                        tokenize_text(
-                            text_tokenizer, text=f"{prompt_text}".strip()
-                        )
-                    ]
-                )
 
-                audio_prompts = tokenize_audio(audio_tokenizer, prompt_audio)
-                audio_prompts = audio_prompts[0][0].transpose(2, 1).to(device)
+                def tokenize_prompt():
+                    _, enroll_x_lens = text_collater(
+                        [
+                            tokenize_text(
+                                text_tokenizer, text=f"{prompt_text}".strip()
+                            )
+                        ]
+                    )
+                    audio_prompts = tokenize_audio(
+                        audio_tokenizer, prompt_audio
+                    )
+                    audio_prompts = audio_prompts[0][0].transpose(2, 1)
+                    return enroll_x_lens, audio_prompts.to(device)
+
+                if prompt_cache is not None:
+                    enroll_x_lens, audio_prompts = prompt_cache.get_or_compute(
+                        PromptCache.key("prompt", prompt_text, prompt_audio),
+                        tokenize_prompt,
+                    )
+                else:
+                    enroll_x_lens, audio_prompts = tokenize_prompt()
 
                 # synthesis
                 encoded_frames = model.inference(
@@ -201,13 +550,113 @@ def main():
                     enroll_x_lens=enroll_x_lens,
                     top_k=args.top_k,
                     temperature=args.temperature,
+                    use_kv_cache=args.use_kv_cache,
+                    int8_kv_cache=args.int8_kv_cache,
+                    ar_only=nar_executor is not None,
+                    **decode_kwargs,
                 )
+                if nar_executor is None:
+                    save(encoded_frames, audio_path)
+                    continue
 
+                index = nar_executor.submit(
+                    text_tokens.to(device),
+                    audio_prompts,
+                    encoded_frames,
+                    enroll_x_lens,
+                )
+                audio_paths[index] = audio_path
+                for index, codes in nar_executor.run().items():
+                    save(codes, audio_paths.pop(index))
+
+        if nar_executor is not None:
+            for index, codes in nar_executor.run(flush=True).items():
+                save(codes, audio_paths.pop(index))
+            logging.info(
+                f"NAR batches: {nar_executor.num_batches} of "
+                f"{nar_executor.num_requests} texts"
+            )
+        if prompt_cache is not None:
+            logging.info(f"prompt cache: {prompt_cache.stats()}")
+        if guard is not None:
+            logging.info(f"runaway guard: {guard.stats()}")
+        return
+
+    if args.batch_size > 1 and not args.continual:
+        assert audio_prompts != []
+        # batch_inference() supports the prompt cache, the paged and the int8
+        # key/value caches and --num-output-quantizers only
+        unsupported = sorted(
+            set(decode_kwargs) - {"prompt_cache", "num_output_quantizers"}
+        )
+        assert not unsupported and not args.streaming, (
+            f"--batch-size {args.batch_size} does not support "
+            f"{unsupported or 'streaming'}, use --batch-size 1"
+        )
+        enroll_x_lens = None
+        if text_prompts:
+            _, enroll_x_lens = text_collater(
+                [tokenize_text(text_tokenizer, text=f"{text_prompts}".strip())]
+            )
+
+        kv_pool = None
+        if args.kv_cache_bytes > 0:
+            kv_pool = model.kv_block_pool(args.kv_cache_bytes)
+
+        texts = args.text.split("|")
+        for start in range(0, len(texts), args.batch_size):
+            batch_texts = texts[start : start + args.batch_size]
+            batch_size = len(batch_texts)
+            logging.info(f"synthesize texts: {batch_texts}")
+            text_tokens, text_tokens_lens = text_collater(
+                [
+                    tokenize_text(
+                        text_tokenizer, text=f"{text_prompts} {text}".strip()
+                    )
+                    for text in batch_texts
+                ]
+            )
+
+            # synthesis
+            encoded_frames, encoded_lens = model.batch_inference(
+                text_tokens.to(device),
+                text_tokens_lens.to(device),
+                # the prompt is shared by all the texts
+                audio_prompts,
+                torch.tensor([audio_prompts.shape[1]], device=device),
+                enroll_x_lens=enroll_x_lens.expand(batch_size)
+                if enroll_x_lens is not None
+                else None,
+                top_k=args.top_k,
+                temperature=args.temperature,
+                prompt_cache=prompt_cache,
+                kv_pool=kv_pool,
+                int8_kv_cache=args.int8_kv_cache,
+                num_output_quantizers=num_output_quantizers,
+            )
+
+            for k in range(batch_size):
+                if encoded_lens[k] == 0:
+                    logging.warning(f"no audio for text {start + k}")
+                    continue
                 samples = audio_tokenizer.decode(
-                    [(encoded_frames.transpose(2, 1), None)]
+                    [
+                        (
+                            encoded_frames[
+                                k : k + 1, : encoded_lens[k]
+                            ].transpose(2, 1),
+                            None,
+                        )
+                    ]
                 )
                 # store
-                torchaudio.save(audio_path, samples[0].cpu(), 24000)
+                torchaudio.save(
+                    f"{args.output_dir}/{start + k}.wav",
+                    samples[0].cpu(),
+                    24000,
+                )
+        if prompt_cache is not None:
+            logging.info(f"prompt cache: {prompt_cache.stats()}")
         return
 
     for n, text in enumerate(args.text.split("|")):
@@ -221,12 +670,55 @@ def main():
         )
 
         # synthesis
+        if args.streaming:
+            assert args.model_name.lower() in ["vall-e", "valle"]
+            assert audio_prompts != [] and not args.continual
+            enroll_x_lens = None
+            if text_prompts:
+                _, enroll_x_lens = text_collater(
+                    [
+                        tokenize_text(
+                            text_tokenizer, text=f"{text_prompts}".strip()
+                        )
+                    ]
+                )
+            writer = WavWriter(
+                f"{args.output_dir}/{n}.wav",
+                audio_tokenizer.sample_rate,
+                audio_tokenizer.channels,
+            )
+            time_to_first_audio = stream_audio(
+                model.inference_stream(
+                    text_tokens.to(device),
+                    text_tokens_lens.to(device),
+                    audio_prompts,
+                    enroll_x_lens=enroll_x_lens,
+                    top_k=args.top_k,
+                    temperature=args.temperature,
+                    chunk_size=args.stream_chunk_size,
+                    left_context=args.stream_left_context,
+                    prompt_cache=prompt_cache,
+                    num_output_quantizers=num_output_quantizers,
+                ),
+                StreamingAudioDecoder(
+                    audio_tokenizer, left_context=args.stream_decoder_context
+                ),
+                writer,
+            )
+            writer.close()
+            if time_to_first_audio is None:
+                logging.warning(f"no audio for text {n}")
+            else:
+                logging.info(f"time to first audio: {time_to_first_audio:.3f}s")
+            continue
+
         if args.continual:
             assert text == ""
             encoded_frames = model.continual(
                 text_tokens.to(device),
                 text_tokens_lens.to(device),
                 audio_prompts,
+                prompt_cache=prompt_cache,
             )
         else:
             enroll_x_lens = None
@@ -245,6 +737,9 @@ def main():
                 enroll_x_lens=enroll_x_lens,
                 top_k=args.top_k,
                 temperature=args.temperature,
+                use_kv_cache=args.use_kv_cache,
+                int8_kv_cache=args.int8_kv_cache,
+                **decode_kwargs,
             )
 
         if audio_prompts != []:
@@ -258,6 +753,9 @@ def main():
         else:  # Transformer
             pass
 
+    if guard is not None:
+        logging.info(f"runaway guard: {guard.stats()}")
+
 
 torch.set_num_threads(1)
 torch.set_num_interop_threads(1)
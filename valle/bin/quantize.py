@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Copyright    2023                            (authors: Feiteng Li)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Convert a trained checkpoint to an int8 (dynamically quantized) model for CPU
+inference, which bin/infer.py loads with the same model arguments.
+
+Usage example:
+    python3 bin/quantize.py \
+        --decoder-dim 1024 --nhead 16 --num-decoder-layers 12 \
+        --model-name valle --prefix-mode 1 \
+        --checkpoint exp/valle/best-valid-loss.pt \
+        --output exp/valle/best-valid-loss-int8.pt
+
+    python3 bin/infer.py \
+        --decoder-dim 1024 --nhead 16 --num-decoder-layers 12 \
+        --model-name valle --prefix-mode 1 \
+        --checkpoint exp/valle/best-valid-loss-int8.pt ...
+
+See `bin/benchmark.py --benchmark int8-dynamic` for the RTF and the accuracy
+w.r.t. the fp32 model.
+"""
+import argparse
+import logging
+import os
+
+import torch
+
+from valle.models import (
+    INT8_DYNAMIC,
+    add_model_arguments,
+    get_model,
+    quantize_dynamic,
+)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    # model
+    add_model_arguments(parser)
+
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        required=True,
+        help="Path to the saved checkpoint.",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="Path to the int8 model.",
+    )
+
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main():
+    args = get_args()
+
+    model = get_model(args)
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    assert checkpoint.get("quantization") is None, "already quantized"
+    model.load_state_dict(checkpoint["model"], strict=True)
+    model.eval()
+
+    quantize_dynamic(model)
+    torch.save(
+        {"model": model.state_dict(), "quantization": INT8_DYNAMIC},
+        args.output,
+    )
+    logging.info(
+        f"Saved the int8 model to {args.output} "
+        f"({os.path.getsize(args.output) / 2**20:.1f} MB)"
+    )
+
+
+if __name__ == "__main__":
+    formatter = (
+        "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+    )
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
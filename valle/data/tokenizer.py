@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
 import re
 from dataclasses import asdict, dataclass
 from typing import Any, Dict, List, Optional, Pattern, Union
@@ -241,6 +242,84 @@ class AudioTokenizer:
     def decode(self, frames: torch.Tensor) -> torch.Tensor:
         return self.codec.decode(frames)
 
+    def bandwidth(self, num_quantizers: int) -> float:
+        """The bitrate in kbps of the codes of the first `num_quantizers`
+        quantizers, decode() takes any number of them, e.g. 2 (1.5 kbps) or
+        4 (3 kbps) instead of 8 (6 kbps)."""
+        bits = math.log2(self.codec.quantizer.bins)
+        return self.codec.frame_rate * bits * num_quantizers / 1000
+
+
+class StreamingAudioDecoder:
+    """Decode the EnCodec codes chunk by chunk, e.g. of
+    VALLE.inference_stream(). Every chunk is decoded with the last
+    `left_context` frames of the previous chunks in front of it, and the
+    first `crossfade` frames of its audio are cross-faded with the end of the
+    previous chunk, which is held back until then.
+
+    Usage:
+        decoder = StreamingAudioDecoder(audio_tokenizer)
+        for codes in chunks:
+            play(decoder.decode(codes))
+        play(decoder.flush())
+    """
+
+    def __init__(
+        self,
+        tokenizer: AudioTokenizer,
+        left_context: int = 10,
+        crossfade: int = 1,
+    ) -> None:
+        assert 0 < crossfade <= left_context
+        self.tokenizer = tokenizer
+        self.left_context = left_context
+        self.hop_length = tokenizer.sample_rate // tokenizer.codec.frame_rate
+        self.crossfade = crossfade * self.hop_length
+        self._context = None
+        self._tail = None
+
+    def decode(self, codes: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+          codes:
+            The codes of a new chunk, (1, T, num_quantizers).
+        Returns:
+          The new audio samples, (channels, num_samples).
+        """
+        context_len = 0
+        if self._context is not None:
+            context_len = self._context.shape[1]
+            codes = torch.concat([self._context, codes], dim=1)
+        samples = self.tokenizer.decode([(codes.transpose(2, 1), None)])[0]
+
+        start = context_len * self.hop_length
+        if self._tail is not None:
+            start -= self._tail.shape[-1]
+            samples = samples[:, start:]
+            fade_in = torch.linspace(
+                0.0, 1.0, self._tail.shape[-1], device=samples.device
+            )
+            samples = torch.concat(
+                [
+                    self._tail * (1.0 - fade_in)
+                    + samples[:, : self._tail.shape[-1]] * fade_in,
+                    samples[:, self._tail.shape[-1] :],
+                ],
+                dim=-1,
+            )
+        else:
+            samples = samples[:, start:]
+
+        self._context = codes[:, -self.left_context :]
+        self._tail = samples[:, -self.crossfade :]
+        return samples[:, : -self.crossfade]
+
+    def flush(self) -> torch.Tensor:
+        """The held back end of the audio, call it after the last chunk."""
+        tail = self._tail
+        self._context, self._tail = None, None
+        return tail
+
 
 def tokenize_audio(tokenizer: AudioTokenizer, audio_path: str):
     # Load and pre-process the audio waveform
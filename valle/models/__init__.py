@@ -10,6 +10,7 @@ from .macros import (
     NUM_TEXT_TOKENS,
     SPEAKER_EMBEDDING_DIM,
 )
+from .quantization import INT8_DYNAMIC, quantize_dynamic
 from .transformer import Transformer
 from .valle import VALLE, VALLF
 from .visualizer import visualize
@@ -85,6 +86,36 @@ def add_model_arguments(parser: argparse.ArgumentParser):
         default=8,
         help="Number of Audio/Semantic quantization layers.",
     )
+    parser.add_argument(
+        "--num-mtp-heads",
+        type=int,
+        default=0,
+        help="Number of VALL-E AR multi-token prediction heads, "
+        "the k-th head predicts the (k + 1)-th next acoustic token.",
+    )
+    parser.add_argument(
+        "--ar-attention-window",
+        type=int,
+        default=0,
+        help="If > 0, VALL-E AR Decoder attends over the text, the prompt and "
+        "the last ar-attention-window acoustic tokens only (training and "
+        "inference), which bounds the inference cost per frame.",
+    )
+    parser.add_argument(
+        "--ar-exit-layers",
+        type=str,
+        default="",
+        help="Comma separated numbers of VALL-E AR Decoder layers, each "
+        "followed by an early exit head, e.g. 4,8. Enables "
+        "--early-exit-threshold in inference.",
+    )
+    parser.add_argument(
+        "--nar-group-size",
+        type=int,
+        default=1,
+        help="Number of quantizers predicted by one pass of the NAR Decoder "
+        "(one prediction layer each), e.g. 3 runs 3 NAR passes instead of 7.",
+    )
 
     # Transformer
     parser.add_argument(
@@ -108,6 +139,7 @@ def get_model(params: AttributeDict) -> nn.Module:
             nar_scale_factor=params.scale_factor,
             prepend_bos=params.prepend_bos,
             num_quantizers=params.num_quantizers,
+            nar_group_size=getattr(params, "nar_group_size", 1),
         )
     elif params.model_name.lower() in ["vall-e", "valle"]:
         model = VALLE(
@@ -121,6 +153,14 @@ def get_model(params: AttributeDict) -> nn.Module:
             nar_scale_factor=params.scale_factor,
             prepend_bos=params.prepend_bos,
             num_quantizers=params.num_quantizers,
+            num_mtp_heads=getattr(params, "num_mtp_heads", 0),
+            ar_attention_window=getattr(params, "ar_attention_window", 0),
+            ar_exit_layers=[
+                int(n)
+                for n in getattr(params, "ar_exit_layers", "").split(",")
+                if n
+            ],
+            nar_group_size=getattr(params, "nar_group_size", 1),
         )
     else:
         assert params.model_name in ["Transformer"]
@@ -0,0 +1,77 @@
+# Copyright    2023                             (authors: Feiteng Li)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+import torch.nn as nn
+
+from valle.modules.activation import MultiheadAttention
+from valle.modules.transformer import (
+    TransformerDecoderLayer,
+    TransformerEncoderLayer,
+)
+
+# The "quantization" of the checkpoints saved by bin/quantize.py
+INT8_DYNAMIC = "int8-dynamic"
+
+
+def quantize_dynamic(
+    model: nn.Module, dtype: torch.dtype = torch.qint8
+) -> nn.Module:
+    """Dynamically quantize a VALL-E / VALL-F model in place for CPU inference:
+    the weights are int8 and the activations are quantized on the fly.
+
+    The quantized layers are
+      - the input projections (split into the queries and the keys/values)
+        and the output projections of the MultiheadAttention, see
+        MultiheadAttention.quantize_dynamic(),
+      - the nn.Linear layers of the Transformer layers, i.e. the feedforward
+        and the AdaptiveLayerNorm projections,
+      - the prediction layers `ar_predict_layer` and `nar_predict_layers`.
+
+    The state dict of a quantized model is loaded by a model quantized the same
+    way, see bin/infer.py.
+
+    Args:
+      model:
+        A VALLE or VALLF model in eval mode, on CPU.
+      dtype:
+        The dtype of the quantized weights.
+    Returns:
+      The quantized model.
+    """
+    assert not model.training
+
+    names = set()
+    for name, module in list(model.named_modules()):
+        if isinstance(module, MultiheadAttention):
+            module.quantize_dynamic(dtype)
+        elif isinstance(
+            module, (TransformerEncoderLayer, TransformerDecoderLayer)
+        ):
+            names.update(
+                f"{name}.{child_name}"
+                for child_name, child in module.named_modules()
+                if type(child) is nn.Linear
+            )
+
+    for name in ["ar_predict_layer", "nar_predict_layers"]:
+        module = getattr(model, name, None)
+        if isinstance(module, nn.Linear):
+            names.add(name)
+        elif isinstance(module, nn.ModuleList):
+            names.update(f"{name}.{i}" for i in range(len(module)))
+
+    return torch.quantization.quantize_dynamic(
+        model, names, dtype=dtype, inplace=True
+    )
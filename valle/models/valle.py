@@ -12,8 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import random
-from typing import Dict, Iterator, List, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -22,10 +23,19 @@ from icefall.utils import make_pad_mask
 from torchmetrics.classification import MulticlassAccuracy
 
 from valle.data.input_strategies import PromptedFeatures
-from valle.modules.embedding import SinePositionalEmbedding, TokenEmbedding
+from valle.modules.embedding import (
+    MultiTokenEmbedding,
+    SinePositionalEmbedding,
+    TokenEmbedding,
+)
+from valle.modules.guard import RunawayGuard
+from valle.modules.kv_cache import BlockPool, KVCache, PagedKVCache
+from valle.modules.prompt_cache import PromptCache
+from valle.modules.sampling import Param, Sampler, TopK, TopP
 from valle.modules.transformer import (
     AdaptiveLayerNorm,
     LayerNorm,
+    TransformerDecoder,
     TransformerDecoderLayer,
     TransformerEncoder,
     TransformerEncoderLayer,
@@ -34,6 +44,9 @@ from valle.modules.transformer import (
 from .macros import NUM_AUDIO_TOKENS, NUM_TEXT_TOKENS
 from .visualizer import visualize
 
+# unique (never reused) identifiers of the models in the PromptCache keys
+_MODEL_IDS = itertools.count()
+
 
 class Transpose(nn.Identity):
     """(N, T, D) -> (N, D, T)"""
@@ -59,8 +72,8 @@ class VALLF(nn.Module):
         norm_first: bool = True,
         add_prenet: bool = False,
         decoder_cls: Union[
-            nn.TransformerDecoder, nn.TransformerEncoder
-        ] = nn.TransformerDecoder,
+            TransformerDecoder, TransformerEncoder
+        ] = TransformerDecoder,
         decoder_layer_cls: Union[
             TransformerDecoderLayer, TransformerEncoderLayer
         ] = TransformerDecoderLayer,
@@ -69,6 +82,7 @@ class VALLF(nn.Module):
         nar_scale_factor: float = 1.0,
         prepend_bos: bool = False,
         num_quantizers: int = 8,
+        nar_group_size: int = 1,
     ):
         """
         Args:
@@ -78,6 +92,12 @@ class VALLF(nn.Module):
             The number of heads in the multiheadattention models (required).
           num_layers:
             The number of sub-decoder-layers in the decoder (required).
+          nar_group_size:
+            The number of quantizers predicted by one pass of the NAR Decoder.
+            The Non-AR stages are grouped by `nar_group_size` consecutive
+            stages, a pass is conditioned on the stage embedding of the first
+            stage of its group and every stage keeps its own prediction layer,
+            e.g. 3 passes instead of 7 with nar_group_size=3.
         """
         super().__init__()
         nar_d_model = int(d_model * nar_scale_factor)
@@ -163,13 +183,18 @@ class VALLF(nn.Module):
         )
 
         self.rng = random.Random(0)
+        # see _prompt_cache_key()
+        self._cache_id = next(_MODEL_IDS)
+        self._cache_version = 0
         self.num_heads = nhead
         self.prefix_mode = prefix_mode
         self.num_quantizers = num_quantizers
 
         assert num_quantizers >= 1
+        assert nar_group_size >= 1
+        self.nar_group_size = nar_group_size
         if num_quantizers > 1:
-            self.nar_audio_embeddings = nn.ModuleList(
+            self.nar_audio_embeddings = MultiTokenEmbedding(
                 [TokenEmbedding(nar_d_model, NUM_AUDIO_TOKENS + 1)]
                 + [
                     TokenEmbedding(nar_d_model, NUM_AUDIO_TOKENS)
@@ -291,6 +316,39 @@ class VALLF(nn.Module):
     #     elif isinstance(module, nn.Embedding):
     #         module.weight.data.normal_(mean=0.0, std=1.0)
 
+    def load_state_dict(self, state_dict, strict: bool = True):
+        # invalidates the PromptCache entries of the model
+        self._cache_version += 1
+        return super().load_state_dict(state_dict, strict=strict)
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to(), .cuda(), .half(), ... invalidate the PromptCache entries
+        self._cache_version += 1
+        return super()._apply(fn, *args, **kwargs)
+
+    def _prompt_cache_key(
+        self, name: str, modules: Sequence[nn.Module], prompts: torch.Tensor
+    ) -> str:
+        """The PromptCache key of the output of `modules` for `prompts`.
+
+        It changes with the model (the identifiers are never reused), its loads
+        and moves, its training mode and the device, dtype, storage and version
+        (in-place updates) of every parameter of `modules`.
+        """
+        parameters = [
+            (str(p.device), p.dtype, p.data_ptr(), p._version)
+            for module in modules
+            for p in module.parameters()
+        ]
+        return PromptCache.key(
+            name,
+            self._cache_id,
+            self._cache_version,
+            self.training,
+            parameters,
+            prompts,
+        )
+
     def stage_parameters(self, stage: int = 1) -> Iterator[nn.Parameter]:
         assert stage > 0
         if stage == 1:
@@ -332,33 +390,31 @@ class VALLF(nn.Module):
 
         return targets[:, :-1], targets[:, 1:]
 
-    def _prepare_prompts(self, y, y_lens, codes, nar_stage, y_prompts_codes):
+    def _prepare_prompts(
+        self, y, y_lens, codes, nar_stage, y_prompts_codes, num_stages=1
+    ):
         # 5.1 For the NAR acoustic prompt tokens, we select a random segment waveform of 3 seconds
         # from the same utterance.
         # We implement this differently.
+        # the codes of the first quantizer are the (padded) AR Decoder inputs
+        y_codes = torch.concat(
+            [y.unsqueeze(-1), codes[..., 1 : self.num_quantizers]], dim=-1
+        )
         if self.prefix_mode == 0:
             # no prefix
             prefix_len = 0
-            y_emb = self.nar_audio_embeddings[0](y)
-            for j in range(1, nar_stage):
-                # Formula (4) (5)
-                y_emb = y_emb + self.nar_audio_embeddings[j](codes[..., j])
+            # Formula (4) (5)
+            y_emb = self.nar_audio_embeddings(y_codes[..., :nar_stage])
         elif self.prefix_mode == 1:
             # prefix at begining
             int_low = (0.25 * y_lens.min()).type(torch.int64).item()
             prefix_len = torch.randint(int_low, int_low * 2, size=()).item()
             prefix_len = min(prefix_len, 225)  # 24000/320 * 3s = 225 frames
 
-            y_prompts = self.nar_audio_embeddings[0](y[:, :prefix_len])
-            y_emb = self.nar_audio_embeddings[0](y[:, prefix_len:])
-            for j in range(1, self.num_quantizers):
-                y_prompts += self.nar_audio_embeddings[j](
-                    codes[:, :prefix_len, j]
-                )
-                if j < nar_stage:
-                    y_emb += self.nar_audio_embeddings[j](
-                        codes[:, prefix_len:, j]
-                    )
+            y_prompts = self.nar_audio_embeddings(y_codes[:, :prefix_len])
+            y_emb = self.nar_audio_embeddings(
+                y_codes[:, prefix_len:, :nar_stage]
+            )
             y_emb = torch.concat([y_prompts, y_emb], axis=1)
         elif self.prefix_mode in [2, 4]:
             if self.prefix_mode == 2:
@@ -372,26 +428,65 @@ class VALLF(nn.Module):
                         torch.clone(codes[b, start : start + prefix_len])
                     )
                     codes[
-                        b, start : start + prefix_len, nar_stage
+                        b,
+                        start : start + prefix_len,
+                        nar_stage : nar_stage + num_stages,
                     ] = NUM_AUDIO_TOKENS
                 y_prompts_codes = torch.stack(y_prompts_codes, dim=0)
             else:
                 prefix_len = y_prompts_codes.shape[1]
 
-            y_prompts = self.nar_audio_embeddings[0](y_prompts_codes[..., 0])
-            y_emb = self.nar_audio_embeddings[0](y)
-            for j in range(1, self.num_quantizers):
-                y_prompts += self.nar_audio_embeddings[j](
-                    y_prompts_codes[..., j]
-                )
-                if j < nar_stage:
-                    y_emb += self.nar_audio_embeddings[j](codes[..., j])
+            y_prompts = self.nar_audio_embeddings(
+                y_prompts_codes[..., : self.num_quantizers]
+            )
+            y_emb = self.nar_audio_embeddings(y_codes[..., :nar_stage])
             y_emb = torch.concat([y_prompts, y_emb], axis=1)
         else:
             raise ValueError
 
         return y_emb, prefix_len
 
+    def _sample_nar_stages(self) -> List[int]:
+        """Sample the Non-AR stages trained by one pass of the NAR Decoder, a
+        group of `nar_group_size` consecutive stages."""
+        group_starts = list(range(1, self.num_quantizers, self.nar_group_size))
+        num_groups = len(group_starts)
+        nar_stage = self.rng.choices(
+            group_starts,
+            weights=[1.0 / num_groups] * num_groups,
+            k=1,
+        )[0]
+        return list(
+            range(
+                nar_stage,
+                min(nar_stage + self.nar_group_size, self.num_quantizers),
+            )
+        )
+
+    def _nar_loss(
+        self,
+        y_dec: torch.Tensor,
+        nar_stages: List[int],
+        targets: List[torch.Tensor],
+        reduction: str = "sum",
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The cross-entropy loss of the prediction layers of `nar_stages`,
+        averaged over the stages, and the logits of the first stage."""
+        logits = [
+            self.nar_predict_layers[j - 1](y_dec).permute(0, 2, 1)
+            for j in nar_stages
+        ]
+        loss = sum(
+            F.cross_entropy(
+                stage_logits,
+                stage_targets,
+                ignore_index=NUM_AUDIO_TOKENS,
+                reduction=reduction,
+            )
+            for stage_logits, stage_targets in zip(logits, targets)
+        )
+        return loss / len(nar_stages), logits[0]
+
     def forward(
         self,
         x: torch.Tensor,
@@ -491,28 +586,32 @@ class VALLF(nn.Module):
             y = y[:, 1:]
 
         if train_stage in [0, 2]:
-            num_nar_layers = self.num_quantizers - 1
-            nar_stage = self.rng.choices(
-                [_k for _k in range(1, self.num_quantizers)],
-                weights=[1.0 / num_nar_layers] * num_nar_layers,
-                k=1,
-            )[0]
+            nar_stages = self._sample_nar_stages()
+            nar_stage = nar_stages[0]
 
             x = self.nar_text_embedding(text)
             x = self.nar_text_prenet(x)
             x = self.nar_text_position(x)
 
             y_emb, prefix_len = self._prepare_prompts(
-                y, y_lens, codes, nar_stage, y_prompts_codes
+                y,
+                y_lens,
+                codes,
+                nar_stage,
+                y_prompts_codes,
+                num_stages=len(nar_stages),
             )
 
             y_len = y_lens.max()
-            targets = codes[..., nar_stage] + NUM_AUDIO_TOKENS * y_mask_int
+            targets = [
+                codes[..., j] + NUM_AUDIO_TOKENS * y_mask_int
+                for j in nar_stages
+            ]
             if self.prefix_mode in [2, 4]:
                 targets = targets
                 y_mask = F.pad(y_mask, (y_emb.shape[1] - y_len, 0), value=False)
             elif self.prefix_mode == 1:
-                targets = targets[:, prefix_len:]
+                targets = [t[:, prefix_len:] for t in targets]
             else:
                 assert prefix_len == 0
 
@@ -532,19 +631,13 @@ class VALLF(nn.Module):
                 if self.prefix_mode == 4:
                     prefix_len = 0  # reset for Top10Accuracy metric
 
-            logits = self.nar_predict_layers[nar_stage - 1](y_dec).permute(
-                0, 2, 1
+            nar_loss, logits = self._nar_loss(
+                y_dec, nar_stages, targets, reduction=reduction
             )
             # loss
             total_length = (y_lens).sum().type(torch.float32)
-            total_loss += (
-                F.cross_entropy(
-                    logits,
-                    targets,
-                    ignore_index=NUM_AUDIO_TOKENS,
-                    reduction=reduction,
-                )
-                * (total_length / (total_length - prefix_len * x.shape[0]))
+            total_loss += nar_loss * (
+                total_length / (total_length - prefix_len * x.shape[0])
             )
             metrics["NarTop10Accuracy"] = (
                 self.nar_accuracy_metric(
@@ -553,7 +646,7 @@ class VALLF(nn.Module):
                         (0, 0, 0, 1, 0, 0),
                         value=logits.min().cpu().item(),
                     ),
-                    targets,
+                    targets[0],
                 ).item()
                 * total_length
             )
@@ -571,6 +664,12 @@ class VALLF(nn.Module):
         enroll_x_lens: Union[torch.Tensor, None] = None,
         top_k: int = -100,
         temperature: float = 1.0,
+        use_kv_cache: bool = False,
+        int8_kv_cache: bool = False,
+        guard: Optional[RunawayGuard] = None,
+        prompt_cache: Optional[PromptCache] = None,
+        ar_only: bool = False,
+        num_output_quantizers: Optional[int] = None,
     ) -> torch.Tensor:
         """
         Args:
@@ -585,6 +684,24 @@ class VALLF(nn.Module):
             The number of highest probability tokens to keep for top-k-filtering. Default to -100.
           temperature: (`optional`) float
             The value used to module the next token probabilities. Must be strictly positive. Default to 1.0.
+          use_kv_cache: (`optional`) bool
+            Feed only the newest token through the AR Decoder, reading the previous
+            steps and the key/value projections of the text memory from a cache.
+          int8_kv_cache: (`optional`) bool
+            Store the cached keys/values in int8 with a scale per head and position.
+          guard: (`optional`) RunawayGuard
+            Check the generated tokens for runaway generation (length budget, looping
+            n-grams, long silence) at every step, and abort or retry accordingly.
+          prompt_cache: (`optional`) PromptCache
+            Reuse the prompt-side tensors of the audio prompt `y` across calls.
+          ar_only: (`optional`) bool
+            Return the codes of the AR Decoder only, (1, T, 1), e.g. to batch the
+            Non-AR Decoders of several requests with NarBatchExecutor.
+          num_output_quantizers: (`optional`) int
+            Run the Non-AR Decoders of the first `num_output_quantizers - 1` stages
+            only and return that many quantizers, which EnCodec decodes at a lower
+            bandwidth (0.75 kbps per quantizer), e.g. for low-latency previews.
+            Default to all the `num_quantizers`.
         Returns:
           Return the predicted audio code matrix and cross-entropy loss.
         """
@@ -606,30 +723,60 @@ class VALLF(nn.Module):
         prefix_len = y.shape[1]
 
         # AR Decoder
-        # TODO: Managing decoder steps avoid repetitive computation
         y = prompts[..., 0]
         if self.ar_audio_prepend_bos:
             y = F.pad(y, (1, 0), value=NUM_AUDIO_TOKENS + 1)
 
-        while True:
-            y_emb = self.ar_audio_embedding(y)
-            y_emb = self.ar_audio_prenet(y_emb)
-            y_pos = self.ar_audio_position(y_emb)
+        cache = None
+        if use_kv_cache:
+            cache = KVCache(self.ar_decoder.num_layers, int8=int8_kv_cache)
 
-            tgt_mask = torch.triu(
-                torch.ones(
-                    y.shape[1], y.shape[1], device=y.device, dtype=torch.bool
-                ),
-                diagonal=1,
+        if guard is not None:
+            # the budget is for the text to synthesize
+            enrolled_len = (
+                enroll_x_lens.max().item() if enroll_x_lens is not None else 0
             )
+            guard.start(max(x_lens.max().item() - enrolled_len, 1))
 
-            y_dec, _ = self.ar_decoder(
-                (y_pos, None),
-                x,
-                tgt_mask=tgt_mask,
-                memory_mask=None,
-                memory_key_padding_mask=x_mask,
-            )
+        while True:
+            if cache is not None and len(cache) > 0:
+                # only the newest token goes through the decoder
+                y_emb = self.ar_audio_embedding(y[:, -1:])
+                y_emb = self.ar_audio_prenet(y_emb)
+                y_pos = self.ar_audio_position(y_emb, offset=y.shape[1] - 1)
+                tgt_mask = None
+            else:
+                y_emb = self.ar_audio_embedding(y)
+                y_emb = self.ar_audio_prenet(y_emb)
+                y_pos = self.ar_audio_position(y_emb)
+
+                tgt_mask = torch.triu(
+                    torch.ones(
+                        y.shape[1],
+                        y.shape[1],
+                        device=y.device,
+                        dtype=torch.bool,
+                    ),
+                    diagonal=1,
+                )
+
+            if cache is not None:
+                y_dec, _ = self.ar_decoder.infer(
+                    (y_pos, None),
+                    x,
+                    tgt_mask=tgt_mask,
+                    memory_mask=None,
+                    memory_key_padding_mask=x_mask,
+                    cache=cache,
+                )
+            else:
+                y_dec, _ = self.ar_decoder(
+                    (y_pos, None),
+                    x,
+                    tgt_mask=tgt_mask,
+                    memory_mask=None,
+                    memory_key_padding_mask=x_mask,
+                )
             logits = self.ar_predict_layer(y_dec[:, -1])
             samples = topk_sampling(
                 logits, top_k=top_k, top_p=1.0, temperature=temperature
@@ -650,11 +797,29 @@ class VALLF(nn.Module):
 
             y = torch.concat([y, samples], dim=1)
 
+            if guard is not None:
+                runaway = guard.update(samples[0].tolist())
+                if runaway is not None:
+                    y_len = prefix_len + int(self.ar_audio_prepend_bos)
+                    if guard.retry():
+                        # sample again from the prompt
+                        y = y[:, :y_len]
+                        if cache is not None:
+                            cache.truncate(y_len - 1)
+                        continue
+                    y = y[:, : y_len + runaway[1]]
+                    print(f"VALL-F runaway [{prefix_len} -> {y.shape[1]}]")
+                    break
+
         codes = [y[:, prefix_len + int(self.ar_audio_prepend_bos) :]]
-        if self.num_quantizers == 1:
+        num_output_quantizers = self._num_output_quantizers(
+            num_output_quantizers
+        )
+        if num_output_quantizers == 1 or ar_only:
             return torch.stack(codes, dim=-1)
 
         # Non-AR Decoders
+        self.freeze_nar_stages()
         y_emb = self.nar_audio_embeddings[0](
             y[:, int(self.ar_audio_prepend_bos) :]
         )
@@ -675,26 +840,32 @@ class VALLF(nn.Module):
         x = self.nar_text_position(x)
 
         if self.prefix_mode != 0:
-            for j in range(1, self.num_quantizers):
-                y_emb[:, :prefix_len] += self.nar_audio_embeddings[j](
-                    prompts[..., j]
-                )
+            prompt_pos = self._nar_prompt_position(
+                prompts, prompt_cache=prompt_cache
+            )
 
+        # the text memory is the same for all the stages
+        memory_kv = self.nar_decoder.compute_memory_kv(x)
         for i, (predict_layer, embedding_layer) in enumerate(
-            zip(
-                self.nar_predict_layers,
-                self.nar_audio_embeddings[1:],
-            )
+            self._nar_stages(num_output_quantizers)
         ):
-            y_pos = self.nar_audio_prenet(y_emb)
-            y_pos = self.nar_audio_position(y_pos)
-            y_dec, _ = self.nar_decoder(
-                (y_pos, self.nar_stage_embeddings[i].weight),
-                x,
-                tgt_mask=None,
-                memory_mask=None,
-                memory_key_padding_mask=None,
-            )
+            # one pass of the NAR Decoder per group of stages
+            if i % self.nar_group_size == 0:
+                if self.prefix_mode != 0:
+                    y_pos = self._nar_audio_position(
+                        y_emb[:, prefix_len:], prompt_pos
+                    )
+                else:
+                    y_pos = self.nar_audio_prenet(y_emb)
+                    y_pos = self.nar_audio_position(y_pos)
+                y_dec, _ = self.nar_decoder(
+                    (y_pos, self.nar_stage_embeddings[i].weight),
+                    x,
+                    tgt_mask=None,
+                    memory_mask=None,
+                    memory_key_padding_mask=None,
+                    memory_kv=memory_kv,
+                )
             logits = predict_layer(y_dec[:, prefix_len:])
             samples = torch.argmax(logits, dim=-1)
             codes.append(samples)
@@ -706,9 +877,519 @@ class VALLF(nn.Module):
                     )
                 y_emb[:, prefix_len:] += embedding_layer(samples)
 
-        assert len(codes) == self.num_quantizers
+        assert len(codes) == num_output_quantizers
         return torch.stack(codes, dim=-1)
 
+    def batch_inference(
+        self,
+        x: torch.Tensor,
+        x_lens: torch.Tensor,
+        y: torch.Tensor,
+        y_lens: torch.Tensor,
+        enroll_x_lens: Union[torch.Tensor, None] = None,
+        top_k: Param = -100,
+        temperature: Param = 1.0,
+        prompt_cache: Optional[PromptCache] = None,
+        kv_pool: Optional[BlockPool] = None,
+        int8_kv_cache: bool = False,
+        top_p: Param = 1.0,
+        generators: Optional[List[Optional[torch.Generator]]] = None,
+        num_output_quantizers: Optional[int] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+          x:
+            A 2-D tensor of shape (N, S).
+          x_lens:
+            A 1-D tensor of shape (N,). It contains the number of tokens in `x`
+            before padding.
+          y:
+            A 3-D tensor of shape (N, T, 8), the audio prompts. If its shape is
+            (1, T, 8), the single prompt is shared by all the texts and its
+            embeddings are computed once for the batch.
+          y_lens:
+            A 1-D tensor of shape (N,) or (1,). It contains the number of frames
+            in `y` before padding.
+          enroll_x_lens:
+            A 1-D tensor of shape (N,). It contains the number of tokens of the
+            text prompts in `x`, required by prefix_mode 2 and 4.
+          top_k: (`optional`) int or 1-D tensor of shape (N,)
+            The number of highest probability tokens to keep for top-k-filtering. Default to -100.
+          temperature: (`optional`) float or 1-D tensor of shape (N,)
+            The value used to module the next token probabilities. Must be strictly positive. Default to 1.0.
+          prompt_cache: (`optional`) PromptCache
+            Reuse the prompt-side tensors of a shared audio prompt `y` across calls.
+          kv_pool: (`optional`) BlockPool
+            Decode the AR stage with a paged key/value cache in this fixed
+            memory budget, see VALLE.kv_block_pool(). The texts are admitted
+            while there are free blocks and preempted (recomputed later) when
+            the pool runs out. VALL-E only, not combined with `int8_kv_cache`.
+          int8_kv_cache: (`optional`) bool
+            Store the cached keys/values in int8 with a scale per head and position.
+          top_p: (`optional`) float or 1-D tensor of shape (N,)
+            The cumulative probability of the tokens to keep for nucleus filtering. Default to 1.0.
+          generators: (`optional`) list of torch.Generator
+            The random generators of the texts, e.g. seeded per request, see Sampler.
+          num_output_quantizers: (`optional`) int
+            The number of quantizers of the output.
+            See inference().
+        Returns:
+          Return the predicted audio code matrix of shape (N, T', 8) and its lengths of shape (N,).
+        """
+        assert x.ndim == 2, x.shape
+        assert x_lens.ndim == 1, x_lens.shape
+        assert y.ndim == 3, y.shape
+        assert y_lens.ndim == 1, y_lens.shape
+        assert x.shape[0] == x_lens.shape[0]
+        assert y.shape[0] == y_lens.shape[0]
+        assert y.shape[0] in [1, x.shape[0]]
+
+        assert torch.all(x_lens > 0)
+        assert torch.all(y_lens > 0)
+        assert kv_pool is None or isinstance(
+            self, VALLE
+        ), "The paged key/value cache is implemented for VALL-E."
+        assert not (
+            kv_pool is not None and int8_kv_cache
+        ), "The paged key/value cache is not quantized."
+        # VALL-E, see VALLE.inference(attention_window=)
+        assert not getattr(self, "ar_attention_window", 0), (
+            "The batched AR decoding attends over all the positions, "
+            "decode a model trained with ar_attention_window with inference()."
+        )
+
+        y = y.type(torch.int64)
+        sampler = Sampler(
+            top_k=top_k,
+            top_p=top_p,
+            temperature=temperature,
+            generators=generators,
+        )
+        if kv_pool is not None:
+            codes, code_lens = self._ar_paged_decode(
+                x, x_lens, y, y_lens, kv_pool, sampler
+            )
+        else:
+            codes, code_lens = self._ar_batch_decode(
+                x, x_lens, y, y_lens, sampler, int8_kv_cache=int8_kv_cache
+            )
+        if self._num_output_quantizers(num_output_quantizers) == 1:
+            return codes.unsqueeze(-1), code_lens
+
+        codes = self._nar_batch_decode(
+            x,
+            x_lens,
+            y,
+            y_lens,
+            codes,
+            code_lens,
+            enroll_x_lens,
+            prompt_cache=prompt_cache,
+            num_output_quantizers=num_output_quantizers,
+        )
+        return codes, code_lens
+
+    def _ar_prefill(
+        self,
+        x: torch.Tensor,
+        x_mask: torch.Tensor,
+        y_pos: torch.Tensor,
+        y_mask: torch.Tensor,
+        cache: KVCache,
+    ) -> torch.Tensor:
+        """Run the AR Decoder over the audio prompts `y_pos` and fill `cache`.
+
+        Returns the decoder outputs of shape (N, T, D) at the positions of `y_pos`.
+        """
+        tgt_mask = torch.triu(
+            torch.ones(
+                y_pos.shape[1],
+                y_pos.shape[1],
+                device=y_pos.device,
+                dtype=torch.bool,
+            ),
+            diagonal=1,
+        )
+        y_dec, _ = self.ar_decoder.infer(
+            (y_pos, None),
+            x,
+            tgt_mask=tgt_mask,
+            tgt_key_padding_mask=y_mask,
+            memory_key_padding_mask=x_mask,
+            cache=cache,
+        )
+        return y_dec
+
+    def _ar_step(
+        self,
+        x: torch.Tensor,
+        x_mask: torch.Tensor,
+        y_pos: torch.Tensor,
+        y_mask: torch.Tensor,
+        cache: KVCache,
+    ) -> torch.Tensor:
+        """Run the AR Decoder over the newest tokens `y_pos` of shape (N, 1, D).
+
+        `y_mask` is the padding mask of all (cached + new) audio positions.
+        """
+        y_dec, _ = self.ar_decoder.infer(
+            (y_pos, None),
+            x,
+            tgt_key_padding_mask=y_mask,
+            memory_key_padding_mask=x_mask,
+            cache=cache,
+        )
+        return y_dec
+
+    def _num_output_quantizers(
+        self, num_output_quantizers: Optional[int] = None
+    ) -> int:
+        if num_output_quantizers is None:
+            return self.num_quantizers
+        assert 1 <= num_output_quantizers <= self.num_quantizers, (
+            num_output_quantizers,
+            self.num_quantizers,
+        )
+        return num_output_quantizers
+
+    def _nar_stages(
+        self, num_output_quantizers: Optional[int] = None
+    ) -> List[Tuple[nn.Module, nn.Module]]:
+        """The predict layer and the embedding of the predicted codes of the
+        Non-AR stages producing `num_output_quantizers` quantizers."""
+        num_output_quantizers = self._num_output_quantizers(
+            num_output_quantizers
+        )
+        return list(
+            zip(
+                self.nar_predict_layers[: num_output_quantizers - 1],
+                self.nar_audio_embeddings[1:num_output_quantizers],
+            )
+        )
+
+    def freeze_nar_stages(self) -> None:
+        """Precompute the weights and biases of the AdaptiveLayerNorm layers of
+        the NAR Decoder for every stage embedding, see AdaptiveLayerNorm.freeze().
+        Only the missing or stale entries are computed, a no-op in training."""
+        if self.training or self.num_quantizers == 1:
+            return
+        embeddings = [
+            stage_embedding.weight
+            for stage_embedding in self.nar_stage_embeddings
+        ]
+        for module in self.nar_decoder.modules():
+            if isinstance(module, AdaptiveLayerNorm):
+                module.freeze(embeddings)
+
+    def _nar_memory_kv(
+        self, x: torch.Tensor
+    ) -> Optional[List[Tuple[torch.Tensor, torch.Tensor]]]:
+        """The key/value projections of the text memory `x` of the NAR Decoder,
+        computed once and shared by all the stages, see _nar_stage()."""
+        return self.nar_decoder.compute_memory_kv(x)
+
+    def _nar_stage(
+        self,
+        x: torch.Tensor,
+        x_mask: torch.Tensor,
+        y_pos: torch.Tensor,
+        y_mask: torch.Tensor,
+        stage: int,
+        memory_kv: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None,
+    ) -> torch.Tensor:
+        """Run the NAR Decoder of `stage` (1-based), returns the decoder outputs
+        at the audio positions."""
+        y_dec, _ = self.nar_decoder(
+            (y_pos, self.nar_stage_embeddings[stage - 1].weight),
+            x,
+            tgt_mask=None,
+            tgt_key_padding_mask=y_mask,
+            memory_mask=None,
+            memory_key_padding_mask=x_mask,
+            memory_kv=memory_kv,
+        )
+        return y_dec
+
+    def _ar_batch_decode(
+        self,
+        x: torch.Tensor,
+        x_lens: torch.Tensor,
+        y: torch.Tensor,
+        y_lens: torch.Tensor,
+        sampler: Sampler,
+        int8_kv_cache: bool = False,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Batched AR decoding with a key/value cache, every row stops at its own
+        EOS and the finished rows are removed from the batch.
+
+        Returns the codes of the first quantizer (N, T') and their lengths (N,),
+        the length of a row which emits EOS on its first step is 0.
+        """
+        batch_size = x.shape[0]
+        device = x.device
+        bos = int(self.ar_audio_prepend_bos)
+
+        x_mask = make_pad_mask(x_lens, x.shape[1]).to(device)
+        x = self.ar_text_embedding(x)
+        x = self.ar_text_prenet(x)
+        x = self.ar_text_position(x)
+
+        y_mask = make_pad_mask(y_lens, y.shape[1]).to(device)
+        # audio tokens of the prompts, the padded positions are masked out
+        tokens = y[..., 0].masked_fill(y_mask, 0)
+        if self.ar_audio_prepend_bos:
+            tokens = F.pad(tokens, (1, 0), value=NUM_AUDIO_TOKENS + 1)
+            y_mask = F.pad(y_mask, (1, 0), value=False)
+        prompt_lens = y_lens + bos
+
+        cache = KVCache(self.ar_decoder.num_layers, int8=int8_kv_cache)
+        y_emb = self.ar_audio_embedding(tokens)
+        y_emb = self.ar_audio_prenet(y_emb)
+        y_pos = self.ar_audio_position(y_emb)
+        if y_pos.shape[0] != batch_size:  # a prompt shared by all the rows
+            y_pos = y_pos.expand(batch_size, -1, -1)
+            y_mask = y_mask.expand(batch_size, -1)
+            prompt_lens = prompt_lens.expand(batch_size)
+        y_dec = self._ar_prefill(x, x_mask, y_pos, y_mask, cache)
+        logits = self.ar_predict_layer(
+            y_dec[torch.arange(batch_size, device=device), prompt_lens - 1]
+        )
+
+        # rows[i] is the index in the batch of the i-th active sequence
+        rows = torch.arange(batch_size, device=device)
+        max_lens = x_lens * 16
+        code_lens = torch.zeros_like(x_lens)
+        codes = []
+        while True:
+            samples = sampler(logits, rows)
+            finished = (
+                (torch.argmax(logits, dim=-1) == NUM_AUDIO_TOKENS)
+                | (samples[:, 0] == NUM_AUDIO_TOKENS)
+                | (len(codes) + bos > max_lens[rows])
+            )
+            if torch.any(finished):
+                keep = torch.nonzero(~finished, as_tuple=True)[0]
+                if keep.numel() == 0:
+                    break
+                rows, samples = rows[keep], samples[keep]
+                x, x_mask, y_mask = x[keep], x_mask[keep], y_mask[keep]
+                cache.select(keep)
+
+            step_codes = torch.zeros_like(x_lens)
+            step_codes[rows] = samples[:, 0]
+            codes.append(step_codes)
+            code_lens[rows] += 1
+
+            y_emb = self.ar_audio_embedding(samples)
+            y_emb = self.ar_audio_prenet(y_emb)
+            y_pos = self.ar_audio_position(
+                y_emb, offset=prompt_lens[rows] + len(codes) - 1
+            )
+            y_mask = F.pad(y_mask, (0, 1), value=False)
+            y_dec = self._ar_step(x, x_mask, y_pos, y_mask, cache)
+            logits = self.ar_predict_layer(y_dec[:, -1])
+
+        if not codes:  # every row emitted EOS on its first step
+            return x_lens.new_zeros((batch_size, 0)), code_lens
+        return torch.stack(codes, dim=1), code_lens
+
+    def _nar_batch_decode(
+        self,
+        x: torch.Tensor,
+        x_lens: torch.Tensor,
+        y: torch.Tensor,
+        y_lens: torch.Tensor,
+        codes: torch.Tensor,
+        code_lens: torch.Tensor,
+        enroll_x_lens: Union[torch.Tensor, None] = None,
+        prompt_cache: Optional[PromptCache] = None,
+        num_output_quantizers: Optional[int] = None,
+    ) -> torch.Tensor:
+        """Batched NAR decoding of the codes of the quantizers
+        2..num_output_quantizers.
+
+        Every row is laid out as [prompt, AR codes] and right padded.
+        Returns the code matrix of shape (N, T', num_output_quantizers).
+        """
+        batch_size = x.shape[0]
+        device = x.device
+        shared_prompt = y.shape[0] != batch_size
+        if shared_prompt:
+            y_lens = y_lens.expand(batch_size)
+
+        texts, audios = [], []
+        for b in range(batch_size):
+            text = x[b, : x_lens[b]]
+            if self.prefix_mode in [2, 4]:  # Exclude enrolled_phonemes
+                enrolled_len = enroll_x_lens[b].item()
+                # SOS + Synthesis Text + EOS
+                text = torch.concat([text[:1], text[enrolled_len - 1 :]])
+            texts.append(text)
+
+            audio = F.pad(
+                codes[b, : code_lens[b]].unsqueeze(-1),
+                (0, self.num_quantizers - 1),
+                value=0,
+            )
+            prompt = y[0] if shared_prompt else y[b]
+            audios.append(torch.concat([prompt[: y_lens[b]], audio]))
+
+        nar_x_lens = torch.tensor([len(t) for t in texts], device=device)
+        audio_lens = y_lens + code_lens
+        x = nn.utils.rnn.pad_sequence(texts, batch_first=True)
+        # (N, T, num_quantizers), prompts followed by the AR codes
+        audios = nn.utils.rnn.pad_sequence(audios, batch_first=True)
+
+        x_mask = make_pad_mask(nar_x_lens, x.shape[1]).to(device)
+        x = self.nar_text_embedding(x)
+        x = self.nar_text_prenet(x)
+        x = self.nar_text_position(x)
+
+        positions = torch.arange(audios.shape[1], device=device).unsqueeze(0)
+        prompt_mask = positions < y_lens.unsqueeze(1)
+        code_mask = (positions >= y_lens.unsqueeze(1)) & (
+            positions < audio_lens.unsqueeze(1)
+        )
+        y_mask = ~(prompt_mask | code_mask)
+
+        y_emb = self.nar_audio_embeddings[0](audios[..., 0])
+        if self.prefix_mode != 0 and shared_prompt:
+            prompt_len = y_lens[0].item()
+            y_emb[:, :prompt_len] = self._nar_prompt_embedding(
+                y[:, :prompt_len], prompt_cache=prompt_cache
+            )
+        elif self.prefix_mode != 0:
+            y_emb = torch.where(
+                prompt_mask.unsqueeze(-1),
+                self.nar_audio_embeddings(audios),
+                y_emb,
+            )
+
+        self.freeze_nar_stages()
+        memory_kv = self._nar_memory_kv(x)
+        for i, (predict_layer, embedding_layer) in enumerate(
+            self._nar_stages(num_output_quantizers)
+        ):
+            # one pass of the NAR Decoder per group of stages
+            if i % self.nar_group_size == 0:
+                y_pos = self.nar_audio_prenet(y_emb)
+                y_pos = self.nar_audio_position(y_pos)
+                y_dec = self._nar_stage(
+                    x, x_mask, y_pos, y_mask, i + 1, memory_kv=memory_kv
+                )
+            samples = torch.argmax(predict_layer(y_dec), dim=-1)
+            audios[..., i + 1] = torch.where(
+                code_mask, samples, audios[..., i + 1]
+            )
+
+            # Formula (4) (5)
+            if i < self.num_quantizers - 2:
+                if self.prefix_mode == 0:
+                    mask = prompt_mask | code_mask
+                else:
+                    mask = code_mask
+                mask = mask.unsqueeze(-1)
+                y_emb += embedding_layer(audios[..., i + 1]) * mask
+
+        num_output_quantizers = self._num_output_quantizers(
+            num_output_quantizers
+        )
+        outputs = torch.zeros(
+            (batch_size, code_lens.max(), num_output_quantizers),
+            dtype=audios.dtype,
+            device=device,
+        )
+        for b in range(batch_size):
+            outputs[b, : code_lens[b]] = audios[
+                b, y_lens[b] : audio_lens[b], :num_output_quantizers
+            ]
+        return outputs
+
+    def _nar_prompt_embedding(
+        self,
+        prompts: torch.Tensor,
+        prompt_cache: Optional[PromptCache] = None,
+    ) -> torch.Tensor:
+        """The NAR Decoder input of the audio prompt for prefix_mode != 0, the
+        sum of the embeddings of all its quantizers.
+
+        Args:
+          prompts:
+            A 3-D tensor of shape (1, T, num_quantizers).
+          prompt_cache:
+            If given, the result is looked up in / stored to it, keyed by the
+            value of `prompts` and the state of the model, see
+            _prompt_cache_key().
+        Returns:
+          A 3-D tensor of shape (1, T, E).
+        """
+
+        def compute() -> torch.Tensor:
+            return self.nar_audio_embeddings(
+                prompts[..., : self.num_quantizers]
+            )
+
+        if prompt_cache is None:
+            return compute()
+        key = self._prompt_cache_key(
+            "nar_prompt_embedding", [self.nar_audio_embeddings], prompts
+        )
+        return prompt_cache.get_or_compute(key, compute)
+
+    def _nar_prompt_position(
+        self,
+        prompts: torch.Tensor,
+        prompt_cache: Optional[PromptCache] = None,
+    ) -> torch.Tensor:
+        """The audio prompt part of the NAR Decoder input for prefix_mode != 0,
+        i.e. _nar_prompt_embedding() through nar_audio_prenet and
+        nar_audio_position, which is the same for all the stages.
+
+        Args:
+          prompts:
+            A 3-D tensor of shape (1, T, num_quantizers).
+          prompt_cache:
+            If given, the result is looked up in / stored to it, keyed by the
+            value of `prompts` and the state of the model, see
+            _prompt_cache_key().
+        Returns:
+          A 3-D tensor of shape (1, T, E).
+        """
+
+        def compute() -> torch.Tensor:
+            y_pos = self.nar_audio_prenet(self._nar_prompt_embedding(prompts))
+            return self.nar_audio_position(y_pos)
+
+        if prompt_cache is None:
+            return compute()
+        key = self._prompt_cache_key(
+            "nar_prompt_position",
+            [
+                self.nar_audio_embeddings,
+                self.nar_audio_prenet,
+                self.nar_audio_position,
+            ],
+            prompts,
+        )
+        return prompt_cache.get_or_compute(key, compute)
+
+    def _nar_audio_position(
+        self,
+        y_emb: torch.Tensor,
+        prompt_pos: torch.Tensor,
+        offset: Optional[int] = None,
+    ) -> torch.Tensor:
+        """The NAR Decoder input of the audio, the prompt part `prompt_pos`
+        (see _nar_prompt_position()) followed by the embeddings of the
+        generated frames `y_emb` through nar_audio_prenet and
+        nar_audio_position, `offset` is the position of y_emb[:, 0] and
+        defaults to the prompt length."""
+        if offset is None:
+            offset = prompt_pos.shape[1]
+        y_pos = self.nar_audio_prenet(y_emb)
+        y_pos = self.nar_audio_position(y_pos, offset=offset)
+        return torch.concat([prompt_pos, y_pos], dim=1)
+
     def visualize(
         self,
         predicts: Tuple[torch.Tensor],
@@ -734,6 +1415,11 @@ class VALLE(VALLF):
         prefix_mode: int = 0,
         share_embedding: bool = True,
         nar_scale_factor: float = 1.0,
+        num_mtp_heads: int = 0,
+        mtp_loss_weight: float = 0.3,
+        ar_attention_window: int = 0,
+        ar_exit_layers: Sequence[int] = (),
+        exit_loss_weight: float = 0.3,
         **kwargs,
     ):
         """
@@ -744,6 +1430,21 @@ class VALLE(VALLF):
             The number of heads in the multiheadattention models (required).
           num_layers:
             The number of sub-decoder-layers in the decoder (required).
+          num_mtp_heads:
+            The number of extra AR prediction heads, the k-th head predicts the
+            token t + 1 + k from the hidden state of token t (multi-token prediction).
+          mtp_loss_weight:
+            The weight of the multi-token prediction loss.
+          ar_attention_window:
+            If > 0, the AR Decoder is trained with the band attention mask of
+            inference(attention_window=ar_attention_window): the audio attends
+            over the text, a random prompt-like prefix and the last
+            `ar_attention_window` audio positions only.
+          ar_exit_layers:
+            Train an early exit head (prediction layer) after each of these numbers
+            of AR Decoder layers, see inference(early_exit_threshold=...).
+          exit_loss_weight:
+            The weight of the loss of the early exit heads.
         """
         super(VALLE, self).__init__(
             d_model,
@@ -759,6 +1460,35 @@ class VALLE(VALLF):
             **kwargs,
         )
 
+        self.ar_mtp_layers = nn.ModuleList(
+            [
+                nn.Sequential(
+                    nn.Linear(d_model, d_model),
+                    nn.ReLU(),
+                    nn.Linear(d_model, NUM_AUDIO_TOKENS + 1, bias=False),
+                )
+                for k in range(num_mtp_heads)
+            ]
+        )
+        self.mtp_loss_weight = mtp_loss_weight
+        self.ar_attention_window = ar_attention_window
+
+        assert all(0 < n < num_layers for n in ar_exit_layers)
+        self.ar_exit_layers = list(ar_exit_layers)
+        self.ar_exit_heads = nn.ModuleList(
+            [
+                nn.Sequential(
+                    nn.LayerNorm(d_model),
+                    nn.Linear(d_model, NUM_AUDIO_TOKENS + 1, bias=False),
+                )
+                for n in self.ar_exit_layers
+            ]
+        )
+        self.exit_loss_weight = exit_loss_weight
+        # the AR frames and the AR Decoder layers they went through in
+        # inference(early_exit_threshold=...)
+        self.early_exit_stats = {"frames": 0, "layers": 0}
+
     def forward(
         self,
         x: torch.Tensor,
@@ -845,6 +1575,18 @@ class VALLE(VALLF):
                 (x_len, 0),
                 value=False,
             )
+            if self.ar_attention_window > 0:
+                # the prompt at inference is the beginning of the audio
+                int_low = (0.25 * y_lens.min()).type(torch.int64).item()
+                sink_len = torch.randint(
+                    int_low, int_low * 2 + 1, size=()
+                ).item()
+                y_attn_mask[:, x_len:] |= _ar_window_mask(
+                    y_len,
+                    self.ar_attention_window,
+                    sink_len=min(sink_len, 225) + self.ar_audio_prepend_bos,
+                    device=x.device,
+                )
             xy_attn_mask = torch.concat([x_attn_mask, y_attn_mask], dim=0)
 
             # merge key padding and attention masks
@@ -866,20 +1608,51 @@ class VALLE(VALLF):
 
             xy_pos = torch.concat([x, y_pos], dim=1)
 
-            xy_dec, _ = self.ar_decoder(
-                (xy_pos, None),
-                mask=xy_attn_mask,
-                # src_key_padding_mask=xy_padding_mask,
-                # is_causal=True,
-            )
+            if self.ar_exit_layers:
+                layer_states, (xy_dec, _) = self.ar_decoder(
+                    (xy_pos, None),
+                    mask=xy_attn_mask,
+                    return_layer_states=True,
+                )
+            else:
+                xy_dec, _ = self.ar_decoder(
+                    (xy_pos, None),
+                    mask=xy_attn_mask,
+                    # src_key_padding_mask=xy_padding_mask,
+                    # is_causal=True,
+                )
             logits = self.ar_predict_layer(xy_dec[:, x_len:]).permute(0, 2, 1)
             # loss
             total_loss = F.cross_entropy(logits, targets, reduction=reduction)
 
+            # Early exit heads
+            for n, exit_head in zip(self.ar_exit_layers, self.ar_exit_heads):
+                exit_logits = exit_head(layer_states[n - 1][:, x_len:])
+                total_loss = total_loss + self.exit_loss_weight * (
+                    F.cross_entropy(
+                        exit_logits.permute(0, 2, 1),
+                        targets,
+                        reduction=reduction,
+                    )
+                )
+
             metrics["ArTop10Accuracy"] = self.ar_accuracy_metric(
                 logits.detach(), targets
             ).item() * y_lens.sum().type(torch.float32)
 
+            # Multi-token prediction
+            for k, mtp_layer in enumerate(self.ar_mtp_layers, start=1):
+                if k >= targets.shape[1]:
+                    break
+                mtp_logits = mtp_layer(xy_dec[:, x_len:-k])
+                total_loss = total_loss + self.mtp_loss_weight * (
+                    F.cross_entropy(
+                        mtp_logits.permute(0, 2, 1),
+                        targets[:, k:],
+                        reduction=reduction,
+                    )
+                )
+
         if self.num_quantizers == 1:
             return ((x, codes), total_loss, metrics)
 
@@ -887,23 +1660,27 @@ class VALLE(VALLF):
         if self.ar_audio_prepend_bos:
             y = y[:, 1:]
         if train_stage in [0, 2]:
-            num_nar_layers = self.num_quantizers - 1
-            nar_stage = self.rng.choices(
-                [_k for _k in range(1, self.num_quantizers)],
-                weights=[1.0 / num_nar_layers] * num_nar_layers,
-                k=1,
-            )[0]
+            nar_stages = self._sample_nar_stages()
+            nar_stage = nar_stages[0]
 
             x = self.nar_text_embedding(text)
             x = self.nar_text_prenet(x)
             x = self.nar_text_position(x)
 
             y_emb, prefix_len = self._prepare_prompts(
-                y, y_lens, codes, nar_stage, y_prompts_codes
+                y,
+                y_lens,
+                codes,
+                nar_stage,
+                y_prompts_codes,
+                num_stages=len(nar_stages),
             )
 
             y_len = y_lens.max()
-            targets = codes[..., nar_stage] + NUM_AUDIO_TOKENS * y_mask_int
+            targets = [
+                codes[..., j] + NUM_AUDIO_TOKENS * y_mask_int
+                for j in nar_stages
+            ]
             if self.prefix_mode in [2, 4]:
                 xy_padding_mask = torch.concat(
                     [
@@ -913,7 +1690,7 @@ class VALLE(VALLF):
                     dim=1,
                 )
             elif self.prefix_mode == 1:
-                targets = targets[:, prefix_len:]
+                targets = [t[:, prefix_len:] for t in targets]
 
             y_pos = self.nar_audio_prenet(y_emb)
             y_pos = self.nar_audio_position(y_pos)
@@ -926,20 +1703,14 @@ class VALLE(VALLF):
             xy_dec = xy_dec[:, x_lens.max() + prefix_len :]
             if self.prefix_mode == 4:
                 prefix_len = 0  # reset for Top10Accuracy metric
-            logits = self.nar_predict_layers[nar_stage - 1](xy_dec).permute(
-                0, 2, 1
+            nar_loss, logits = self._nar_loss(
+                xy_dec, nar_stages, targets, reduction=reduction
             )
 
             # loss
             total_length = (y_lens).sum().type(torch.float32)
-            total_loss += (
-                F.cross_entropy(
-                    logits,
-                    targets,
-                    ignore_index=NUM_AUDIO_TOKENS,
-                    reduction=reduction,
-                )
-                * (total_length / (total_length - prefix_len * x.shape[0]))
+            total_loss += nar_loss * (
+                total_length / (total_length - prefix_len * x.shape[0])
             )
             metrics["NarTop10Accuracy"] = (
                 self.nar_accuracy_metric(
@@ -948,7 +1719,7 @@ class VALLE(VALLF):
                         (0, 0, 0, 1, 0, 0),
                         value=logits.min().cpu().item(),
                     ),
-                    targets,
+                    targets[0],
                 ).item()
                 * total_length
             )
@@ -966,6 +1737,21 @@ class VALLE(VALLF):
         enroll_x_lens: torch.Tensor,
         top_k: int = -100,
         temperature: float = 1.0,
+        use_kv_cache: bool = False,
+        int8_kv_cache: bool = False,
+        eos_check_interval: int = 1,
+        draft_model: Optional["VALLE"] = None,
+        num_draft_tokens: int = 4,
+        use_mtp_heads: bool = False,
+        num_candidates: int = 1,
+        prompt_cache: Optional[PromptCache] = None,
+        attention_window: Optional[int] = None,
+        guard: Optional[RunawayGuard] = None,
+        early_exit_threshold: float = 0.0,
+        nar_window_size: int = 0,
+        nar_window_context: int = 32,
+        ar_only: bool = False,
+        num_output_quantizers: Optional[int] = None,
     ) -> torch.Tensor:
         """
         Args:
@@ -980,6 +1766,64 @@ class VALLE(VALLF):
             The number of highest probability tokens to keep for top-k-filtering. Default to -100.
           temperature: (`optional`) float
             The value used to module the next token probabilities. Must be strictly positive. Default to 1.0.
+          use_kv_cache: (`optional`) bool
+            Prefill the text and the audio prompt once and then feed only the newest
+            token through the AR Decoder, reading the previous steps from a key/value cache.
+          int8_kv_cache: (`optional`) bool
+            Store the cached keys/values in int8 with a scale per head and position.
+          eos_check_interval: (`optional`) int
+            Read the EOS flag back to the host every `eos_check_interval` steps only,
+            the frames sampled after EOS are discarded. Values > 1 avoid a device
+            synchronization per step on GPU. Default to 1.
+          draft_model: (`optional`) VALLE
+            A small VALL-E sharing the text and audio tokens, which proposes
+            `num_draft_tokens` tokens that the AR Decoder verifies in one forward pass
+            (speculative decoding). The sampled tokens follow the same distribution as
+            without `draft_model`. Implies `use_kv_cache`.
+          num_draft_tokens: (`optional`) int
+            The number of tokens `draft_model` proposes per step. Default to 4.
+          use_mtp_heads: (`optional`) bool
+            The multi-token prediction heads propose the next tokens, which are
+            verified in the next forward pass of the AR Decoder. Implies `use_kv_cache`.
+          num_candidates: (`optional`) int
+            Sample `num_candidates` hypotheses in one batch from a single prompt prefill
+            and keep the one with the highest cumulative log-probability, only that one
+            goes through the Non-AR Decoders. Implies `use_kv_cache`. Default to 1.
+          prompt_cache: (`optional`) PromptCache
+            Reuse the prompt-side tensors of the audio prompt `y` across calls.
+          attention_window: (`optional`) int
+            If > 0, the AR Decoder attends over the text, the audio prompt and the
+            last `attention_window` generated tokens only, and the key/value cache
+            keeps those positions only: the cost per frame stays constant for long
+            outputs. Default to the `ar_attention_window` the model was trained with,
+            not supported with `draft_model`, `use_mtp_heads` and `num_candidates`.
+          guard: (`optional`) RunawayGuard
+            Check the generated tokens for runaway generation (length budget, looping
+            n-grams, long silence) every `eos_check_interval` steps, and abort or
+            retry accordingly. Not supported with `draft_model`, `use_mtp_heads` and
+            `num_candidates`.
+          early_exit_threshold: (`optional`) float
+            If > 0, a frame skips the remaining AR Decoder layers once the probability
+            of the most likely token of an early exit head (see `ar_exit_layers`)
+            reaches it, the keys/values of the skipped layers are computed from the
+            exiting hidden states. Implies `use_kv_cache`, not supported with
+            `draft_model`, `use_mtp_heads` and `num_candidates`.
+          nar_window_size: (`optional`) int
+            If > 0, the Non-AR Decoders decode the generated frames in windows of
+            `nar_window_size` frames, attending over the text, the audio prompt and
+            `nar_window_context` frames on both sides of the window only: the memory
+            and time stay linear in the output length. Default to 0, i.e. full
+            attention over all the generated frames.
+          nar_window_context: (`optional`) int
+            The number of context frames on each side of the Non-AR windows.
+          ar_only: (`optional`) bool
+            Return the codes of the AR Decoder only, (1, T, 1), e.g. to batch the
+            Non-AR Decoders of several requests with NarBatchExecutor.
+          num_output_quantizers: (`optional`) int
+            Run the Non-AR Decoders of the first `num_output_quantizers - 1` stages
+            only and return that many quantizers, which EnCodec decodes at a lower
+            bandwidth (0.75 kbps per quantizer), e.g. for low-latency previews.
+            Default to all the `num_quantizers`.
         Returns:
           Return the predicted audio code matrix.
         """
@@ -1001,65 +1845,250 @@ class VALLE(VALLF):
         prefix_len = y.shape[1]
 
         # AR Decoder
-        # TODO: Managing decoder steps avoid repetitive computation
-        y = prompts[..., 0]
+        # The tokens, the attention mask and the key/value cache are allocated
+        # once to the maximum length and sliced at every step.
+        bos = int(self.ar_audio_prepend_bos)
+        x_len = x_lens.max().item()
+        max_y_len = prefix_len + x_len * 16 + 1
+        y = torch.zeros((1, max_y_len), dtype=torch.int64, device=x.device)
+        y[:, bos : bos + prefix_len] = prompts[..., 0]
         if self.ar_audio_prepend_bos:
-            y = F.pad(y, (1, 0), value=NUM_AUDIO_TOKENS + 1)
-
-        x_len = x_lens.max()
-        x_attn_mask = torch.zeros((x_len, x_len), dtype=torch.bool)
-
-        while True:
-            y_emb = self.ar_audio_embedding(y)
-            y_emb = self.ar_audio_prenet(y_emb)
-            y_pos = self.ar_audio_position(y_emb)
-            xy_pos = torch.concat([x, y_pos], dim=1)
+            y[:, 0] = NUM_AUDIO_TOKENS + 1
+        y_len = prefix_len + bos
+        fast_decode = (
+            draft_model is not None or num_candidates > 1 or use_mtp_heads
+        )
+        if attention_window is None:
+            attention_window = self.ar_attention_window
+        assert not (fast_decode and attention_window > 0), (
+            "attention_window (ar_attention_window) is not supported by "
+            "speculative decoding, best-of-N and the multi-token prediction "
+            "heads"
+        )
+        assert not (fast_decode and guard is not None), (
+            "guard is not supported by speculative decoding, "
+            "best-of-N and the multi-token prediction heads"
+        )
+        assert not (fast_decode and early_exit_threshold > 0), (
+            "early_exit_threshold is not supported by speculative decoding, "
+            "best-of-N and the multi-token prediction heads"
+        )
+        if early_exit_threshold > 0:
+            assert self.ar_exit_layers, "the model has no early exit heads"
+            use_kv_cache = True
+        xy_attn_mask = _ar_attn_mask(
+            x_len,
+            max_y_len,
+            x.device,
+            window=attention_window,
+            sink_len=y_len,
+        )
 
-            y_len = y.shape[1]
-            x_attn_mask_pad = F.pad(
-                x_attn_mask,
-                (0, y_len),
-                value=True,
-            )
-            y_attn_mask = F.pad(
-                torch.triu(
-                    torch.ones(y_len, y_len, dtype=torch.bool), diagonal=1
-                ),
-                (x_len, 0),
-                value=False,
+        cache = None
+        if use_kv_cache:
+            cache = KVCache(
+                self.ar_decoder.num_layers,
+                max_len=x_len + max_y_len
+                if attention_window <= 0
+                else x_len + y_len + attention_window,
+                int8=int8_kv_cache,
             )
-            xy_attn_mask = torch.concat(
-                [x_attn_mask_pad, y_attn_mask], dim=0
-            ).to(y.device)
 
-            xy_dec, _ = self.ar_decoder(
-                (xy_pos, None),
-                mask=xy_attn_mask,
+        if draft_model is not None:
+            assert draft_model.ar_audio_prepend_bos == self.ar_audio_prepend_bos
+            assert draft_model.ar_attention_window == 0
+            draft_x = draft_model.ar_text_embedding(text)
+            draft_x = draft_model.ar_text_prenet(draft_x)
+            draft_x = draft_model.ar_text_position(draft_x)
+            y_len = self._ar_speculative_decode(
+                x,
+                y,
+                y_len,
+                prefix_len,
+                xy_attn_mask,
+                draft_model,
+                draft_x,
+                num_draft_tokens,
+                top_k=top_k,
+                temperature=temperature,
             )
-            logits = self.ar_predict_layer(xy_dec[:, -1])
-            samples = topk_sampling(
-                logits, top_k=top_k, top_p=1.0, temperature=temperature
+        elif num_candidates > 1:
+            y, y_len = self._ar_best_of_n_decode(
+                x,
+                y,
+                y_len,
+                prefix_len,
+                xy_attn_mask,
+                num_candidates,
+                top_k=top_k,
+                temperature=temperature,
+            )
+        elif use_mtp_heads:
+            assert len(self.ar_mtp_layers) > 0
+            y_len = self._ar_mtp_decode(
+                x,
+                y,
+                y_len,
+                prefix_len,
+                xy_attn_mask,
+                top_k=top_k,
+                temperature=temperature,
             )
+        else:
+            # EOS is tracked on the device, the host only reads it back every
+            # `eos_check_interval` steps
+            finished = torch.zeros((1,), dtype=torch.bool, device=x.device)
+            eos_len = torch.zeros((1,), dtype=torch.int64, device=x.device)
+            num_steps = 0
+            if guard is not None:
+                # the budget is for the text to synthesize
+                enrolled_len = (
+                    enroll_x_lens.max().item()
+                    if enroll_x_lens is not None
+                    else 0
+                )
+                guard.start(max(x_len - enrolled_len, 1))
+                guard_len = y_len
+
+            exit_heads = dict(zip(self.ar_exit_layers, self.ar_exit_heads))
+            exit_logits = []
+            exit_stats = {"frames": 0, "layers": 0}
+
+            def early_exit(i: int, output: Tuple[torch.Tensor, None]) -> bool:
+                # exit after i + 1 layers if the head is confident enough
+                if i + 1 not in exit_heads:
+                    return False
+                logits = exit_heads[i + 1](output[0][:, -1])
+                confidence = F.softmax(logits, dim=-1).max().item()
+                if confidence < early_exit_threshold:
+                    return False
+                exit_logits.append(logits)
+                exit_stats["layers"] += i + 1
+                return True
+
+            while True:
+                if cache is not None and len(cache) > 0:
+                    # only the newest token goes through the decoder,
+                    # it attends over all the cached positions
+                    if attention_window > 0:
+                        # slide the window: keep the text, the prompt and
+                        # the last `attention_window - 1` generated tokens
+                        sink_len = x_len + prefix_len + bos
+                        num_drop = len(cache) - sink_len - attention_window + 1
+                        if num_drop > 0:
+                            cache.drop(sink_len, sink_len + num_drop)
+                    y_emb = self.ar_audio_embedding(y[:, y_len - 1 : y_len])
+                    y_emb = self.ar_audio_prenet(y_emb)
+                    xy_pos = self.ar_audio_position(y_emb, offset=y_len - 1)
+                    if early_exit_threshold > 0:
+                        exit_logits.clear()
+                        exit_stats["frames"] += 1
+                    xy_dec, _ = self.ar_decoder.infer(
+                        (xy_pos, None),
+                        cache=cache,
+                        early_exit=early_exit
+                        if early_exit_threshold > 0
+                        else None,
+                    )
+                    if early_exit_threshold > 0 and not exit_logits:
+                        exit_stats["layers"] += self.ar_decoder.num_layers
+                else:
+                    y_emb = self.ar_audio_embedding(y[:, :y_len])
+                    y_emb = self.ar_audio_prenet(y_emb)
+                    y_pos = self.ar_audio_position(y_emb)
+                    xy_pos = torch.concat([x, y_pos], dim=1)
+                    mask = xy_attn_mask[: x_len + y_len, : x_len + y_len]
+                    if cache is not None:
+                        xy_dec, _ = self.ar_decoder.infer(
+                            (xy_pos, None), mask=mask, cache=cache
+                        )
+                    else:
+                        xy_dec, _ = self.ar_decoder((xy_pos, None), mask=mask)
+                if exit_logits:
+                    logits = exit_logits[0]
+                else:
+                    logits = self.ar_predict_layer(xy_dec[:, -1])
+                samples = topk_sampling(
+                    logits, top_k=top_k, top_p=1.0, temperature=temperature
+                )
 
-            if (
-                torch.argmax(logits, dim=-1)[0] == NUM_AUDIO_TOKENS
-                or samples[0, 0] == NUM_AUDIO_TOKENS
-                or (y.shape[1] - prompts.shape[1]) > x_lens.max() * 16
-            ):
-                if prompts.shape[1] == y.shape[1]:
-                    raise SyntaxError(
-                        "well trained model shouldn't reach here."
-                    )
-
-                print(f"VALL-E EOS [{prompts.shape[1]} -> {y.shape[1]}]")
-                break
-
-            y = torch.concat([y, samples], dim=1)
+                eos = (torch.argmax(logits, dim=-1) == NUM_AUDIO_TOKENS) | (
+                    samples[:, 0] == NUM_AUDIO_TOKENS
+                )
+                eos_len += (eos & ~finished) * y_len
+                finished |= eos
+                num_steps += 1
+
+                if (y_len - prefix_len) > x_len * 16 or (
+                    num_steps % eos_check_interval == 0 and finished.item()
+                ):
+                    if finished.item():
+                        y_len = eos_len.item()
+                    if prefix_len == y_len:
+                        raise SyntaxError(
+                            "well trained model shouldn't reach here."
+                        )
+
+                    print(f"VALL-E EOS [{prefix_len} -> {y_len}]")
+                    break
+
+                y[:, y_len : y_len + 1] = samples
+                y_len += 1
+
+                if guard is not None and num_steps % eos_check_interval == 0:
+                    runaway = guard.update(y[0, guard_len:y_len].tolist())
+                    guard_len = y_len
+                    if runaway is not None:
+                        if guard.retry():
+                            # sample again from the prompt
+                            y_len = guard_len = prefix_len + bos
+                            finished.zero_()
+                            eos_len.zero_()
+                            if cache is not None:
+                                cache.truncate(x_len + y_len - 1)
+                            continue
+                        y_len = prefix_len + bos + runaway[1]
+                        print(f"VALL-E runaway [{prefix_len} -> {y_len}]")
+                        break
+
+            if exit_stats["frames"] > 0:
+                print(
+                    "VALL-E early exit: "
+                    f"{exit_stats['layers'] / exit_stats['frames']:.2f} of "
+                    f"{self.ar_decoder.num_layers} layers per frame"
+                )
+                for k, v in exit_stats.items():
+                    self.early_exit_stats[k] += v
 
+        y = y[:, :y_len]
         codes = [y[:, prefix_len + int(self.ar_audio_prepend_bos) :]]
-        if self.num_quantizers == 1:
+        num_output_quantizers = self._num_output_quantizers(
+            num_output_quantizers
+        )
+        if num_output_quantizers == 1 or ar_only:
             return torch.stack(codes, dim=-1)
 
+        self.freeze_nar_stages()
+        if 0 < nar_window_size < codes[0].shape[1]:
+            x, prompt_pos = self._nar_inputs(
+                text, prompts, enroll_x_lens, prompt_cache=prompt_cache
+            )
+            return torch.concat(
+                [
+                    codes[0].unsqueeze(-1),
+                    self._nar_windowed(
+                        x,
+                        prompts,
+                        prompt_pos,
+                        codes[0],
+                        nar_window_size,
+                        nar_window_context,
+                        num_output_quantizers=num_output_quantizers,
+                    ),
+                ],
+                dim=-1,
+            )
+
         # Non-AR Decoders
         y_emb = self.nar_audio_embeddings[0](
             y[:, int(self.ar_audio_prepend_bos) :]
@@ -1084,18 +2113,17 @@ class VALLE(VALLF):
 
         if self.prefix_mode == 0:
             for i, (predict_layer, embedding_layer) in enumerate(
-                zip(
-                    self.nar_predict_layers,
-                    self.nar_audio_embeddings[1:],
-                )
+                self._nar_stages(num_output_quantizers)
             ):
-                y_pos = self.nar_audio_prenet(y_emb)
-                y_pos = self.nar_audio_position(y_pos)
-                xy_pos = torch.concat([x, y_pos], dim=1)
-
-                xy_dec, _ = self.nar_decoder(
-                    (xy_pos, self.nar_stage_embeddings[i].weight)
-                )
+                # one pass of the NAR Decoder per group of stages
+                if i % self.nar_group_size == 0:
+                    y_pos = self.nar_audio_prenet(y_emb)
+                    y_pos = self.nar_audio_position(y_pos)
+                    xy_pos = torch.concat([x, y_pos], dim=1)
+
+                    xy_dec, _ = self.nar_decoder(
+                        (xy_pos, self.nar_stage_embeddings[i].weight)
+                    )
                 logits = predict_layer(xy_dec[:, text_len + prefix_len :])
 
                 samples = torch.argmax(logits, dim=-1)
@@ -1107,24 +2135,23 @@ class VALLE(VALLF):
                     )
                     y_emb[:, prefix_len:] += embedding_layer(samples)
         else:
-            for j in range(1, self.num_quantizers):
-                y_emb[:, :prefix_len] += self.nar_audio_embeddings[j](
-                    prompts[..., j]
-                )
+            prompt_pos = self._nar_prompt_position(
+                prompts, prompt_cache=prompt_cache
+            )
 
             for i, (predict_layer, embedding_layer) in enumerate(
-                zip(
-                    self.nar_predict_layers,
-                    self.nar_audio_embeddings[1:],
-                )
+                self._nar_stages(num_output_quantizers)
             ):
-                y_pos = self.nar_audio_prenet(y_emb)
-                y_pos = self.nar_audio_position(y_pos)
-                xy_pos = torch.concat([x, y_pos], dim=1)
+                # one pass of the NAR Decoder per group of stages
+                if i % self.nar_group_size == 0:
+                    y_pos = self._nar_audio_position(
+                        y_emb[:, prefix_len:], prompt_pos
+                    )
+                    xy_pos = torch.concat([x, y_pos], dim=1)
 
-                xy_dec, _ = self.nar_decoder(
-                    (xy_pos, self.nar_stage_embeddings[i].weight)
-                )
+                    xy_dec, _ = self.nar_decoder(
+                        (xy_pos, self.nar_stage_embeddings[i].weight)
+                    )
                 logits = predict_layer(xy_dec[:, text_len + prefix_len :])
 
                 samples = torch.argmax(logits, dim=-1)
@@ -1133,14 +2160,894 @@ class VALLE(VALLF):
                 if i < self.num_quantizers - 2:
                     y_emb[:, prefix_len:] += embedding_layer(samples)
 
-        assert len(codes) == self.num_quantizers
+        assert len(codes) == num_output_quantizers
         return torch.stack(codes, dim=-1)
 
+    def inference_stream(
+        self,
+        x: torch.Tensor,
+        x_lens: torch.Tensor,
+        y: torch.Tensor,
+        enroll_x_lens: torch.Tensor,
+        top_k: int = -100,
+        temperature: float = 1.0,
+        chunk_size: int = 40,
+        left_context: int = 40,
+        prompt_cache: Optional[PromptCache] = None,
+        num_output_quantizers: Optional[int] = None,
+    ) -> Iterator[torch.Tensor]:
+        """Streaming version of inference(): the AR Decoder generates the frames
+        one by one and every `chunk_size` new frames go through the Non-AR
+        Decoders, which attend over the text, the audio prompt, the last
+        `left_context` frames and the chunk (not the frames after it).
+
+        Args:
+          x, x_lens, y, enroll_x_lens, top_k, temperature:
+            See inference().
+          chunk_size: (`optional`) int
+            The number of frames of the chunks. Default to 40 (0.53s).
+          left_context: (`optional`) int
+            The number of previous frames the Non-AR Decoders attend over.
+          prompt_cache: (`optional`) PromptCache
+            Reuse the prompt-side tensors of the audio prompt `y` across calls.
+          num_output_quantizers: (`optional`) int
+            See inference().
+        Returns:
+          Yield the predicted audio code matrix chunk by chunk, (1, T_i, 8).
+        """
+        assert x.ndim == 2, x.shape
+        assert y.ndim == 3 and y.shape[0] == 1, y.shape
+        assert chunk_size > 0 and left_context >= 0
+
+        num_output_quantizers = self._num_output_quantizers(
+            num_output_quantizers
+        )
+        if num_output_quantizers > 1:
+            nar_x, prompt_pos = self._nar_inputs(
+                x, y, enroll_x_lens, prompt_cache=prompt_cache
+            )
+
+        # codes[:, :num_done] went through the Non-AR Decoders
+        codes = torch.zeros(
+            (1, x_lens.max().item() * 16 + 1, num_output_quantizers),
+            dtype=torch.int64,
+            device=x.device,
+        )
+        num_frames, num_done = 0, 0
+        ar_frames = self._ar_stream(
+            x, x_lens, y, top_k=top_k, temperature=temperature
+        )
+        for frame in itertools.chain(ar_frames, [None]):
+            if frame is not None:
+                codes[:, num_frames, 0] = frame
+                num_frames += 1
+                if num_frames - num_done < chunk_size:
+                    continue
+            if num_frames == num_done:
+                break
+
+            if num_output_quantizers > 1:
+                start = max(num_done - left_context, 0)
+                codes[:, num_done:num_frames, 1:] = self._nar_window(
+                    nar_x,
+                    y,
+                    prompt_pos,
+                    codes[:, start:num_frames],
+                    start,
+                    num_done - start,
+                    num_output_quantizers=num_output_quantizers,
+                )
+            yield codes[:, num_done:num_frames].clone()
+            num_done = num_frames
+
+    def _ar_stream(
+        self,
+        x: torch.Tensor,
+        x_lens: torch.Tensor,
+        y: torch.Tensor,
+        top_k: int = -100,
+        temperature: float = 1.0,
+    ) -> Iterator[torch.Tensor]:
+        """The AR Decoder of inference(use_kv_cache=True) as a generator,
+        yields the sampled tokens one by one, (1,). The key/value cache slides
+        over the `ar_attention_window` the model was trained with."""
+        x = self.ar_text_embedding(x)
+        x = self.ar_text_prenet(x)
+        x = self.ar_text_position(x)
+
+        prefix_len = y.shape[1]
+        bos = int(self.ar_audio_prepend_bos)
+        x_len = x_lens.max().item()
+        max_y_len = prefix_len + x_len * 16 + 1
+        prompts = y
+        y = torch.zeros((1, max_y_len), dtype=torch.int64, device=x.device)
+        y[:, bos : bos + prefix_len] = prompts[..., 0]
+        if self.ar_audio_prepend_bos:
+            y[:, 0] = NUM_AUDIO_TOKENS + 1
+        y_len = prefix_len + bos
+        attention_window = self.ar_attention_window
+        xy_attn_mask = _ar_attn_mask(
+            x_len,
+            max_y_len,
+            x.device,
+            window=attention_window,
+            sink_len=y_len,
+        )
+        cache = KVCache(
+            self.ar_decoder.num_layers,
+            max_len=x_len + max_y_len
+            if attention_window <= 0
+            else x_len + y_len + attention_window,
+        )
+
+        start = 0
+        while (y_len - prefix_len) <= x_len * 16:
+            if start > 0 and attention_window > 0:
+                # slide the window as inference() does, the newest token
+                # attends over all the cached positions
+                sink_len = x_len + prefix_len + bos
+                num_drop = len(cache) - sink_len - attention_window + 1
+                if num_drop > 0:
+                    cache.drop(sink_len, sink_len + num_drop)
+            logits = self._ar_cached_logits(
+                x,
+                y,
+                start,
+                y_len,
+                xy_attn_mask if start == 0 else None,
+                cache,
+            )[:, -1]
+            start = y_len
+            samples = topk_sampling(
+                logits, top_k=top_k, top_p=1.0, temperature=temperature
+            )
+            if (
+                torch.argmax(logits, dim=-1)[0] == NUM_AUDIO_TOKENS
+                or samples[0, 0] == NUM_AUDIO_TOKENS
+            ):
+                break
+            y[:, y_len : y_len + 1] = samples
+            y_len += 1
+            yield samples[:, 0]
+        print(f"VALL-E EOS [{prefix_len} -> {y_len}]")
+
+    def _nar_inputs(
+        self,
+        text: torch.Tensor,
+        prompts: torch.Tensor,
+        enroll_x_lens: torch.Tensor,
+        prompt_cache: Optional[PromptCache] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """The NAR Decoder inputs of the text (1, S, E) and of the audio prompt
+        (1, P, E), the latter is None for prefix_mode 0, see _nar_window() and
+        _nar_prompt_position()."""
+        self.freeze_nar_stages()
+        if self.prefix_mode in [2, 4]:  # Exclude enrolled_phonemes
+            enrolled_len = enroll_x_lens.max().item()
+            # SOS + Synthesis Text + EOS
+            text = torch.concat(
+                [
+                    text[:, :1],
+                    text[:, enrolled_len - 1 :],
+                ],
+                dim=1,
+            )
+        x = self.nar_text_embedding(text)
+        x = self.nar_text_prenet(x)
+        x = self.nar_text_position(x)
+        if self.prefix_mode == 0:
+            return x, None
+        return x, self._nar_prompt_position(prompts, prompt_cache=prompt_cache)
+
+    def _nar_windowed(
+        self,
+        x: torch.Tensor,
+        prompts: torch.Tensor,
+        prompt_pos: Optional[torch.Tensor],
+        codes: torch.Tensor,
+        window_size: int,
+        context: int,
+        num_output_quantizers: Optional[int] = None,
+    ) -> torch.Tensor:
+        """The Non-AR Decoders over windows of `window_size` frames, each with
+        `context` frames on both sides: the attention is over the text, the
+        audio prompt and at most `window_size + 2 * context` frames.
+
+        Args:
+          x, prompts, prompt_pos:
+            See _nar_window().
+          codes:
+            The codes of the first quantizer, (1, T).
+          window_size:
+            The number of frames of the windows, <= 0 is a single window.
+          context:
+            The number of frames before and after a window the Non-AR Decoders
+            attend over, the codes of the frames after it are discarded.
+          num_output_quantizers:
+            See inference().
+        Returns:
+          The codes of the quantizers 2..num_output_quantizers,
+          (1, T, num_output_quantizers - 1).
+        """
+        num_frames = codes.shape[1]
+        if window_size <= 0:
+            window_size = num_frames
+        frames = codes.new_zeros(
+            (1, num_frames, self._num_output_quantizers(num_output_quantizers))
+        )
+        frames[..., 0] = codes
+        for start in range(0, num_frames, window_size):
+            end = min(start + window_size, num_frames)
+            left = max(start - context, 0)
+            right = min(end + context, num_frames)
+            frames[:, start:end, 1:] = self._nar_window(
+                x,
+                prompts,
+                prompt_pos,
+                frames[:, left:right],
+                left,
+                start - left,
+                num_output_quantizers=num_output_quantizers,
+            )[:, : end - start]
+        return frames[..., 1:]
+
+    def _nar_window(
+        self,
+        x: torch.Tensor,
+        prompts: torch.Tensor,
+        prompt_pos: Optional[torch.Tensor],
+        codes: torch.Tensor,
+        start: int,
+        context_len: int,
+        num_output_quantizers: Optional[int] = None,
+    ) -> torch.Tensor:
+        """The Non-AR Decoders over a window of the generated frames, of
+        inference_stream() and _nar_windowed().
+
+        Args:
+          x:
+            The NAR Decoder input of the text, (1, S, E).
+          prompts:
+            The audio prompt, (1, P, 8).
+          prompt_pos:
+            The NAR Decoder input of the audio prompt for prefix_mode != 0,
+            see _nar_prompt_position().
+          codes:
+            The left context frames (all quantizers) followed by the frames to
+            decode (first quantizer), (1, context_len + T, 8).
+          start:
+            The index of the first left context frame in the generated audio.
+          context_len:
+            The number of left context frames.
+          num_output_quantizers:
+            See inference().
+        Returns:
+          The codes of the quantizers 2..num_output_quantizers of the frames to
+          decode, (1, T, num_output_quantizers - 1).
+        """
+        prefix_len = prompts.shape[1]
+        if self.prefix_mode == 0:
+            prompt_emb = self.nar_audio_embeddings[0](prompts[..., 0])
+        y_emb = self.nar_audio_embeddings[0](codes[..., 0])
+        chunk_start = x.shape[1] + prefix_len + context_len
+
+        chunk_codes = []
+        for i, (predict_layer, embedding_layer) in enumerate(
+            self._nar_stages(num_output_quantizers)
+        ):
+            # one pass of the NAR Decoder per group of stages
+            if i % self.nar_group_size == 0:
+                if self.prefix_mode == 0:
+                    prompt_pos = self.nar_audio_prenet(prompt_emb)
+                    prompt_pos = self.nar_audio_position(prompt_pos)
+                # the left context is at its position in the generated audio
+                y_pos = self._nar_audio_position(
+                    y_emb, prompt_pos, offset=prefix_len + start
+                )
+                xy_pos = torch.concat([x, y_pos], dim=1)
+
+                xy_dec, _ = self.nar_decoder(
+                    (xy_pos, self.nar_stage_embeddings[i].weight)
+                )
+            logits = predict_layer(xy_dec[:, chunk_start:])
+
+            samples = torch.argmax(logits, dim=-1)
+            chunk_codes.append(samples)
+
+            if i < self.num_quantizers - 2:
+                if self.prefix_mode == 0:
+                    prompt_emb += embedding_layer(prompts[..., i + 1])
+                next_codes = torch.concat(
+                    [codes[:, :context_len, i + 1], samples], dim=1
+                )
+                y_emb += embedding_layer(next_codes)
+
+        return torch.stack(chunk_codes, dim=-1)
+
+    def _ar_cached_logits(
+        self,
+        x: torch.Tensor,
+        y: torch.Tensor,
+        start: int,
+        end: int,
+        xy_attn_mask: Optional[torch.Tensor],
+        cache: KVCache,
+    ) -> torch.Tensor:
+        """Pass the tokens y[:, start:end] through the AR Decoder, attending
+        over the positions in `cache`. The text `x` is prepended if `cache` is
+        empty. Without `xy_attn_mask` they attend over all the positions in
+        `cache`, e.g. a single token over a sliding window.
+
+        Returns:
+          The logits of the next token at every position, (1, end - start, V).
+        """
+        return self.ar_predict_layer(
+            self._ar_cached_hidden(x, y, start, end, xy_attn_mask, cache)
+        )
+
+    def _ar_cached_hidden(
+        self,
+        x: torch.Tensor,
+        y: torch.Tensor,
+        start: int,
+        end: int,
+        xy_attn_mask: Optional[torch.Tensor],
+        cache: KVCache,
+    ) -> torch.Tensor:
+        """Like _ar_cached_logits(), but returns the hidden states of the AR
+        Decoder, (1, end - start, E)."""
+        y_emb = self.ar_audio_embedding(y[:, start:end])
+        y_emb = self.ar_audio_prenet(y_emb)
+        xy_pos = self.ar_audio_position(y_emb, offset=start)
+        if len(cache) == 0:
+            assert start == 0
+            xy_pos = torch.concat([x, xy_pos], dim=1)
+
+        x_len = x.shape[1]
+        xy_dec, _ = self.ar_decoder.infer(
+            (xy_pos, None),
+            mask=None
+            if xy_attn_mask is None
+            else xy_attn_mask[len(cache) : x_len + end, : x_len + end],
+            cache=cache,
+        )
+        return xy_dec[:, xy_dec.shape[1] - (end - start) :]
+
+    def _ar_speculative_decode(
+        self,
+        x: torch.Tensor,
+        y: torch.Tensor,
+        y_len: int,
+        prefix_len: int,
+        xy_attn_mask: torch.Tensor,
+        draft_model: "VALLE",
+        draft_x: torch.Tensor,
+        num_draft_tokens: int,
+        top_k: int = -100,
+        temperature: float = 1.0,
+    ) -> int:
+        """Speculative decoding of the AR Decoder: `draft_model` proposes up to
+        `num_draft_tokens` tokens, they are verified in one forward pass and
+        accepted by rejection sampling, see https://arxiv.org/abs/2211.17192
+
+        Args:
+          x:
+            The embedded text of this model, (1, S, E).
+          y:
+            The token buffer (1, max_y_len), y[:, :y_len] are the prompt tokens.
+            The generated tokens are written in place.
+          draft_x:
+            The embedded text of `draft_model`.
+        Returns:
+          Return the number of valid tokens in `y`.
+        """
+        x_len = x.shape[1]
+        max_y_len = y.shape[1]
+        cache = KVCache(self.ar_decoder.num_layers, max_len=x_len + max_y_len)
+        draft_cache = KVCache(
+            draft_model.ar_decoder.num_layers, max_len=x_len + max_y_len
+        )
+        # Both caches hold all the tokens but the last one y[:, y_len - 1],
+        # which is the input of the next step.
+        self._ar_cached_logits(x, y, 0, y_len - 1, xy_attn_mask, cache)
+        draft_model._ar_cached_logits(
+            draft_x, y, 0, y_len - 1, xy_attn_mask, draft_cache
+        )
+
+        num_proposed, num_accepted, num_steps = 0, 0, 0
+        finished = False
+        while not finished and (y_len - prefix_len) <= x_len * 16:
+            num_draft = min(num_draft_tokens, max_y_len - y_len)
+            draft_probs = []
+            for i in range(num_draft):
+                logits = draft_model._ar_cached_logits(
+                    draft_x,
+                    y,
+                    y_len - 1 + i,
+                    y_len + i,
+                    xy_attn_mask,
+                    draft_cache,
+                )
+                probs = sampling_probs(
+                    logits[:, -1], top_k=top_k, temperature=temperature
+                )
+                y[:, y_len + i] = torch.multinomial(probs, num_samples=1)[:, 0]
+                draft_probs.append(probs[0])
+            draft_probs = torch.stack(draft_probs, dim=0)
+
+            logits = self._ar_cached_logits(
+                x, y, y_len - 1, y_len - 1 + num_draft, xy_attn_mask, cache
+            )[0]
+            probs = sampling_probs(logits, top_k=top_k, temperature=temperature)
+            tokens = y[0, y_len : y_len + num_draft]
+            p = probs.gather(1, tokens[:, None])[:, 0]
+            q = draft_probs.gather(1, tokens[:, None])[:, 0]
+            # accept a draft token with probability min(1, p / q)
+            accepted = (torch.rand_like(q) * q < p).tolist()
+            eos_argmax = torch.argmax(logits, dim=-1) == NUM_AUDIO_TOKENS
+            eos_argmax = eos_argmax.tolist()
+            tokens = tokens.tolist()
+            num_steps += 1
+            num_proposed += num_draft
+
+            num_new = num_draft
+            for j in range(num_draft):
+                if eos_argmax[j]:
+                    finished, num_new = True, j
+                    break
+                if not accepted[j]:
+                    # resample from the residual distribution max(0, p - q)
+                    residual = (probs[j] - draft_probs[j]).clamp(min=0)
+                    if residual.sum() <= 0:
+                        residual = probs[j]
+                    token = torch.multinomial(residual, num_samples=1)
+                    y[0, y_len + j] = token[0]
+                    finished = token.item() == NUM_AUDIO_TOKENS
+                    num_new = j if finished else j + 1
+                    break
+                num_accepted += 1
+                if tokens[j] == NUM_AUDIO_TOKENS:
+                    finished, num_new = True, j
+                    break
+
+            y_len += num_new
+            cache.truncate(x_len + y_len - 1)
+            draft_cache.truncate(x_len + y_len - 1)
+
+        if prefix_len == y_len:
+            raise SyntaxError("well trained model shouldn't reach here.")
+
+        num_generated = y_len - prefix_len - int(self.ar_audio_prepend_bos)
+        print(
+            f"VALL-E EOS [{prefix_len} -> {y_len}], speculative decoding: "
+            f"acceptance rate {num_accepted / max(num_proposed, 1):.3f}, "
+            f"{num_generated} tokens in {num_steps} steps "
+            f"({num_generated / max(num_steps, 1):.2f}x)"
+        )
+        return y_len
+
+    def _ar_best_of_n_decode(
+        self,
+        x: torch.Tensor,
+        y: torch.Tensor,
+        y_len: int,
+        prefix_len: int,
+        xy_attn_mask: torch.Tensor,
+        num_candidates: int,
+        top_k: int = -100,
+        temperature: float = 1.0,
+    ) -> Tuple[torch.Tensor, int]:
+        """Sample `num_candidates` hypotheses in parallel after a single prefill
+        of the prompt and select the most likely one.
+
+        The hypotheses are scored with the distribution they are sampled from
+        (top-k filtered, at `temperature`) and ranked by their mean
+        log-probability per token, the EOS included, so that the ones ending
+        first are not favored. The finished hypotheses leave the batch.
+
+        Args:
+          x:
+            The embedded text, (1, S, E).
+          y:
+            The token buffer (1, max_y_len), y[:, :y_len] are the prompt tokens.
+        Returns:
+          Return the token buffer of the selected hypothesis (1, max_y_len) and
+          its number of valid tokens.
+        """
+        x_len = x.shape[1]
+        max_y_len = y.shape[1]
+        cache = KVCache(self.ar_decoder.num_layers, max_len=x_len + max_y_len)
+        logits = self._ar_cached_logits(x, y, 0, y_len, xy_attn_mask, cache)
+        logits = logits[:, -1]
+
+        # expand the prompt into a batch of hypotheses
+        cache.select(
+            torch.zeros(num_candidates, dtype=torch.int64, device=x.device)
+        )
+        y = y.repeat(num_candidates, 1)
+        logits = logits.repeat(num_candidates, 1)
+
+        sampler = Sampler(top_k=top_k, temperature=temperature)
+        scores = torch.zeros(num_candidates, device=x.device)
+        num_tokens = torch.zeros_like(scores)
+        lengths = torch.zeros_like(scores, dtype=torch.int64)
+        # the hypotheses in the batch, in the order of the rows of `cache`
+        alive = torch.arange(num_candidates, device=x.device)
+        while True:
+            log_probs = sampler.logits(logits).log_softmax(dim=-1)
+            samples = sampler(logits)[:, 0]
+            eos = (torch.argmax(logits, dim=-1) == NUM_AUDIO_TOKENS) | (
+                samples == NUM_AUDIO_TOKENS
+            )
+            tokens = samples.masked_fill(eos, NUM_AUDIO_TOKENS)
+            scores[alive] += log_probs.gather(1, tokens[:, None])[:, 0]
+            num_tokens[alive] += 1
+            lengths[alive[eos]] = y_len
+
+            keep = torch.nonzero(~eos)[:, 0]
+            if (y_len - prefix_len) > x_len * 16 or len(keep) == 0:
+                lengths[alive[keep]] = y_len
+                break
+
+            alive = alive[keep]
+            cache.select(keep)
+            y[alive, y_len] = samples[keep]
+            y_len += 1
+            logits = self._ar_cached_logits(
+                x, y[alive], y_len - 1, y_len, xy_attn_mask, cache
+            )[:, -1]
+
+        # the candidates without any generated token
+        start_len = prefix_len + int(self.ar_audio_prepend_bos)
+        scores = (scores / num_tokens).masked_fill(
+            lengths == start_len, float("-inf")
+        )
+        best = torch.argmax(scores).item()
+        y_len = lengths[best].item()
+        if y_len == start_len:
+            raise SyntaxError("well trained model shouldn't reach here.")
+
+        print(
+            f"VALL-E EOS [{prefix_len} -> {y_len}], best of {num_candidates} "
+            f"candidates, mean log-probabilities: {scores.tolist()}"
+        )
+        return y[best : best + 1], y_len
+
+    def _ar_mtp_decode(
+        self,
+        x: torch.Tensor,
+        y: torch.Tensor,
+        y_len: int,
+        prefix_len: int,
+        xy_attn_mask: torch.Tensor,
+        top_k: int = -100,
+        temperature: float = 1.0,
+    ) -> int:
+        """Self-speculative decoding of the AR Decoder: the multi-token
+        prediction heads propose the tokens after the next one, they are fed
+        together with the next token and accepted by rejection sampling against
+        ar_predict_layer in the same forward pass.
+
+        Args:
+          x:
+            The embedded text, (1, S, E).
+          y:
+            The token buffer (1, max_y_len), y[:, :y_len] are the prompt tokens.
+            The generated tokens are written in place.
+        Returns:
+          Return the number of valid tokens in `y`.
+        """
+        x_len = x.shape[1]
+        max_y_len = y.shape[1]
+        cache = KVCache(self.ar_decoder.num_layers, max_len=x_len + max_y_len)
+        # The cache holds all the tokens but the last one y[:, y_len - 1],
+        # the proposals are y[:, y_len : y_len + num_draft].
+        self._ar_cached_hidden(x, y, 0, y_len - 1, xy_attn_mask, cache)
+
+        num_proposed, num_accepted, num_steps = 0, 0, 0
+        num_draft, draft_probs = 0, None
+        finished = False
+        while not finished and (y_len - prefix_len) <= x_len * 16:
+            hidden = self._ar_cached_hidden(
+                x, y, y_len - 1, y_len + num_draft, xy_attn_mask, cache
+            )[0]
+            logits = self.ar_predict_layer(hidden)
+            probs = sampling_probs(logits, top_k=top_k, temperature=temperature)
+            eos_argmax = torch.argmax(logits, dim=-1) == NUM_AUDIO_TOKENS
+            eos_argmax = eos_argmax.tolist()
+            if num_draft > 0:
+                tokens = y[0, y_len : y_len + num_draft]
+                p = probs[:num_draft].gather(1, tokens[:, None])[:, 0]
+                q = draft_probs.gather(1, tokens[:, None])[:, 0]
+                # accept a proposal with probability min(1, p / q)
+                accepted = (torch.rand_like(q) * q < p).tolist()
+                tokens = tokens.tolist()
+            num_steps += 1
+            num_proposed += num_draft
+
+            num_new, last = num_draft + 1, num_draft
+            for j in range(num_draft + 1):
+                if eos_argmax[j]:
+                    finished, num_new = True, j
+                    break
+                if j == num_draft:
+                    token = torch.multinomial(probs[j], num_samples=1)
+                elif accepted[j]:
+                    num_accepted += 1
+                    if tokens[j] == NUM_AUDIO_TOKENS:
+                        finished, num_new = True, j
+                        break
+                    continue
+                else:
+                    # resample from the residual distribution max(0, p - q)
+                    residual = (probs[j] - draft_probs[j]).clamp(min=0)
+                    if residual.sum() <= 0:
+                        residual = probs[j]
+                    token = torch.multinomial(residual, num_samples=1)
+                y[0, y_len + j] = token[0]
+                finished = token.item() == NUM_AUDIO_TOKENS
+                num_new, last = (j if finished else j + 1), j
+                break
+
+            y_len += num_new
+            cache.truncate(x_len + y_len - 1)
+
+            # propose the next tokens from the hidden state which predicted
+            # the last accepted token
+            num_draft = min(len(self.ar_mtp_layers), max_y_len - y_len - 1)
+            if finished or num_draft <= 0:
+                num_draft = 0
+                continue
+            draft_probs = torch.concat(
+                [
+                    sampling_probs(
+                        mtp_layer(hidden[last : last + 1]),
+                        top_k=top_k,
+                        temperature=temperature,
+                    )
+                    for mtp_layer in self.ar_mtp_layers[:num_draft]
+                ],
+                dim=0,
+            )
+            y[0, y_len : y_len + num_draft] = torch.multinomial(
+                draft_probs, num_samples=1
+            )[:, 0]
+
+        if prefix_len == y_len:
+            raise SyntaxError("well trained model shouldn't reach here.")
+
+        num_generated = y_len - prefix_len - int(self.ar_audio_prepend_bos)
+        print(
+            f"VALL-E EOS [{prefix_len} -> {y_len}], multi-token prediction: "
+            f"acceptance rate {num_accepted / max(num_proposed, 1):.3f}, "
+            f"{num_generated} tokens in {num_steps} steps "
+            f"({num_generated / max(num_steps, 1):.2f}x)"
+        )
+        return y_len
+
+    def kv_block_pool(
+        self,
+        max_bytes: int,
+        block_size: int = 16,
+        device: Optional[torch.device] = None,
+    ) -> BlockPool:
+        """A BlockPool of `max_bytes` for the AR Decoder, see
+        batch_inference()."""
+        self_attn = self.ar_decoder.layers[0].self_attn
+        # not quantized by quantize_dynamic()
+        parameter = self.ar_audio_embedding.weight
+        return BlockPool.from_bytes(
+            max_bytes,
+            self.ar_decoder.num_layers,
+            self_attn.num_heads,
+            self_attn.head_dim,
+            block_size=block_size,
+            dtype=parameter.dtype,
+            device=device or parameter.device,
+        )
+
+    def _ar_paged_decode(
+        self,
+        x: torch.Tensor,
+        x_lens: torch.Tensor,
+        y: torch.Tensor,
+        y_lens: torch.Tensor,
+        kv_pool: BlockPool,
+        sampler: Sampler,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Continuous batching of the AR Decoder with a paged key/value cache.
+
+        A text is admitted (its text and prompt are prefilled) when `kv_pool`
+        has the blocks for it, leaving one free block per active sequence.
+        When the pool runs out, the most recently admitted sequence is
+        preempted, its blocks are released and it is prefilled again with its
+        generated tokens once blocks are free. The finished sequences release
+        their blocks at once.
+
+        Returns the codes of the first quantizer (N, T') and their lengths (N,),
+        a text ending on its first step has length 0.
+        """
+        batch_size = x.shape[0]
+        device = x.device
+        bos = int(self.ar_audio_prepend_bos)
+        num_layers = self.ar_decoder.num_layers
+
+        prompts = []
+        for b in range(batch_size):
+            p = b if y.shape[0] == batch_size else 0  # a shared prompt
+            prompt = y[p, : y_lens[p], 0]
+            if self.ar_audio_prepend_bos:
+                prompt = F.pad(prompt, (1, 0), value=NUM_AUDIO_TOKENS + 1)
+            prompts.append(prompt)
+        generated = [[] for _ in range(batch_size)]
+        max_lens = (x_lens * 16).tolist()
+        x_lens = x_lens.tolist()
+
+        def prefill(b: int) -> Tuple[PagedKVCache, torch.Tensor]:
+            text = self.ar_text_embedding(x[b : b + 1, : x_lens[b]])
+            text = self.ar_text_prenet(text)
+            text = self.ar_text_position(text)
+            tokens = torch.concat(
+                [
+                    prompts[b],
+                    torch.tensor(
+                        generated[b], dtype=torch.int64, device=device
+                    ),
+                ]
+            ).unsqueeze(0)
+            y_emb = self.ar_audio_embedding(tokens)
+            y_emb = self.ar_audio_prenet(y_emb)
+            y_pos = self.ar_audio_position(y_emb)
+
+            row_cache = PagedKVCache(kv_pool, num_layers)
+            row_cache.add_sequence()
+            xy_dec, _ = self.ar_decoder.infer(
+                (torch.concat([text, y_pos], dim=1), None),
+                mask=_ar_attn_mask(x_lens[b], tokens.shape[1], device),
+                cache=row_cache,
+            )
+            return row_cache, self.ar_predict_layer(xy_dec[:, -1])
+
+        cache = PagedKVCache(kv_pool, num_layers)
+        waiting = list(range(batch_size))
+        # rows[i] is the index in the batch of the i-th active sequence
+        rows, logits = [], None
+        max_active, num_preempted = 0, 0
+        while waiting or rows:
+            # admission
+            while waiting:
+                b = waiting[0]
+                length = x_lens[b] + len(prompts[b]) + len(generated[b])
+                num_blocks = kv_pool.num_blocks_for(length + 1)
+                if num_blocks > kv_pool.num_free_blocks - len(rows):
+                    if not rows:
+                        raise RuntimeError(
+                            f"The KV block pool is too small for text {b}."
+                        )
+                    break
+                waiting.pop(0)
+                row_cache, row_logits = prefill(b)
+                cache.extend(row_cache)
+                rows.append(b)
+                logits = (
+                    row_logits
+                    if logits is None
+                    else torch.concat([logits, row_logits], dim=0)
+                )
+            max_active = max(max_active, len(rows))
+
+            samples = sampler(logits, torch.tensor(rows))
+            eos = (torch.argmax(logits, dim=-1) == NUM_AUDIO_TOKENS) | (
+                samples[:, 0] == NUM_AUDIO_TOKENS
+            )
+            eos, samples = eos.tolist(), samples[:, 0].tolist()
+
+            keep = []
+            for i, b in enumerate(rows):
+                if eos[i] or len(generated[b]) + bos > max_lens[b]:
+                    continue
+                generated[b].append(samples[i])
+                keep.append(i)
+            cache.select(torch.tensor(keep, dtype=torch.int64))
+            rows = [rows[i] for i in keep]
+
+            # preemption, the sequences starting a new block need free blocks
+            while len(rows) > 1 and (
+                cache.num_blocks_needed(1) > kv_pool.num_free_blocks
+            ):
+                waiting.insert(0, rows.pop())
+                cache.select(torch.arange(len(rows)))
+                num_preempted += 1
+            if not rows:
+                logits = None
+                continue
+
+            tokens = torch.tensor(
+                [generated[b][-1] for b in rows], device=device
+            ).unsqueeze(1)
+            offsets = torch.tensor(
+                [len(prompts[b]) + len(generated[b]) - 1 for b in rows],
+                device=device,
+            )
+            y_emb = self.ar_audio_embedding(tokens)
+            y_emb = self.ar_audio_prenet(y_emb)
+            y_pos = self.ar_audio_position(y_emb, offset=offsets)
+            # the cache masks the positions after the end of every sequence
+            xy_dec, _ = self.ar_decoder.infer((y_pos, None), cache=cache)
+            logits = self.ar_predict_layer(xy_dec[:, -1])
+
+        print(
+            f"VALL-E paged decoding: {max_active} active sequences at most, "
+            f"{num_preempted} preemptions"
+        )
+        code_lens = torch.tensor([len(g) for g in generated], device=device)
+        codes = torch.zeros(
+            (batch_size, code_lens.max()), dtype=torch.int64, device=device
+        )
+        for b in range(batch_size):
+            codes[b, : code_lens[b]] = torch.tensor(generated[b], device=device)
+        return codes, code_lens
+
+    def _ar_prefill(
+        self,
+        x: torch.Tensor,
+        x_mask: torch.Tensor,
+        y_pos: torch.Tensor,
+        y_mask: torch.Tensor,
+        cache: KVCache,
+    ) -> torch.Tensor:
+        x_len = x.shape[1]
+        xy_dec, _ = self.ar_decoder.infer(
+            (torch.concat([x, y_pos], dim=1), None),
+            mask=_ar_attn_mask(x_len, y_pos.shape[1], x.device),
+            src_key_padding_mask=torch.concat([x_mask, y_mask], dim=1),
+            cache=cache,
+        )
+        return xy_dec[:, x_len:]
+
+    def _ar_step(
+        self,
+        x: torch.Tensor,
+        x_mask: torch.Tensor,
+        y_pos: torch.Tensor,
+        y_mask: torch.Tensor,
+        cache: KVCache,
+    ) -> torch.Tensor:
+        xy_dec, _ = self.ar_decoder.infer(
+            (y_pos, None),
+            src_key_padding_mask=torch.concat([x_mask, y_mask], dim=1),
+            cache=cache,
+        )
+        return xy_dec
+
+    def _nar_memory_kv(self, x: torch.Tensor) -> None:
+        # the text is in the self-attention of the NAR Decoder
+        return None
+
+    def _nar_stage(
+        self,
+        x: torch.Tensor,
+        x_mask: torch.Tensor,
+        y_pos: torch.Tensor,
+        y_mask: torch.Tensor,
+        stage: int,
+        memory_kv: None = None,
+    ) -> torch.Tensor:
+        xy_dec, _ = self.nar_decoder(
+            (
+                torch.concat([x, y_pos], dim=1),
+                self.nar_stage_embeddings[stage - 1].weight,
+            ),
+            src_key_padding_mask=torch.concat([x_mask, y_mask], dim=1),
+        )
+        return xy_dec[:, x.shape[1] :]
+
     def continual(
         self,
         x: torch.Tensor,
         x_lens: torch.Tensor,
         y: torch.Tensor,
+        prompt_cache: Optional[PromptCache] = None,
     ) -> torch.Tensor:
         """
         Args:
@@ -1151,6 +3058,8 @@ class VALLE(VALLF):
             before padding.
           y:
             A 3-D tensor of shape (1, T, 8).
+          prompt_cache: (`optional`) PromptCache
+            Reuse the prompt-side tensors of the prompt part of `y` across calls.
         Returns:
           Return the predicted audio code matrix.
         """
@@ -1177,6 +3086,7 @@ class VALLE(VALLF):
 
         codes = [y[:, prefix_len:, 0]]
         # Non-AR Decoders
+        self.freeze_nar_stages()
         x = self.nar_text_embedding(text)
         x = self.nar_text_prenet(x)
         x = self.nar_text_position(x)
@@ -1190,13 +3100,15 @@ class VALLE(VALLF):
                     self.nar_audio_embeddings[1:],
                 )
             ):
-                y_pos = self.nar_audio_position(y_emb)
-                y_pos = self.nar_audio_prenet(y_pos)
-                xy_pos = torch.concat([x, y_pos], dim=1)
-
-                xy_dec, _ = self.nar_decoder(
-                    (xy_pos, self.nar_stage_embeddings[i].weight)
-                )
+                # one pass of the NAR Decoder per group of stages
+                if i % self.nar_group_size == 0:
+                    y_pos = self.nar_audio_position(y_emb)
+                    y_pos = self.nar_audio_prenet(y_pos)
+                    xy_pos = torch.concat([x, y_pos], dim=1)
+
+                    xy_dec, _ = self.nar_decoder(
+                        (xy_pos, self.nar_stage_embeddings[i].weight)
+                    )
                 logits = predict_layer(xy_dec[:, text_len + prefix_len :])
 
                 samples = torch.argmax(logits, dim=-1)
@@ -1208,10 +3120,9 @@ class VALLE(VALLF):
                     )
                     y_emb[:, prefix_len:] += embedding_layer(samples)
         else:
-            for j in range(1, 8):
-                y_emb[:, :prefix_len] += self.nar_audio_embeddings[j](
-                    prompts[..., j]
-                )
+            prompt_pos = self._nar_prompt_position(
+                prompts, prompt_cache=prompt_cache
+            )
 
             for i, (predict_layer, embedding_layer) in enumerate(
                 zip(
@@ -1219,13 +3130,16 @@ class VALLE(VALLF):
                     self.nar_audio_embeddings[1:],
                 )
             ):
-                y_pos = self.nar_audio_prenet(y_emb)
-                y_pos = self.nar_audio_position(y_pos)
-                xy_pos = torch.concat([x, y_pos], dim=1)
+                # one pass of the NAR Decoder per group of stages
+                if i % self.nar_group_size == 0:
+                    y_pos = self._nar_audio_position(
+                        y_emb[:, prefix_len:], prompt_pos
+                    )
+                    xy_pos = torch.concat([x, y_pos], dim=1)
 
-                xy_dec, _ = self.nar_decoder(
-                    (xy_pos, self.nar_stage_embeddings[i].weight)
-                )
+                    xy_dec, _ = self.nar_decoder(
+                        (xy_pos, self.nar_stage_embeddings[i].weight)
+                    )
                 logits = predict_layer(xy_dec[:, text_len + prefix_len :])
 
                 samples = torch.argmax(logits, dim=-1)
@@ -1238,6 +3152,57 @@ class VALLE(VALLF):
         return torch.stack(codes, dim=-1)
 
 
+def _ar_window_mask(
+    y_len: int, window: int, sink_len: int = 0, device: torch.device = None
+) -> torch.Tensor:
+    """The (y_len, y_len) mask of the audio positions out of the attention
+    window: the audio i attends over the first `sink_len` audio positions
+    (e.g. BOS and the audio prompt) and the `window` positions up to i only.
+    True means not allowed to attend.
+    """
+    pos = torch.arange(y_len, device=device)
+    return (pos.unsqueeze(1) - pos.unsqueeze(0) >= window) & (
+        pos.unsqueeze(0) >= sink_len
+    )
+
+
+def _ar_attn_mask(
+    x_len: int,
+    y_len: int,
+    device: torch.device = None,
+    window: int = 0,
+    sink_len: int = 0,
+) -> torch.Tensor:
+    """The (x_len + y_len, x_len + y_len) attention mask of VALL-E AR Decoder,
+    the text attends over the text only and the audio attends over the text and
+    the previous audio. True means not allowed to attend.
+
+    If `window` > 0, the audio attends over the text, the first `sink_len`
+    audio positions and the last `window` audio positions only, see
+    _ar_window_mask().
+
+    The mask of a shorter audio is the top-left block of the mask.
+    """
+    x_attn_mask = F.pad(
+        torch.zeros((x_len, x_len), dtype=torch.bool, device=device),
+        (0, y_len),
+        value=True,
+    )
+    y_attn_mask = F.pad(
+        torch.triu(
+            torch.ones(y_len, y_len, dtype=torch.bool, device=device),
+            diagonal=1,
+        ),
+        (x_len, 0),
+        value=False,
+    )
+    if window > 0:
+        y_attn_mask[:, x_len:] |= _ar_window_mask(
+            y_len, window, sink_len, device
+        )
+    return torch.concat([x_attn_mask, y_attn_mask], dim=0)
+
+
 # https://github.com/microsoft/unilm/blob/master/xtune/src/transformers/modeling_utils.py
 def top_k_top_p_filtering(
     logits, top_k=0, top_p=1.0, filter_value=-float("Inf"), min_tokens_to_keep=1
@@ -1250,38 +3215,17 @@ def top_k_top_p_filtering(
             Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
         Make sure we keep at least min_tokens_to_keep per batch example in the output
     From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
+
+    `logits` is not modified, see valle.modules.sampling for per-row parameters.
     """
     if top_k > 0:
-        top_k = min(
-            max(top_k, min_tokens_to_keep), logits.size(-1)
-        )  # Safety check
-        # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
-
-    if top_p < 1.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(
-            F.softmax(sorted_logits, dim=-1), dim=-1
-        )
-
-        # Remove tokens with cumulative probability above the threshold (token with 0 are kept)
-        sorted_indices_to_remove = cumulative_probs > top_p
-        if min_tokens_to_keep > 1:
-            # Keep at least min_tokens_to_keep (set to min_tokens_to_keep-1 because we add the first one below)
-            sorted_indices_to_remove[..., :min_tokens_to_keep] = 0
-        # Shift the indices to the right to keep also the first token above the threshold
-        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[
-            ..., :-1
-        ].clone()
-        sorted_indices_to_remove[..., 0] = 0
-
-        # scatter sorted tensors to original indexing
-        indices_to_remove = sorted_indices_to_remove.scatter(
-            1, sorted_indices, sorted_indices_to_remove
-        )
-        logits[indices_to_remove] = filter_value
-    return logits
+        top_k = max(top_k, min_tokens_to_keep)
+    filtered = TopP(top_p, min_tokens_to_keep=min_tokens_to_keep)(
+        TopK(top_k)(logits)
+    )
+    if filter_value != -float("Inf"):
+        filtered = filtered.masked_fill(filtered == -float("Inf"), filter_value)
+    return filtered
 
 
 def topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0):
@@ -1291,12 +3235,11 @@ def topk_sampling(logits, top_k=10, top_p=1.0, temperature=1.0):
     #     The number of highest probability vocabulary tokens to keep for top-k-filtering. Between 1 and infinity. Default to 50.
     # top_p: (`optional`) float
     #     The cumulative probability of parameter highest probability vocabulary tokens to keep for nucleus sampling. Must be between 0 and 1. Default to 1.
+    return Sampler(top_k=top_k, top_p=top_p, temperature=temperature)(logits)
+
 
-    # Temperature (higher temperature => more likely to sample low probability tokens)
-    if temperature != 1.0:
-        logits = logits / temperature
-    # Top-p/top-k filtering
-    logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
-    # Sample
-    token = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
-    return token
+def sampling_probs(logits, top_k=10, top_p=1.0, temperature=1.0):
+    """The distribution topk_sampling() samples from."""
+    return Sampler(top_k=top_k, top_p=top_p, temperature=temperature).probs(
+        logits
+    )
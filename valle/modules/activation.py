@@ -2,12 +2,14 @@ from typing import Optional, Tuple
 
 import torch
 from torch import Tensor
-from torch.nn import Linear, Module
+from torch.nn import Linear, Module, ModuleDict
 from torch.nn import functional as F
 from torch.nn.init import constant_, xavier_normal_, xavier_uniform_
 from torch.nn.modules.linear import NonDynamicallyQuantizableLinear
 from torch.nn.parameter import Parameter
 
+from .kv_cache import KVCache, PagedKVCache, dequantize_int8
+
 
 class MultiheadAttention(Module):
     r"""Allows the model to jointly attend to information
@@ -196,6 +198,56 @@ class MultiheadAttention(Module):
 
         super(MultiheadAttention, self).__setstate__(state)
 
+    def quantize_dynamic(self, dtype: torch.dtype = torch.qint8) -> None:
+        r"""Replace the packed input projection ``in_proj_weight`` and
+        ``out_proj`` by dynamically quantized linear layers, for CPU inference.
+
+        Afterwards ``in_proj_weight`` and ``in_proj_bias`` are None, the input
+        projection is split into ``in_proj_q`` (the queries) and ``in_proj_kv``
+        (the keys and values), so that the cross-attention and the cached
+        memory project only what they use, and :meth:`forward` attends like
+        :meth:`infer` (``batch_first`` is required and no attention weights are
+        returned).
+        """
+        assert self._qkv_same_embed_dim and self.in_proj_weight is not None
+        assert self.bias_k is None and not self.add_zero_attn
+
+        E = self.embed_dim
+        # name: (weight, bias)
+        weights = {
+            "in_proj_q": (
+                self.in_proj_weight[:E],
+                None if self.in_proj_bias is None else self.in_proj_bias[:E],
+            ),
+            "in_proj_kv": (
+                self.in_proj_weight[E:],
+                None if self.in_proj_bias is None else self.in_proj_bias[E:],
+            ),
+            "out_proj": (self.out_proj.weight, self.out_proj.bias),
+        }
+        projections = ModuleDict(
+            {
+                name: Linear(E, weight.shape[0], bias=bias is not None)
+                for name, (weight, bias) in weights.items()
+            }
+        )
+        with torch.no_grad():
+            for name, (weight, bias) in weights.items():
+                projections[name].weight.copy_(weight)
+                if bias is not None:
+                    projections[name].bias.copy_(bias)
+        projections = torch.quantization.quantize_dynamic(
+            projections, {Linear}, dtype=dtype
+        )
+
+        if "in_proj_linear" in self._modules:
+            del self.in_proj_linear
+        self.in_proj_weight = None
+        self.in_proj_bias = None
+        self.in_proj_q = projections["in_proj_q"]
+        self.in_proj_kv = projections["in_proj_kv"]
+        self.out_proj = projections["out_proj"]
+
     def forward(
         self,
         query: Tensor,
@@ -254,6 +306,15 @@ class MultiheadAttention(Module):
             .. note::
                 `batch_first` argument is ignored for unbatched inputs.
         """
+        if self._qkv_same_embed_dim and self.in_proj_weight is None:
+            # dynamically quantized, see quantize_dynamic()
+            return (
+                self._quantized_forward(
+                    query, key, value, key_padding_mask, attn_mask
+                ),
+                None,
+            )
+
         is_batched = query.dim() == 3
         if key_padding_mask is not None:
             _kpm_dtype = key_padding_mask.dtype
@@ -429,3 +490,164 @@ class MultiheadAttention(Module):
             return attn_output.transpose(1, 0), attn_output_weights
         else:
             return attn_output, attn_output_weights
+
+    def _quantized_forward(
+        self,
+        query: Tensor,
+        key: Tensor,
+        value: Tensor,
+        key_padding_mask: Optional[Tensor],
+        attn_mask: Optional[Tensor],
+    ) -> Tensor:
+        assert self.batch_first and query.dim() == 3
+        if query is key and key is value:
+            q, k, v = [
+                self._split_heads(t)
+                for t in self._in_proj(query).chunk(3, dim=-1)
+            ]
+        else:
+            # cross-attention over a memory
+            assert key is value
+            q = self._split_heads(self._in_proj(query, 0, self.embed_dim))
+            k, v = self.compute_kv(key)
+        return self._attend(q, k, v, attn_mask, key_padding_mask)
+
+    def _in_proj(
+        self, x: Tensor, start: int = 0, end: Optional[int] = None
+    ) -> Tensor:
+        # the rows start:end of the packed input projection
+        if self.in_proj_weight is None:  # dynamically quantized
+            E = self.embed_dim
+            if (start, end) == (0, E):
+                return self.in_proj_q(x)
+            if (start, end) in [(E, None), (E, 3 * E)]:
+                return self.in_proj_kv(x)
+            assert (start, end) in [(0, None), (0, 3 * E)], (start, end)
+            return torch.concat([self.in_proj_q(x), self.in_proj_kv(x)], dim=-1)
+        bias = self.in_proj_bias
+        return F.linear(
+            x,
+            self.in_proj_weight[start:end],
+            None if bias is None else bias[start:end],
+        )
+
+    def _split_heads(self, x: Tensor) -> Tensor:
+        # (N, L, E) -> (N, num_heads, L, head_dim)
+        return x.view(
+            x.shape[0], x.shape[1], self.num_heads, self.head_dim
+        ).transpose(1, 2)
+
+    def compute_kv(self, memory: Tensor) -> Tuple[Tensor, Tensor]:
+        r"""Project ``memory`` of shape :math:`(N, S, E)` to the keys and values
+        of the attention heads, each of shape :math:`(N, \text{num\_heads}, S, E / \text{num\_heads})`.
+
+        The result can be passed to :meth:`infer` as ``memory_kv`` to attend over
+        a memory that does not change between calls.
+        """
+        assert self.batch_first and self._qkv_same_embed_dim
+        k, v = self._in_proj(memory, self.embed_dim).chunk(2, dim=-1)
+        return self._split_heads(k), self._split_heads(v)
+
+    def infer(
+        self,
+        x: Tensor,
+        attn_mask: Optional[Tensor] = None,
+        key_padding_mask: Optional[Tensor] = None,
+        cache: Optional[KVCache] = None,
+        layer_idx: int = 0,
+        memory_kv: Optional[Tuple[Tensor, Tensor]] = None,
+    ) -> Tensor:
+        r"""Attention for incremental decoding.
+
+        Without ``memory_kv`` this is self-attention: the keys and values of ``x``
+        are appended to ``cache`` (if given), and the queries of ``x`` attend over
+        all cached positions. With ``memory_kv`` (see :meth:`compute_kv`) the queries
+        of ``x`` attend over the precomputed keys and values instead.
+
+        Args:
+            x: Input of shape :math:`(N, L, E)`, ``batch_first`` is required.
+            attn_mask: A 2D mask of shape :math:`(L, S)` or a 3D mask of shape
+                :math:`(N\cdot\text{num\_heads}, L, S)`, where :math:`S` is the number
+                of attended positions. Binary and float masks are supported.
+            key_padding_mask: A mask of shape :math:`(N, S)`, ``True`` means ignored.
+                Not used with a :class:`PagedKVCache`, which masks the positions
+                after the end of every sequence itself.
+            cache: Keys/values of the previous steps, updated in place.
+            layer_idx: The index of this layer in ``cache``.
+            memory_kv: Precomputed keys/values of the memory for cross-attention.
+
+        Outputs:
+            - **attn_output** - Attention outputs of shape :math:`(N, L, E)`.
+        """
+        assert self.batch_first and self._qkv_same_embed_dim
+        assert self.bias_k is None and not self.add_zero_attn
+
+        if memory_kv is None:
+            q, k, v = self._in_proj(x).chunk(3, dim=-1)
+            q, k, v = [self._split_heads(t) for t in (q, k, v)]
+            if isinstance(cache, PagedKVCache):
+                assert key_padding_mask is None
+                cache.append(layer_idx, k, v)
+                # attend the blocks in place
+                attn_output = cache.attend(
+                    layer_idx, q * (float(self.head_dim) ** -0.5), attn_mask
+                )
+                return self.out_proj(
+                    attn_output.transpose(1, 2).reshape(
+                        x.shape[0], x.shape[1], self.embed_dim
+                    )
+                )
+            if cache is not None:
+                k, v = cache.update(layer_idx, k, v)
+                if isinstance(k, tuple):  # int8 cache
+                    k = dequantize_int8(*k, dtype=q.dtype)
+                    v = dequantize_int8(*v, dtype=q.dtype)
+        else:
+            q = self._split_heads(self._in_proj(x, 0, self.embed_dim))
+            k, v = memory_kv
+        return self._attend(q, k, v, attn_mask, key_padding_mask)
+
+    def _attend(
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        attn_mask: Optional[Tensor],
+        key_padding_mask: Optional[Tensor],
+    ) -> Tensor:
+        # q, k, v: (N, num_heads, L or S, head_dim) -> (N, L, E)
+        bsz, _, tgt_len, _ = q.shape
+        src_len = k.shape[2]
+
+        attn_weights = torch.matmul(
+            q * (float(self.head_dim) ** -0.5), k.transpose(-2, -1)
+        )
+        if attn_mask is not None:
+            if attn_mask.dim() == 3:
+                attn_mask = attn_mask.view(
+                    bsz, self.num_heads, tgt_len, src_len
+                )
+            if attn_mask.dtype == torch.bool:
+                attn_weights = attn_weights.masked_fill(
+                    attn_mask, float("-inf")
+                )
+            else:
+                attn_weights = attn_weights + attn_mask
+        if key_padding_mask is not None:
+            key_padding_mask = key_padding_mask.view(bsz, 1, 1, src_len)
+            if key_padding_mask.dtype == torch.bool:
+                attn_weights = attn_weights.masked_fill(
+                    key_padding_mask, float("-inf")
+                )
+            else:
+                attn_weights = attn_weights + key_padding_mask
+
+        attn_weights = F.softmax(attn_weights, dim=-1)
+        attn_weights = F.dropout(
+            attn_weights, p=self.dropout, training=self.training
+        )
+        attn_output = torch.matmul(attn_weights, v)
+        attn_output = attn_output.transpose(1, 2).reshape(
+            bsz, tgt_len, self.embed_dim
+        )
+        return self.out_proj(attn_output)
@@ -13,9 +13,11 @@
 # limitations under the License.
 
 import math
+from typing import Iterable, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class TokenEmbedding(nn.Module):
@@ -47,6 +49,69 @@ class TokenEmbedding(nn.Module):
         return X
 
 
+class MultiTokenEmbedding(nn.ModuleList):
+    """The TokenEmbeddings of several codebooks, e.g. the quantizers of the
+    acoustic tokens. forward() sums the embeddings of the first k codebooks in
+    a single embedding_bag lookup on their tables concatenated, the codes of
+    the j-th codebook being offset by the sizes of the previous tables.
+
+    It is a nn.ModuleList of the TokenEmbeddings, so the state dict and the
+    indexing (e.g. sharing a table with a prediction layer) are unchanged. In
+    eval mode the concatenated table is kept until one of the tables changes.
+    """
+
+    def __init__(self, embeddings: Optional[Iterable[TokenEmbedding]] = None):
+        super().__init__(embeddings)
+        assert all(embedding.dropout.p == 0.0 for embedding in self)
+        # (the data_ptr and _version of the tables, weight, offsets)
+        self._fused = None
+
+    def _fused_key(self) -> Tuple[Tuple[int, int], ...]:
+        return tuple(
+            (embedding.weight.data_ptr(), embedding.weight._version)
+            for embedding in self
+        )
+
+    def _fuse(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        weight = torch.cat([embedding.weight for embedding in self], dim=0)
+        offsets = torch.tensor(
+            [0] + [embedding.vocab_size for embedding in self][:-1],
+            device=weight.device,
+        ).cumsum(dim=0)
+        return weight, offsets
+
+    def fused_weight(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The concatenated tables and the offsets of the codebooks."""
+        if self.training:
+            return self._fuse()
+
+        key = self._fused_key()
+        if self._fused is None or self._fused[0] != key:
+            with torch.no_grad():
+                self._fused = (key,) + self._fuse()
+        return self._fused[1:]
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+          x:
+            The codes of the first k codebooks, (..., k).
+        Returns:
+          The sum of their embeddings, (..., dim_model).
+        """
+        num_codebooks = x.shape[-1]
+        assert 1 <= num_codebooks <= len(self), (num_codebooks, len(self))
+        weight, offsets = self.fused_weight()
+        if x.numel() == 0:
+            return weight.new_zeros(x.shape[:-1] + (weight.shape[-1],))
+        X = F.embedding_bag(
+            (x + offsets[:num_codebooks]).reshape(-1, num_codebooks),
+            weight,
+            mode="sum",
+        )
+        return X.reshape(x.shape[:-1] + (weight.shape[-1],))
+
+
 class SinePositionalEmbedding(nn.Module):
     def __init__(
         self,
@@ -65,22 +130,22 @@ class SinePositionalEmbedding(nn.Module):
         self.pe = None
         self.extend_pe(torch.tensor(0.0).expand(1, 4000))
 
-    def extend_pe(self, x):
+    def extend_pe(self, x, length: int = None):
         """Reset the positional encodings."""
+        if length is None:
+            length = x.size(1)
         if self.pe is not None:
-            if self.pe.size(1) >= x.size(1):
+            if self.pe.size(1) >= length:
                 if self.pe.dtype != x.dtype or self.pe.device != x.device:
                     self.pe = self.pe.to(dtype=x.dtype, device=x.device)
                 return
-        pe = torch.zeros(x.size(1), self.dim_model)
+        pe = torch.zeros(length, self.dim_model)
         if self.reverse:
             position = torch.arange(
-                x.size(1) - 1, -1, -1.0, dtype=torch.float32
+                length - 1, -1, -1.0, dtype=torch.float32
             ).unsqueeze(1)
         else:
-            position = torch.arange(
-                0, x.size(1), dtype=torch.float32
-            ).unsqueeze(1)
+            position = torch.arange(0, length, dtype=torch.float32).unsqueeze(1)
         div_term = torch.exp(
             torch.arange(0, self.dim_model, 2, dtype=torch.float32)
             * -(math.log(10000.0) / self.dim_model)
@@ -90,8 +155,26 @@ class SinePositionalEmbedding(nn.Module):
         pe = pe.unsqueeze(0)
         self.pe = pe.to(device=x.device, dtype=x.dtype).detach()
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        self.extend_pe(x)
+    def forward(
+        self, x: torch.Tensor, offset: Union[int, torch.Tensor] = 0
+    ) -> torch.Tensor:
+        """
+        Args:
+          x:
+            A 3-D tensor of shape (N, T, D).
+          offset:
+            The position of x[:, 0], used by incremental decoding.
+            A 1-D tensor of shape (N,) gives every sequence its own offset.
+        """
+        if isinstance(offset, torch.Tensor):
+            positions = offset.view(-1, 1) + torch.arange(
+                x.size(1), device=offset.device
+            )
+            self.extend_pe(x, int(positions.max()) + 1)
+            pe = self.pe[0][positions]
+        else:
+            self.extend_pe(x, offset + x.size(1))
+            pe = self.pe[:, offset : offset + x.size(1)]
         output = x.unsqueeze(-1) if x.ndim == 2 else x
-        output = output * self.x_scale + self.alpha * self.pe[:, : x.size(1)]
+        output = output * self.x_scale + self.alpha * pe
         return self.dropout(output)
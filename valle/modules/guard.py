@@ -0,0 +1,235 @@
+# Copyright    2023                             (authors: Feiteng Li)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import math
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+class LengthBudget:
+    """Upper bound of the number of acoustic frames of a text, from the
+    frames per text token statistics of the training utterances."""
+
+    def __init__(
+        self, frames_per_token: float, margin: int = 10, quantile: float = 1.0
+    ) -> None:
+        self.frames_per_token = frames_per_token
+        self.margin = margin
+        self.quantile = quantile
+
+    def max_frames(self, num_tokens: int) -> int:
+        return int(math.ceil(self.frames_per_token * num_tokens)) + self.margin
+
+    @classmethod
+    def from_cuts(
+        cls, cuts: Iterable, quantile: float = 0.99, margin: int = 10
+    ) -> "LengthBudget":
+        """
+        Args:
+          cuts:
+            The tokenized cuts, i.e. with the text tokens in
+            `cut.supervisions[0].custom["tokens"]["text"]`.
+          quantile:
+            The quantile of the frames per text token of the cuts.
+          margin:
+            The number of frames added to every budget.
+        """
+        ratios = []
+        for cut in cuts:
+            num_tokens = len(cut.supervisions[0].custom["tokens"]["text"])
+            if num_tokens > 0:
+                ratios.append(cut.num_frames / num_tokens)
+        assert ratios, "no tokenized cuts"
+        ratios = sorted(ratios)
+        return cls(
+            ratios[min(int(quantile * len(ratios)), len(ratios) - 1)],
+            margin=margin,
+            quantile=quantile,
+        )
+
+    def save(self, filename: str) -> None:
+        with open(filename, "w") as f:
+            json.dump(
+                {
+                    "frames_per_token": self.frames_per_token,
+                    "margin": self.margin,
+                    "quantile": self.quantile,
+                },
+                f,
+                indent=2,
+            )
+
+    @classmethod
+    def load(cls, filename: str) -> "LengthBudget":
+        with open(filename) as f:
+            return cls(**json.load(f))
+
+
+class RunawayGuard:
+    """Detect runaway AR generation on the fly: the output exceeds its length
+    budget, loops over a short n-gram of codes, or stays silent too long.
+
+    Usage:
+        guard.start(num_text_tokens)
+        for every new chunk of tokens:
+            runaway = guard.update(tokens)
+            if runaway is not None:
+                if guard.retry():
+                    # restart from the prompt, guard.start() again
+                else:
+                    # keep the first `runaway[1]` generated tokens
+
+    Args:
+      budget:
+        The length budget of a text, the length is only bounded by the caller
+        if None.
+      max_ngram_size:
+        Loops of 2 to `max_ngram_size` codes are detected.
+      max_ngram_repeats:
+        A loop is detected once an n-gram is repeated back to back
+        `max_ngram_repeats` times.
+      max_silence_frames:
+        The maximum number of consecutive silence frames.
+      silence_tokens:
+        The codes of silence frames, the runs of a single repeated code are
+        taken as silence if None.
+      policy:
+        "abort" keeps the tokens generated before the runaway, "retry" samples
+        again from the prompt up to `max_retries` times and then aborts.
+    """
+
+    def __init__(
+        self,
+        budget: Optional[LengthBudget] = None,
+        max_ngram_size: int = 16,
+        max_ngram_repeats: int = 6,
+        max_silence_frames: int = 150,
+        silence_tokens: Optional[Sequence[int]] = None,
+        policy: str = "abort",
+        max_retries: int = 2,
+    ) -> None:
+        assert policy in ["abort", "retry"], policy
+        self.budget = budget
+        self.max_ngram_size = max_ngram_size
+        self.max_ngram_repeats = max_ngram_repeats
+        self.max_silence_frames = max_silence_frames
+        self.silence_tokens = (
+            set(silence_tokens) if silence_tokens is not None else None
+        )
+        self.policy = policy
+        self.max_retries = max_retries
+
+        self.num_utterances = 0
+        self.num_retries = 0
+        self.num_aborts = 0
+        self.num_wasted_frames = 0
+        self.num_runaways: Dict[str, int] = {
+            "length": 0,
+            "ngram": 0,
+            "silence": 0,
+        }
+
+        self._retries = 0
+        self.reset(0)
+
+    def start(self, num_text_tokens: int) -> Optional[int]:
+        """Start a new utterance, returns its maximum number of frames."""
+        self.num_utterances += 1
+        self._retries = 0
+        return self.reset(num_text_tokens)
+
+    def reset(self, num_text_tokens: int) -> Optional[int]:
+        """Restart the current utterance, e.g. to retry."""
+        self._tokens: List[int] = []
+        self._matches = [0] * (self.max_ngram_size + 1)
+        self._silence = 0
+        self._run = 0
+        self._keep_len = 0
+        self._num_text_tokens = num_text_tokens
+        self._max_frames = None
+        if self.budget is not None:
+            self._max_frames = self.budget.max_frames(num_text_tokens)
+        return self._max_frames
+
+    def update(self, tokens: Sequence[int]) -> Optional[Tuple[str, int]]:
+        """Append the newly generated tokens (first quantizer).
+
+        Returns:
+          None, or the reason of the runaway and the number of tokens to keep.
+        """
+        for token in tokens:
+            i = len(self._tokens)
+            self._tokens.append(token)
+
+            repeated = i > 0 and token == self._tokens[i - 1]
+            self._run = self._run + 1 if repeated else 1
+            if self.silence_tokens is not None:
+                silent = token in self.silence_tokens
+            else:
+                silent = repeated
+            self._silence = self._silence + 1 if silent else 0
+            if self._silence >= self.max_silence_frames:
+                return self._runaway("silence", i + 1, i + 1 - self._silence)
+
+            for n in range(2, self.max_ngram_size + 1):
+                if i >= n and token == self._tokens[i - n]:
+                    self._matches[n] += 1
+                else:
+                    self._matches[n] = 0
+                if (
+                    self._matches[n] >= n * (self.max_ngram_repeats - 1)
+                    and self._run < self._matches[n] + n  # not a single code
+                ):
+                    # keep the first occurrence of the n-gram
+                    start = i + 1 - self._matches[n] - n
+                    return self._runaway("ngram", i + 1, start + n)
+
+            if self._max_frames is not None and i + 1 > self._max_frames:
+                return self._runaway("length", i + 1, self._max_frames)
+        return None
+
+    def retry(self) -> bool:
+        """Whether to sample the current utterance again after a runaway."""
+        if self.policy == "retry" and self._retries < self.max_retries:
+            self._retries += 1
+            self.num_retries += 1
+            # the kept tokens are discarded as well
+            self.num_wasted_frames += self._keep_len
+            self.reset(self._num_text_tokens)
+            return True
+        self.num_aborts += 1
+        return False
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "utterances": self.num_utterances,
+            "retries": self.num_retries,
+            "aborts": self.num_aborts,
+            "wasted_frames": self.num_wasted_frames,
+            **{f"runaway_{k}": v for k, v in self.num_runaways.items()},
+        }
+
+    def _runaway(
+        self, reason: str, length: int, keep_len: int
+    ) -> Tuple[str, int]:
+        keep_len = max(keep_len, 1)
+        self._keep_len = keep_len
+        self.num_runaways[reason] += 1
+        self.num_wasted_frames += length - keep_len
+        logging.info(
+            f"runaway AR generation ({reason}) after {length} frames, "
+            f"keep {keep_len} frames"
+        )
+        return reason, keep_len
@@ -0,0 +1,492 @@
+# Copyright    2023                             (authors: Feiteng Li)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+
+def quantize_int8(x: Tensor) -> Tuple[Tensor, Tensor]:
+    """Symmetric int8 quantization of the last dim of `x`, e.g. of every head
+    and position of keys/values (N, num_heads, S, head_dim).
+
+    Returns the int8 tensor and the scales of shape (..., 1).
+    """
+    scale = x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / 127.0
+    q = torch.round(x / scale).clamp(-127, 127).to(torch.int8)
+    return q, scale
+
+
+def dequantize_int8(q: Tensor, scale: Tensor, dtype: torch.dtype) -> Tensor:
+    return q.to(dtype) * scale.to(dtype)
+
+
+class KVCache:
+    """Key/value states of the self-attention layers of a decoder stack,
+    grown step by step during autoregressive decoding.
+
+    Keys and values are kept per layer in shape (N, num_heads, S, head_dim).
+    For decoder layers with cross-attention, `memory_kv` additionally keeps the
+    key/value projections of the (unchanging) memory of every layer.
+
+    If `max_len` > 0, the buffers of every layer are allocated once to `max_len`
+    positions and the new states are written in place, instead of being
+    concatenated at every step.
+
+    If `int8` is True, the keys and values are stored in int8 with a scale per
+    head and position (see quantize_int8()), update() then returns the pairs
+    (int8 states, scales) to be dequantized by the attention.
+    """
+
+    def __init__(
+        self, num_layers: int, max_len: int = 0, int8: bool = False
+    ) -> None:
+        self.num_layers = num_layers
+        self.max_len = max_len
+        self.int8 = int8
+        self.lengths = [0] * num_layers
+        self.keys: List[Optional[Tensor]] = [None] * num_layers
+        self.values: List[Optional[Tensor]] = [None] * num_layers
+        self.key_scales: List[Optional[Tensor]] = [None] * num_layers
+        self.value_scales: List[Optional[Tensor]] = [None] * num_layers
+        self.memory_kv: List[Optional[Tuple[Tensor, Tensor]]] = [
+            None
+        ] * num_layers
+
+    def __len__(self) -> int:
+        return self.lengths[0]
+
+    def nbytes(self) -> int:
+        """The memory held by the self-attention states."""
+        return sum(
+            t.numel() * t.element_size()
+            for buffers in [
+                self.keys,
+                self.values,
+                self.key_scales,
+                self.value_scales,
+            ]
+            for t in buffers
+            if t is not None
+        )
+
+    def _buffers(self) -> List[List[Optional[Tensor]]]:
+        if self.int8:
+            return [self.keys, self.values, self.key_scales, self.value_scales]
+        return [self.keys, self.values]
+
+    def update(self, layer_idx: int, key: Tensor, value: Tensor):
+        """Append the new keys/values of `layer_idx` and return all of them."""
+        start = self.lengths[layer_idx]
+        end = start + key.shape[2]
+        if self.int8:
+            states = [*quantize_int8(key), *quantize_int8(value)]
+            states = [states[0], states[2], states[1], states[3]]
+        else:
+            states = [key, value]
+
+        buffers = self._buffers()
+        if self.max_len > 0:
+            assert end <= self.max_len, f"KVCache overflow: {end}"
+            for buffer, state in zip(buffers, states):
+                if buffer[layer_idx] is None:
+                    shape = state.shape[:2] + (self.max_len,) + state.shape[3:]
+                    buffer[layer_idx] = state.new_empty(shape)
+                buffer[layer_idx][:, :, start:end] = state
+            outputs = [buffer[layer_idx][:, :, :end] for buffer in buffers]
+        else:
+            for buffer, state in zip(buffers, states):
+                if buffer[layer_idx] is None:
+                    buffer[layer_idx] = state
+                else:
+                    buffer[layer_idx] = torch.concat(
+                        [buffer[layer_idx], state], dim=2
+                    )
+            outputs = [buffer[layer_idx] for buffer in buffers]
+        self.lengths[layer_idx] = end
+
+        if self.int8:
+            return (outputs[0], outputs[2]), (outputs[1], outputs[3])
+        return outputs[0], outputs[1]
+
+    def select(self, indices: Tensor) -> None:
+        """Keep only the sequences `indices` of the batch, e.g. to drop the
+        finished ones."""
+        for i in range(self.num_layers):
+            for buffer in self._buffers():
+                if buffer[i] is not None:
+                    buffer[i] = buffer[i].index_select(0, indices)
+            if self.memory_kv[i] is not None:
+                self.memory_kv[i] = tuple(
+                    t.index_select(0, indices) for t in self.memory_kv[i]
+                )
+
+    def truncate(self, length: int) -> None:
+        """Drop the keys/values after the first `length` positions, e.g. to
+        roll back the rejected tokens of speculative decoding."""
+        for i in range(self.num_layers):
+            if self.lengths[i] <= length:
+                continue
+            self.lengths[i] = length
+            if self.max_len == 0:
+                for buffer in self._buffers():
+                    buffer[i] = buffer[i][:, :, :length]
+
+    def drop(self, start: int, end: int) -> None:
+        """Drop the keys/values of the positions [start, end), the positions
+        after `end` move to `start`, e.g. to slide the attention window of the
+        AR Decoder over the generated tokens."""
+        num = end - start
+        for i in range(self.num_layers):
+            length = self.lengths[i]
+            assert 0 <= start <= end <= length, (start, end, length)
+            for buffer in self._buffers():
+                if self.max_len > 0:
+                    buffer[i][:, :, start : length - num] = buffer[i][
+                        :, :, end:length
+                    ].clone()
+                else:
+                    buffer[i] = torch.concat(
+                        [buffer[i][:, :, :start], buffer[i][:, :, end:]], dim=2
+                    )
+            self.lengths[i] = length - num
+
+
+class BlockPool:
+    """A fixed budget of key/value memory for the self-attention layers of a
+    decoder stack, split into blocks of `block_size` positions.
+
+    The keys and values of every layer are kept in one preallocated tensor of
+    shape (num_blocks, num_heads, block_size, head_dim), a block id addresses
+    the same positions in all layers.
+    """
+
+    def __init__(
+        self,
+        num_blocks: int,
+        num_layers: int,
+        num_heads: int,
+        head_dim: int,
+        block_size: int = 16,
+        dtype: torch.dtype = torch.float32,
+        device: Optional[torch.device] = None,
+    ) -> None:
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        shape = (num_blocks, num_heads, block_size, head_dim)
+        self.keys = [
+            torch.zeros(shape, dtype=dtype, device=device)
+            for _ in range(num_layers)
+        ]
+        self.values = [
+            torch.zeros(shape, dtype=dtype, device=device)
+            for _ in range(num_layers)
+        ]
+        self._free_blocks = list(range(num_blocks - 1, -1, -1))
+
+    @classmethod
+    def from_bytes(
+        cls,
+        max_bytes: int,
+        num_layers: int,
+        num_heads: int,
+        head_dim: int,
+        block_size: int = 16,
+        dtype: torch.dtype = torch.float32,
+        device: Optional[torch.device] = None,
+    ) -> "BlockPool":
+        """The pool with as many blocks as fit into `max_bytes`."""
+        element_size = torch.empty((), dtype=dtype).element_size()
+        block_bytes = (
+            2 * num_layers * num_heads * block_size * head_dim * element_size
+        )
+        return cls(
+            max_bytes // block_bytes,
+            num_layers,
+            num_heads,
+            head_dim,
+            block_size=block_size,
+            dtype=dtype,
+            device=device,
+        )
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self._free_blocks)
+
+    def num_blocks_for(self, length: int) -> int:
+        """The number of blocks holding `length` positions."""
+        return (length + self.block_size - 1) // self.block_size
+
+    def allocate(self, num_blocks: int) -> List[int]:
+        if num_blocks > len(self._free_blocks):
+            raise RuntimeError(
+                f"KV block pool exhausted: {num_blocks} blocks requested, "
+                f"{len(self._free_blocks)} free"
+            )
+        return [self._free_blocks.pop() for _ in range(num_blocks)]
+
+    def free(self, blocks: List[int]) -> None:
+        self._free_blocks.extend(reversed(blocks))
+
+
+class PagedKVCache:
+    """Key/value states of a batch of sequences stored in the blocks of a
+    BlockPool, each sequence has its own block table and length.
+
+    It is a drop-in replacement of KVCache for the self-attention layers:
+    update() returns the keys/values of shape (N, num_heads, S, head_dim), S
+    being the length of the longest sequence, the positions after the end of a
+    shorter sequence must be masked out with key_padding_mask().
+
+    MultiheadAttention.infer() calls append() and attend() instead, which read
+    the blocks in place rather than gathering them into dense tensors.
+    """
+
+    def __init__(self, pool: BlockPool, num_layers: int) -> None:
+        self.pool = pool
+        self.num_layers = num_layers
+        self.block_tables: List[List[int]] = []
+        self.seq_lens: List[int] = []
+        self.memory_kv: List[Optional[Tuple[Tensor, Tensor]]] = [
+            None
+        ] * num_layers
+        self._positions: Optional[Tuple[Tensor, Tensor]] = None
+        # the lengths of the sequences with the positions being appended
+        self._lens: Optional[Tensor] = None
+        self._gather_index: Optional[Tensor] = None
+        self._columns: Optional[List[Tuple[Tensor, Tensor]]] = None
+
+    def __len__(self) -> int:
+        return max(self.seq_lens, default=0)
+
+    @property
+    def batch_size(self) -> int:
+        return len(self.seq_lens)
+
+    def add_sequence(self) -> None:
+        """Append an empty sequence to the batch."""
+        self.block_tables.append([])
+        self.seq_lens.append(0)
+        self._gather_index = self._columns = None
+
+    def num_blocks_needed(self, num_new: int) -> int:
+        """The number of blocks to allocate to append `num_new` positions to
+        every sequence."""
+        return sum(
+            self.pool.num_blocks_for(n + num_new) - len(table)
+            for n, table in zip(self.seq_lens, self.block_tables)
+        )
+
+    def key_padding_mask(self, num_new: int = 0) -> Tensor:
+        """The (N, S) mask of the positions after the end of every sequence,
+        once `num_new` positions are appended."""
+        device = self.pool.keys[0].device
+        lens = torch.tensor(self.seq_lens, device=device) + num_new
+        positions = torch.arange(lens.max(), device=device)
+        return positions.unsqueeze(0) >= lens.unsqueeze(1)
+
+    def update(
+        self, layer_idx: int, key: Tensor, value: Tensor
+    ) -> Tuple[Tensor, Tensor]:
+        """Append the new keys/values (N, num_heads, L, head_dim) of
+        `layer_idx` and return all of them."""
+        self.append(layer_idx, key, value)
+        end = max(self.seq_lens) + (
+            key.shape[2] if layer_idx < self.num_layers - 1 else 0
+        )
+        return (
+            self._gather(self.pool.keys[layer_idx], end),
+            self._gather(self.pool.values[layer_idx], end),
+        )
+
+    def append(self, layer_idx: int, key: Tensor, value: Tensor) -> None:
+        """Append the new keys/values (N, num_heads, L, head_dim) of
+        `layer_idx`, see attend()."""
+        num_new = key.shape[2]
+        if layer_idx == 0:
+            self._prepare(num_new)
+        blocks, offsets = self._positions
+
+        # (N, L, num_heads, head_dim)
+        pool_keys, pool_values = self.pool.keys, self.pool.values
+        pool_keys[layer_idx][blocks, :, offsets] = key.transpose(1, 2)
+        pool_values[layer_idx][blocks, :, offsets] = value.transpose(1, 2)
+
+        if layer_idx == self.num_layers - 1:
+            self.seq_lens = [n + num_new for n in self.seq_lens]
+
+    def attend(
+        self, layer_idx: int, q: Tensor, attn_mask: Optional[Tensor] = None
+    ) -> Tensor:
+        """The attention of the (scaled) queries q over the keys/values of
+        `layer_idx`, the ones just appended included.
+
+        The blocks in use are read in place, one block per sequence at a time,
+        and the softmax is computed online, so no dense copy of the cache is
+        made at every step.
+
+        Args:
+          q:
+            The queries of shape (N, num_heads, L, head_dim), already scaled.
+          attn_mask:
+            A 2-D mask (L, S) or a 3-D mask (N * num_heads, L, S), S being the
+            length of the longest sequence, binary (True is masked) or float.
+            The positions after the end of every sequence are masked anyway.
+        Returns:
+          The attention outputs of shape (N, num_heads, L, head_dim).
+        """
+        batch_size, num_heads, tgt_len, _ = q.shape
+        block_size = self.pool.block_size
+        columns = self._block_columns()
+        if attn_mask is not None:
+            if attn_mask.dim() == 3:
+                attn_mask = attn_mask.view(batch_size, num_heads, tgt_len, -1)
+            if attn_mask.dtype == torch.bool:
+                attn_mask = torch.zeros(
+                    attn_mask.shape, dtype=q.dtype, device=q.device
+                ).masked_fill(attn_mask, float("-inf"))
+            # whole blocks
+            attn_mask = F.pad(
+                attn_mask,
+                (0, len(columns) * block_size - attn_mask.shape[-1]),
+                value=float("-inf"),
+            )
+
+        pool_keys = self.pool.keys[layer_idx]
+        pool_values = self.pool.values[layer_idx]
+        positions = torch.arange(block_size, device=q.device)
+        running_max = torch.full(
+            (batch_size, num_heads, tgt_len, 1),
+            float("-inf"),
+            dtype=q.dtype,
+            device=q.device,
+        )
+        denominator = torch.zeros_like(running_max)
+        output = torch.zeros_like(q)
+        for j, (rows, blocks) in enumerate(columns):
+            # (R, num_heads, L, block_size)
+            scores = torch.matmul(q[rows], pool_keys[blocks].transpose(-2, -1))
+            lens = self._lens[rows].unsqueeze(1)
+            padding = j * block_size + positions >= lens
+            scores = scores.masked_fill(
+                padding[:, None, None, :], float("-inf")
+            )
+            if attn_mask is not None:
+                mask = attn_mask[..., j * block_size : (j + 1) * block_size]
+                scores = scores + (mask if mask.dim() == 2 else mask[rows])
+
+            row_max = running_max[rows]
+            block_max = torch.maximum(
+                row_max, scores.amax(dim=-1, keepdim=True)
+            )
+            # the queries without a visible position so far
+            block_max = block_max.masked_fill(torch.isinf(block_max), 0.0)
+            weights = torch.exp(scores - block_max)
+            scale = torch.exp(row_max - block_max)
+            denominator[rows] = denominator[rows] * scale + weights.sum(
+                dim=-1, keepdim=True
+            )
+            output[rows] = output[rows] * scale + torch.matmul(
+                weights, pool_values[blocks]
+            )
+            running_max[rows] = block_max
+        return output / denominator
+
+    def select(self, indices: Tensor) -> None:
+        """Keep only the sequences `indices` of the batch and release the blocks
+        of the others."""
+        indices = indices.tolist()
+        assert len(set(indices)) == len(indices)
+        for i in set(range(self.batch_size)) - set(indices):
+            self.pool.free(self.block_tables[i])
+        self.block_tables = [self.block_tables[i] for i in indices]
+        self.seq_lens = [self.seq_lens[i] for i in indices]
+        self._gather_index = self._columns = None
+
+    def extend(self, other: "PagedKVCache") -> None:
+        """Move the sequences of `other` to the end of this batch, no key/value
+        is copied."""
+        assert other.pool is self.pool
+        self.block_tables.extend(other.block_tables)
+        self.seq_lens.extend(other.seq_lens)
+        other.block_tables, other.seq_lens = [], []
+        self._gather_index = self._columns = None
+
+    def free(self) -> None:
+        """Release the blocks of all the sequences."""
+        self.select(torch.zeros(0, dtype=torch.int64))
+
+    def _prepare(self, num_new: int) -> None:
+        device = self.pool.keys[0].device
+        for n, table in zip(self.seq_lens, self.block_tables):
+            num_blocks = self.pool.num_blocks_for(n + num_new) - len(table)
+            if num_blocks > 0:
+                table.extend(self.pool.allocate(num_blocks))
+                self._gather_index = self._columns = None
+
+        block_size = self.pool.block_size
+        self._lens = torch.tensor(self.seq_lens, device=device) + num_new
+        positions = torch.tensor(self.seq_lens, device=device).unsqueeze(
+            1
+        ) + torch.arange(num_new, device=device)
+        tables = self._block_table_tensor()
+        self._positions = (
+            tables.gather(1, positions // block_size),
+            positions % block_size,
+        )
+
+    def _block_table_tensor(self) -> Tensor:
+        if self._gather_index is None:
+            num_blocks = max(len(t) for t in self.block_tables)
+            # the padded entries point to block 0, they are masked out
+            self._gather_index = torch.tensor(
+                [t + [0] * (num_blocks - len(t)) for t in self.block_tables],
+                dtype=torch.int64,
+                device=self.pool.keys[0].device,
+            )
+        return self._gather_index
+
+    def _block_columns(self) -> List[Tuple[Tensor, Tensor]]:
+        # the j-th entry: the sequences with a j-th block and these blocks
+        if self._columns is None:
+            device = self.pool.keys[0].device
+            self._columns = []
+            for j in range(max(len(t) for t in self.block_tables)):
+                rows = [
+                    i for i, t in enumerate(self.block_tables) if len(t) > j
+                ]
+                self._columns.append(
+                    (
+                        torch.tensor(rows, dtype=torch.int64, device=device),
+                        torch.tensor(
+                            [self.block_tables[i][j] for i in rows],
+                            dtype=torch.int64,
+                            device=device,
+                        ),
+                    )
+                )
+        return self._columns
+
+    def _gather(self, pool: Tensor, end: int) -> Tensor:
+        tables = self._block_table_tensor()
+        # (N, num_blocks, num_heads, block_size, head_dim)
+        states = pool[tables]
+        batch_size, num_blocks, num_heads, block_size, head_dim = states.shape
+        states = states.transpose(1, 2).reshape(
+            batch_size, num_heads, num_blocks * block_size, head_dim
+        )
+        return states[:, :, :end]
@@ -0,0 +1,207 @@
+# Copyright    2023                             (authors: Feiteng Li)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+
+from .prompt_cache import PromptCache
+
+
+@dataclass
+class _NarRequest:
+    index: int
+    text: torch.Tensor  # (S,)
+    prompt: torch.Tensor  # (P, num_quantizers)
+    codes: torch.Tensor  # (T,)
+    enroll_x_len: int
+
+
+class NarBatchExecutor:
+    """Batch the Non-AR Decoders of independent requests.
+
+    The AR Decoder of every request runs on its own, e.g. with
+    `model.inference(..., ar_only=True)`, and its first quantizer codes are
+    submitted here. The Non-AR Decoders then run once per stage for a group of
+    requests, padded with key padding masks, instead of once per request.
+
+    Usage:
+        executor = NarBatchExecutor(model, max_batch_size=8)
+        for every request:
+            index = executor.submit(x, y, codes, enroll_x_lens)
+            for index, codes in executor.run().items():
+                # the (1, T, num_output_quantizers) codes of request `index`
+        for index, codes in executor.run(flush=True).items():
+            ...
+
+    Args:
+      model:
+        A VALLE or VALLF model.
+      max_batch_size:
+        The number of requests decoded together.
+      max_frames:
+        If > 0, a batch is also bounded by its number of padded audio frames
+        (prompt and codes), i.e. its activation memory.
+      prompt_cache:
+        Reuse the prompt embeddings when all the requests of a batch share the
+        same audio prompt.
+      num_output_quantizers:
+        The number of quantizers of the outputs, see VALLE.inference().
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        max_batch_size: int = 16,
+        max_frames: int = 0,
+        prompt_cache: Optional[PromptCache] = None,
+        num_output_quantizers: Optional[int] = None,
+    ) -> None:
+        assert max_batch_size >= 1
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_frames = max_frames
+        self.prompt_cache = prompt_cache
+        self.num_output_quantizers = num_output_quantizers
+
+        self.num_requests = 0
+        self.num_batches = 0
+        self._pending: List[_NarRequest] = []
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def submit(
+        self,
+        x: torch.Tensor,
+        y: torch.Tensor,
+        codes: torch.Tensor,
+        enroll_x_lens: Optional[torch.Tensor] = None,
+    ) -> int:
+        """
+        Args:
+          x:
+            The text tokens of the request, (1, S), as passed to inference().
+          y:
+            The audio prompt of the request, (1, P, num_quantizers).
+          codes:
+            The codes of the AR Decoder, (1, T) or (1, T, 1).
+          enroll_x_lens:
+            The number of tokens of the text prompt in `x`, (1,), required by
+            prefix_mode 2 and 4.
+        Returns:
+          The index of the request, the key of its codes in run().
+        """
+        assert x.ndim == 2 and x.shape[0] == 1, x.shape
+        assert y.ndim == 3 and y.shape[0] == 1, y.shape
+        if codes.ndim == 3:
+            codes = codes[..., 0]
+        assert codes.shape[0] == 1 and codes.shape[1] > 0, codes.shape
+
+        self._pending.append(
+            _NarRequest(
+                index=self.num_requests,
+                text=x[0],
+                prompt=y[0].type(torch.int64),
+                codes=codes[0],
+                enroll_x_len=0
+                if enroll_x_lens is None
+                else int(enroll_x_lens.max().item()),
+            )
+        )
+        self.num_requests += 1
+        return self.num_requests - 1
+
+    def run(self, flush: bool = False) -> Dict[int, torch.Tensor]:
+        """Decode the full batches of the pending requests, and the remaining
+        ones as well if `flush`.
+
+        Returns:
+          The codes (1, T, num_output_quantizers) of the decoded requests by
+          index.
+        """
+        results = {}
+        while self._pending:
+            batch = self._next_batch(flush)
+            if not batch:
+                break
+            results.update(self._decode(batch))
+        return results
+
+    def _next_batch(self, flush: bool) -> List[_NarRequest]:
+        # similar lengths are batched together to limit the padding
+        self._pending.sort(key=lambda r: len(r.prompt) + len(r.codes))
+        batch_size = 0
+        max_len = 0
+        for request in self._pending:
+            length = max(max_len, len(request.prompt) + len(request.codes))
+            if batch_size == self.max_batch_size or (
+                batch_size > 0
+                and self.max_frames > 0
+                and length * (batch_size + 1) > self.max_frames
+            ):
+                break
+            batch_size += 1
+            max_len = length
+
+        full = batch_size == self.max_batch_size or batch_size < len(
+            self._pending
+        )
+        if not (full or flush):
+            return []
+        batch = self._pending[:batch_size]
+        self._pending = self._pending[batch_size:]
+        return batch
+
+    def _decode(self, batch: List[_NarRequest]) -> Dict[int, torch.Tensor]:
+        device = batch[0].codes.device
+        x_lens = torch.tensor([len(r.text) for r in batch], device=device)
+        x = nn.utils.rnn.pad_sequence([r.text for r in batch], batch_first=True)
+        enroll_x_lens = torch.tensor(
+            [r.enroll_x_len for r in batch], device=device
+        )
+        code_lens = torch.tensor([len(r.codes) for r in batch], device=device)
+        codes = nn.utils.rnn.pad_sequence(
+            [r.codes for r in batch], batch_first=True
+        )
+
+        prompt = batch[0].prompt
+        if all(torch.equal(r.prompt, prompt) for r in batch[1:]):
+            # a single prompt, its embeddings are computed once
+            y = prompt.unsqueeze(0)
+            y_lens = torch.tensor([len(prompt)], device=device)
+        else:
+            y = nn.utils.rnn.pad_sequence(
+                [r.prompt for r in batch], batch_first=True
+            )
+            y_lens = torch.tensor([len(r.prompt) for r in batch], device=device)
+
+        outputs = self.model._nar_batch_decode(
+            x,
+            x_lens,
+            y,
+            y_lens,
+            codes,
+            code_lens,
+            enroll_x_lens,
+            prompt_cache=self.prompt_cache,
+            num_output_quantizers=self.num_output_quantizers,
+        )
+        self.num_batches += 1
+        return {
+            r.index: outputs[b : b + 1, : code_lens[b]]
+            for b, r in enumerate(batch)
+        }
@@ -0,0 +1,113 @@
+# Copyright    2023                             (authors: Feiteng Li)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+import torch
+
+
+def _nbytes(value: Any) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    return 0
+
+
+class PromptCache:
+    """LRU cache of the prompt-side work of a reference voice, e.g. the
+    tokenized text/audio prompt or the prompt embeddings of a model, shared
+    across requests.
+
+    The cache is bounded by the bytes of the tensors it holds, the least
+    recently used entries are evicted first.
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30) -> None:
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        """Hash strings, numbers and tensors (by value) into a cache key."""
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, torch.Tensor):
+                h.update(str((part.dtype, tuple(part.shape))).encode())
+                h.update(part.detach().cpu().contiguous().numpy().tobytes())
+            else:
+                h.update(repr(part).encode())
+            h.update(b"|")
+        return h.hexdigest()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[Any]:
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key: str, value: Any) -> None:
+        if key in self._entries:
+            self._remove(key)
+        size = _nbytes(value)
+        if size > self.max_bytes:
+            return
+        while self.num_bytes + size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        self._entries[key] = value
+        self._sizes[key] = size
+        self.num_bytes += size
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Any:
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._sizes.clear()
+        self.num_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+        }
+
+    def _remove(self, key: str) -> None:
+        del self._entries[key]
+        self.num_bytes -= self._sizes.pop(key)
@@ -0,0 +1,228 @@
+# Copyright    2023                             (authors: Feiteng Li)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List, Optional, Sequence, Union
+
+import torch
+from torch import Tensor
+
+# A value shared by all the rows of a batch, or a 1-D tensor of per-row values.
+Param = Union[int, float, Tensor]
+
+
+def _rows(
+    value: Tensor, logits: Tensor, rows: Optional[Tensor], dtype: torch.dtype
+) -> Tensor:
+    """The values of the rows `rows` of the batch, of shape (N, 1)."""
+    value = value.to(device=logits.device)
+    if rows is not None:
+        value = value[rows.to(logits.device)]
+    return value.to(dtype).unsqueeze(-1)
+
+
+class LogitsProcessor:
+    """Maps the logits (N, V) of the rows `rows` of a batch to new logits,
+    without modifying them in place. `rows` selects the per-row parameters,
+    e.g. after the finished sequences are dropped, None means all the rows.
+    """
+
+    def __call__(self, logits: Tensor, rows: Optional[Tensor] = None) -> Tensor:
+        raise NotImplementedError
+
+
+class Temperature(LogitsProcessor):
+    """Divide the logits by the temperature, temperature <= 0 is greedy
+    decoding and leaves the logits unchanged."""
+
+    def __init__(self, temperature: Param = 1.0) -> None:
+        self.temperature = temperature
+
+    def __call__(self, logits: Tensor, rows: Optional[Tensor] = None) -> Tensor:
+        if not isinstance(self.temperature, Tensor):
+            if self.temperature == 1.0 or self.temperature <= 0:
+                return logits
+            return logits / self.temperature
+        temperature = _rows(self.temperature, logits, rows, logits.dtype)
+        return logits / temperature.masked_fill(temperature <= 0, 1.0)
+
+
+class TopK(LogitsProcessor):
+    """Keep the `top_k` highest logits of every row, top_k <= 0 keeps all."""
+
+    def __init__(self, top_k: Param = 0) -> None:
+        self.top_k = top_k
+        if isinstance(top_k, Tensor):
+            self.max_top_k = int(top_k.max().item())
+
+    def __call__(self, logits: Tensor, rows: Optional[Tensor] = None) -> Tensor:
+        vocab_size = logits.shape[-1]
+        if not isinstance(self.top_k, Tensor):
+            if self.top_k <= 0 or self.top_k >= vocab_size:
+                return logits
+            threshold = torch.topk(logits, self.top_k).values[..., -1:]
+            return logits.masked_fill(logits < threshold, -float("Inf"))
+
+        max_top_k = min(self.max_top_k, vocab_size)
+        if max_top_k <= 0:
+            return logits
+        top_k = _rows(self.top_k, logits, rows, torch.int64)
+        values = torch.topk(logits, max_top_k).values
+        threshold = values.gather(-1, top_k.clamp(1, max_top_k) - 1)
+        threshold = threshold.masked_fill(
+            (top_k <= 0) | (top_k >= vocab_size), -float("Inf")
+        )
+        return logits.masked_fill(logits < threshold, -float("Inf"))
+
+
+class TopP(LogitsProcessor):
+    """Nucleus filtering: keep the highest logits of every row until their
+    probability mass reaches `top_p`, top_p >= 1 keeps all.
+
+    Instead of sorting the whole vocabulary, the nucleus is searched in the top
+    `num_candidates` logits, doubled until it covers `top_p` of every row.
+    """
+
+    def __init__(
+        self,
+        top_p: Param = 1.0,
+        num_candidates: int = 32,
+        min_tokens_to_keep: int = 1,
+    ) -> None:
+        self.top_p = top_p
+        self.num_candidates = num_candidates
+        self.min_tokens_to_keep = min_tokens_to_keep
+        if isinstance(top_p, Tensor):
+            self.min_top_p = float(top_p.min().item())
+        else:
+            self.min_top_p = top_p
+
+    def __call__(self, logits: Tensor, rows: Optional[Tensor] = None) -> Tensor:
+        if self.min_top_p >= 1.0:
+            return logits
+        if isinstance(self.top_p, Tensor):
+            top_p = _rows(self.top_p, logits, rows, torch.float32)
+        else:
+            top_p = torch.full(
+                (logits.shape[0], 1), self.top_p, device=logits.device
+            )
+
+        vocab_size = logits.shape[-1]
+        log_norm = torch.logsumexp(logits.float(), dim=-1, keepdim=True)
+        k = min(max(self.num_candidates, self.min_tokens_to_keep), vocab_size)
+        while True:
+            values = torch.topk(logits, k).values
+            probs = torch.exp(values.float() - log_norm)
+            cumulative_probs = torch.cumsum(probs, dim=-1)
+            if k == vocab_size or bool(
+                torch.all((cumulative_probs[:, -1:] > top_p) | (top_p >= 1.0))
+            ):
+                break
+            k = min(2 * k, vocab_size)
+
+        # keep the tokens whose preceding probability mass is <= top_p
+        num_keep = (cumulative_probs - probs <= top_p).sum(-1, keepdim=True)
+        num_keep = num_keep.clamp(min=self.min_tokens_to_keep)
+        threshold = values.gather(-1, num_keep - 1)
+        threshold = threshold.masked_fill(top_p >= 1.0, -float("Inf"))
+        return logits.masked_fill(logits < threshold, -float("Inf"))
+
+
+class Sampler:
+    """Samples the next tokens from the logits (N, V), every row with its own
+    temperature, top-k, top-p and random generator.
+
+    The parameters are python numbers shared by the batch or 1-D tensors of
+    the values of every row. top_k == 1 or temperature <= 0 is greedy decoding,
+    which takes the argmax directly.
+
+    Args:
+      top_k:
+        The number of highest probability tokens to keep, <= 0 keeps all.
+      top_p:
+        The cumulative probability of the highest probability tokens to keep.
+      temperature:
+        The value used to module the next token probabilities.
+      generators:
+        The random generators of the rows, on the device of the logits, e.g.
+        to make the sampling of a request reproducible. None uses the default
+        generator.
+    """
+
+    def __init__(
+        self,
+        top_k: Param = -100,
+        top_p: Param = 1.0,
+        temperature: Param = 1.0,
+        generators: Optional[Sequence[Optional[torch.Generator]]] = None,
+    ) -> None:
+        self.top_k = top_k
+        self.temperature = temperature
+        self.generators = generators
+        self.processors: List[LogitsProcessor] = [
+            Temperature(temperature),
+            TopK(top_k),
+            TopP(top_p),
+        ]
+
+    def greedy(
+        self, logits: Tensor, rows: Optional[Tensor] = None
+    ) -> Union[bool, Tensor]:
+        """Whether the rows are decoded greedily, a bool if it is the same for
+        all the rows, else a (N, 1) tensor."""
+        top_k, temperature = self.top_k, self.temperature
+        if not isinstance(top_k, Tensor) and top_k == 1:
+            return True
+        if not isinstance(temperature, Tensor) and temperature <= 0:
+            return True
+        greedy = False
+        if isinstance(top_k, Tensor):
+            greedy = _rows(top_k, logits, rows, torch.int64) == 1
+        if isinstance(temperature, Tensor):
+            greedy = greedy | (
+                _rows(temperature, logits, rows, torch.float32) <= 0
+            )
+        return greedy
+
+    def logits(self, logits: Tensor, rows: Optional[Tensor] = None) -> Tensor:
+        """The filtered logits the tokens are sampled from."""
+        for processor in self.processors:
+            logits = processor(logits, rows)
+        greedy = self.greedy(logits, rows)
+        if greedy is not False:
+            # a single token is left, like top_k == 1
+            non_max = logits < logits.max(dim=-1, keepdim=True).values
+            logits = logits.masked_fill(non_max & greedy, -float("Inf"))
+        return logits
+
+    def probs(self, logits: Tensor, rows: Optional[Tensor] = None) -> Tensor:
+        """The distribution the tokens are sampled from."""
+        return torch.softmax(self.logits(logits, rows), dim=-1)
+
+    def __call__(self, logits: Tensor, rows: Optional[Tensor] = None) -> Tensor:
+        """Returns the sampled tokens of shape (N, 1)."""
+        greedy = self.greedy(logits, rows)
+        if greedy is True:
+            return torch.argmax(logits, dim=-1, keepdim=True)
+
+        logits = self.logits(logits, rows).float()
+        # argmax(logits - log(E)), E ~ Exp(1), samples from softmax(logits)
+        noise = torch.empty_like(logits).exponential_()
+        if self.generators is not None:
+            indices = range(len(logits)) if rows is None else rows.tolist()
+            for i, b in enumerate(indices):
+                if self.generators[b] is not None:
+                    noise[i].exponential_(generator=self.generators[b])
+        noise = noise.clamp(min=torch.finfo(noise.dtype).tiny)
+        # the greedy rows have a single token left
+        return torch.argmax(logits - torch.log(noise), dim=-1, keepdim=True)
@@ -1,13 +1,14 @@
 import copy
 import numbers
 from functools import partial
-from typing import Any, Callable, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import torch
 from torch import Tensor, nn
 from torch.nn import functional as F
 
 from .activation import MultiheadAttention
+from .kv_cache import KVCache
 from .scaling import ActivationBalancer, BalancedDoubleSwish
 from .scaling import BasicNorm as _BasicNorm
 
@@ -89,23 +90,62 @@ class AdaptiveLayerNorm(nn.Module):
         self.norm = norm
         self.d_model = d_model
         self.eps = self.norm.eps
+        # embedding.data_ptr() -> (embedding._version, (weight, bias))
+        self._table: Dict[int, Tuple[int, Tuple[Tensor, Tensor]]] = {}
+        self._table_key = None
 
     def forward(self, input: Tensor, embedding: Tensor = None) -> Tensor:
         if isinstance(input, tuple):
             input, embedding = input
-            weight, bias = torch.split(
-                self.project_layer(embedding),
-                split_size_or_sections=self.d_model,
-                dim=-1,
-            )
+            weight, bias = self._weight_bias(embedding)
             return (weight * self.norm(input) + bias, embedding)
 
-        weight, bias = torch.split(
+        weight, bias = self._weight_bias(embedding)
+        return weight * self.norm(input) + bias
+
+    def freeze(self, embeddings: Sequence[Tensor]) -> None:
+        """Precompute the weight and bias of the constant `embeddings`, e.g. the
+        stage embeddings of the NAR Decoder, which forward() then looks up
+        instead of projecting them. The table is only used in eval mode, and an
+        entry is recomputed once the embedding or `project_layer` changes."""
+        key = self._project_key()
+        if key != self._table_key:
+            self._table, self._table_key = {}, key
+        with torch.no_grad():
+            for embedding in embeddings:
+                if self._lookup(embedding) is None:
+                    self._table[embedding.data_ptr()] = (
+                        embedding._version,
+                        self._project(embedding),
+                    )
+
+    def _project(self, embedding: Tensor) -> Tuple[Tensor, Tensor]:
+        return torch.split(
             self.project_layer(embedding),
             split_size_or_sections=self.d_model,
             dim=-1,
         )
-        return weight * self.norm(input) + bias
+
+    def _project_key(self) -> Tuple[Tuple[int, int], ...]:
+        return tuple(
+            (p.data_ptr(), p._version) for p in self.project_layer.parameters()
+        )
+
+    def _lookup(self, embedding: Tensor) -> Optional[Tuple[Tensor, Tensor]]:
+        entry = self._table.get(embedding.data_ptr())
+        if entry is None or entry[0] != embedding._version:
+            return None
+        return entry[1]
+
+    def _weight_bias(self, embedding: Tensor) -> Tuple[Tensor, Tensor]:
+        if self._table and not self.training:
+            if self._table_key == self._project_key():
+                weight_bias = self._lookup(embedding)
+                if weight_bias is not None:
+                    return weight_bias
+            else:
+                self._table = {}
+        return self._project(embedding)
 
 
 class BasicNorm(_BasicNorm):
@@ -311,6 +351,68 @@ class TransformerEncoderLayer(nn.Module):
             return (x, stage_embedding)
         return x
 
+    def infer(
+        self,
+        src: Tensor,
+        src_mask: Optional[Tensor] = None,
+        src_key_padding_mask: Optional[Tensor] = None,
+        cache: Optional[KVCache] = None,
+        layer_idx: int = 0,
+    ) -> Tensor:
+        r"""Pass the new positions through the encoder layer, attending over
+        the positions already stored in `cache`.
+
+        Args:
+            src: the new positions of the sequence (required).
+            src_mask: the mask for the src sequence (optional).
+            src_key_padding_mask: the mask for the src keys per batch (optional).
+            cache: the key/value cache, updated in place (optional).
+            layer_idx: the index of this layer in `cache`.
+        """
+        x, stage_embedding = src, None
+        is_src_tuple = False
+        if isinstance(src, tuple):
+            x, stage_embedding = src
+            is_src_tuple = True
+
+        if self.norm_first:
+            x = x + self._sa_block_infer(
+                self.norm1(x, stage_embedding),
+                src_mask,
+                src_key_padding_mask,
+                cache,
+                layer_idx,
+            )
+            x = x + self._ff_block(self.norm2(x, stage_embedding))
+        else:
+            x = self.norm1(
+                x
+                + self._sa_block_infer(
+                    x, src_mask, src_key_padding_mask, cache, layer_idx
+                ),
+                stage_embedding,
+            )
+            x = self.norm2(x + self._ff_block(x), stage_embedding)
+
+        if is_src_tuple:
+            return (x, stage_embedding)
+        return x
+
+    def fill_cache(
+        self, src: Tensor, cache: KVCache, layer_idx: int = 0
+    ) -> None:
+        r"""Append the keys/values of the new positions `src` to `cache`
+        without computing the output of the layer, e.g. for the layers skipped
+        by an early exit, which take the exiting hidden states as input.
+        """
+        x, stage_embedding = src, None
+        if isinstance(src, tuple):
+            x, stage_embedding = src
+        if self.norm_first:
+            x = self.norm1(x, stage_embedding)
+        k, v = self.self_attn.compute_kv(x)
+        cache.update(layer_idx, k, v)
+
     # self-attention block
     def _sa_block(
         self,
@@ -328,6 +430,24 @@ class TransformerEncoderLayer(nn.Module):
         )[0]
         return self.dropout1(x)
 
+    # cached self-attention block
+    def _sa_block_infer(
+        self,
+        x: Tensor,
+        attn_mask: Optional[Tensor],
+        key_padding_mask: Optional[Tensor],
+        cache: Optional[KVCache],
+        layer_idx: int,
+    ) -> Tensor:
+        x = self.self_attn.infer(
+            x,
+            attn_mask=attn_mask,
+            key_padding_mask=key_padding_mask,
+            cache=cache,
+            layer_idx=layer_idx,
+        )
+        return self.dropout1(x)
+
     # feed forward block
     def _ff_block(self, x: Tensor) -> Tensor:
         x = self.linear2(self.dropout(self.activation(self.linear1(x))))
@@ -405,6 +525,51 @@ class TransformerEncoder(nn.Module):
 
         return output
 
+    def infer(
+        self,
+        src: Tensor,
+        mask: Optional[Tensor] = None,
+        src_key_padding_mask: Optional[Tensor] = None,
+        cache: Optional[KVCache] = None,
+        early_exit: Optional[Callable[[int, Tensor], bool]] = None,
+    ) -> Tensor:
+        r"""Incremental version of forward(): only the new positions of the
+        sequence are passed in, the previous ones are read from `cache`.
+
+        Args:
+            src: the new positions of the sequence (required).
+            mask: the mask of the new positions over all (cached + new)
+                positions (optional).
+            src_key_padding_mask: the mask for all the src keys per batch (optional).
+            cache: the key/value cache of all layers, updated in place (optional).
+            early_exit: called with the index and the output of every layer, if it
+                returns True the remaining layers are skipped and the output of
+                that layer is returned (without `norm`), the keys/values of the
+                skipped layers are computed from it (optional, requires `cache`).
+        """
+        output = src
+        for i, mod in enumerate(self.layers):
+            output = mod.infer(
+                output,
+                src_mask=mask,
+                src_key_padding_mask=src_key_padding_mask,
+                cache=cache,
+                layer_idx=i,
+            )
+            if (
+                early_exit is not None
+                and i + 1 < self.num_layers
+                and early_exit(i, output)
+            ):
+                for j in range(i + 1, self.num_layers):
+                    self.layers[j].fill_cache(output, cache, layer_idx=j)
+                return output
+
+        if self.norm is not None:
+            output = self.norm(output)
+
+        return output
+
 
 class TransformerDecoderLayer(nn.Module):
     __constants__ = ["batch_first", "norm_first"]
@@ -510,6 +675,7 @@ class TransformerDecoderLayer(nn.Module):
         memory_mask: Optional[Tensor] = None,
         tgt_key_padding_mask: Optional[Tensor] = None,
         memory_key_padding_mask: Optional[Tensor] = None,
+        memory_kv: Optional[Tuple[Tensor, Tensor]] = None,
     ) -> Tensor:
         r"""Pass the inputs (and mask) through the decoder layer.
 
@@ -520,6 +686,8 @@ class TransformerDecoderLayer(nn.Module):
             memory_mask: the mask for the memory sequence (optional).
             tgt_key_padding_mask: the mask for the tgt keys per batch (optional).
             memory_key_padding_mask: the mask for the memory keys per batch (optional).
+            memory_kv: the key/value projections of `memory`, see
+                `MultiheadAttention.compute_kv()`, to reuse them across calls (optional).
 
         Shape:
             see the docs in Transformer class.
@@ -535,9 +703,10 @@ class TransformerDecoderLayer(nn.Module):
             x = x + self._sa_block(
                 self.norm1(x, stage_embedding), tgt_mask, tgt_key_padding_mask
             )
-            x = x + self._mha_block(
+            x = x + self._cross_attention_block(
                 self.norm2(x, stage_embedding),
                 memory,
+                memory_kv,
                 memory_mask,
                 memory_key_padding_mask,
             )
@@ -549,8 +718,8 @@ class TransformerDecoderLayer(nn.Module):
             )
             x = self.norm2(
                 x
-                + self._mha_block(
-                    x, memory, memory_mask, memory_key_padding_mask
+                + self._cross_attention_block(
+                    x, memory, memory_kv, memory_mask, memory_key_padding_mask
                 ),
                 stage_embedding,
             )
@@ -595,11 +764,244 @@ class TransformerDecoderLayer(nn.Module):
         )[0]
         return self.dropout2(x)
 
+    def _cross_attention_block(
+        self,
+        x: Tensor,
+        mem: Tensor,
+        memory_kv: Optional[Tuple[Tensor, Tensor]],
+        attn_mask: Optional[Tensor],
+        key_padding_mask: Optional[Tensor],
+    ) -> Tensor:
+        if memory_kv is None:
+            return self._mha_block(x, mem, attn_mask, key_padding_mask)
+        return self._mha_block_infer(x, memory_kv, attn_mask, key_padding_mask)
+
     # feed forward block
     def _ff_block(self, x: Tensor) -> Tensor:
         x = self.linear2(self.dropout(self.activation(self.linear1(x))))
         return self.dropout3(x)
 
+    def infer(
+        self,
+        tgt: Tensor,
+        memory: Tensor,
+        tgt_mask: Optional[Tensor] = None,
+        memory_mask: Optional[Tensor] = None,
+        tgt_key_padding_mask: Optional[Tensor] = None,
+        memory_key_padding_mask: Optional[Tensor] = None,
+        cache: Optional[KVCache] = None,
+        layer_idx: int = 0,
+    ) -> Tensor:
+        r"""Pass the new positions of tgt through the decoder layer.
+
+        The self-attention attends over the positions already stored in `cache`,
+        the key/value projections of `memory` are computed once and kept in
+        `cache.memory_kv`.
+
+        Args:
+            tgt: the new positions of the sequence to the decoder layer (required).
+            memory: the sequence from the last layer of the encoder (required).
+            tgt_mask: the mask for the tgt sequence (optional).
+            memory_mask: the mask for the memory sequence (optional).
+            tgt_key_padding_mask: the mask for the tgt keys per batch (optional).
+            memory_key_padding_mask: the mask for the memory keys per batch (optional).
+            cache: the key/value cache, updated in place (optional).
+            layer_idx: the index of this layer in `cache`.
+        """
+        tgt_is_tuple = False
+        if isinstance(tgt, tuple):
+            x, stage_embedding = tgt
+            tgt_is_tuple = True
+        else:
+            x, stage_embedding = tgt, None
+
+        memory_kv = None
+        if cache is not None:
+            memory_kv = cache.memory_kv[layer_idx]
+        if memory_kv is None:
+            memory_kv = self.multihead_attn.compute_kv(memory)
+            if cache is not None:
+                cache.memory_kv[layer_idx] = memory_kv
+
+        if self.norm_first:
+            x = x + self._sa_block_infer(
+                self.norm1(x, stage_embedding),
+                tgt_mask,
+                tgt_key_padding_mask,
+                cache,
+                layer_idx,
+            )
+            x = x + self._mha_block_infer(
+                self.norm2(x, stage_embedding),
+                memory_kv,
+                memory_mask,
+                memory_key_padding_mask,
+            )
+            x = x + self._ff_block(self.norm3(x, stage_embedding))
+        else:
+            x = self.norm1(
+                x
+                + self._sa_block_infer(
+                    x, tgt_mask, tgt_key_padding_mask, cache, layer_idx
+                ),
+                stage_embedding,
+            )
+            x = self.norm2(
+                x
+                + self._mha_block_infer(
+                    x, memory_kv, memory_mask, memory_key_padding_mask
+                ),
+                stage_embedding,
+            )
+            x = self.norm3(x + self._ff_block(x), stage_embedding)
+
+        if tgt_is_tuple:
+            return (x, stage_embedding)
+        return x
+
+    # cached self-attention block
+    def _sa_block_infer(
+        self,
+        x: Tensor,
+        attn_mask: Optional[Tensor],
+        key_padding_mask: Optional[Tensor],
+        cache: Optional[KVCache],
+        layer_idx: int,
+    ) -> Tensor:
+        x = self.self_attn.infer(
+            x,
+            attn_mask=attn_mask,
+            key_padding_mask=key_padding_mask,
+            cache=cache,
+            layer_idx=layer_idx,
+        )
+        return self.dropout1(x)
+
+    # multihead attention block over precomputed memory keys/values
+    def _mha_block_infer(
+        self,
+        x: Tensor,
+        memory_kv: Tuple[Tensor, Tensor],
+        attn_mask: Optional[Tensor],
+        key_padding_mask: Optional[Tensor],
+    ) -> Tensor:
+        x = self.multihead_attn.infer(
+            x,
+            attn_mask=attn_mask,
+            key_padding_mask=key_padding_mask,
+            memory_kv=memory_kv,
+        )
+        return self.dropout2(x)
+
+
+class TransformerDecoder(nn.Module):
+    r"""TransformerDecoder is a stack of N decoder layers.
+
+    It's a drop-in replacement of torch.nn.TransformerDecoder (same parameter names)
+    which additionally supports incremental decoding with a key/value cache.
+
+    Args:
+        decoder_layer: an instance of the TransformerDecoderLayer() class (required).
+        num_layers: the number of sub-decoder-layers in the decoder (required).
+        norm: the layer normalization component (optional).
+    """
+    __constants__ = ["norm"]
+
+    def __init__(self, decoder_layer, num_layers, norm=None):
+        super(TransformerDecoder, self).__init__()
+        self.layers = _get_clones(decoder_layer, num_layers)
+        self.num_layers = num_layers
+        self.norm = norm
+
+    def forward(
+        self,
+        tgt: Tensor,
+        memory: Tensor,
+        tgt_mask: Optional[Tensor] = None,
+        memory_mask: Optional[Tensor] = None,
+        tgt_key_padding_mask: Optional[Tensor] = None,
+        memory_key_padding_mask: Optional[Tensor] = None,
+        memory_kv: Optional[List[Tuple[Tensor, Tensor]]] = None,
+    ) -> Tensor:
+        r"""Pass the inputs (and mask) through the decoder layers in turn.
+
+        Args:
+            tgt: the sequence to the decoder (required).
+            memory: the sequence from the last layer of the encoder (required).
+            tgt_mask: the mask for the tgt sequence (optional).
+            memory_mask: the mask for the memory sequence (optional).
+            tgt_key_padding_mask: the mask for the tgt keys per batch (optional).
+            memory_key_padding_mask: the mask for the memory keys per batch (optional).
+            memory_kv: the key/value projections of `memory` of every layer, see
+                compute_memory_kv(), e.g. to run several decoding passes over the
+                same memory (optional).
+
+        Shape:
+            see the docs in Transformer class.
+        """
+        output = tgt
+        for i, mod in enumerate(self.layers):
+            output = mod(
+                output,
+                memory,
+                tgt_mask=tgt_mask,
+                memory_mask=memory_mask,
+                tgt_key_padding_mask=tgt_key_padding_mask,
+                memory_key_padding_mask=memory_key_padding_mask,
+                memory_kv=None if memory_kv is None else memory_kv[i],
+            )
+
+        if self.norm is not None:
+            output = self.norm(output)
+
+        return output
+
+    def compute_memory_kv(self, memory: Tensor) -> List[Tuple[Tensor, Tensor]]:
+        r"""The key/value projections of `memory` of the cross-attention of every
+        layer, which forward() takes as `memory_kv`."""
+        return [mod.multihead_attn.compute_kv(memory) for mod in self.layers]
+
+    def infer(
+        self,
+        tgt: Tensor,
+        memory: Tensor,
+        tgt_mask: Optional[Tensor] = None,
+        memory_mask: Optional[Tensor] = None,
+        tgt_key_padding_mask: Optional[Tensor] = None,
+        memory_key_padding_mask: Optional[Tensor] = None,
+        cache: Optional[KVCache] = None,
+    ) -> Tensor:
+        r"""Incremental version of forward(): only the new positions of tgt are
+        passed in, the previous ones and the memory projections are read from `cache`.
+
+        Args:
+            tgt: the new positions of the sequence to the decoder (required).
+            memory: the sequence from the last layer of the encoder (required).
+            tgt_mask: the mask of the new positions over all (cached + new)
+                positions (optional).
+            memory_mask: the mask for the memory sequence (optional).
+            tgt_key_padding_mask: the mask for all the tgt keys per batch (optional).
+            memory_key_padding_mask: the mask for the memory keys per batch (optional).
+            cache: the key/value cache of all layers, updated in place (optional).
+        """
+        output = tgt
+        for i, mod in enumerate(self.layers):
+            output = mod.infer(
+                output,
+                memory,
+                tgt_mask=tgt_mask,
+                memory_mask=memory_mask,
+                tgt_key_padding_mask=tgt_key_padding_mask,
+                memory_key_padding_mask=memory_key_padding_mask,
+                cache=cache,
+                layer_idx=i,
+            )
+
+        if self.norm is not None:
+            output = self.norm(output)
+
+        return output
+
 
 def _get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
@@ -21,7 +21,19 @@ from icefall.utils import AttributeDict
 from torchmetrics.classification import MulticlassAccuracy
 
 from valle.data.input_strategies import PromptedFeatures
-from valle.models import NUM_MEL_BINS, get_model
+from valle.models import NUM_MEL_BINS, get_model, quantize_dynamic
+from valle.modules.embedding import MultiTokenEmbedding, TokenEmbedding
+from valle.modules.guard import LengthBudget, RunawayGuard
+from valle.modules.kv_cache import (
+    BlockPool,
+    KVCache,
+    PagedKVCache,
+    dequantize_int8,
+    quantize_int8,
+)
+from valle.modules.nar_executor import NarBatchExecutor
+from valle.modules.prompt_cache import PromptCache
+from valle.modules.sampling import Sampler
 
 
 class TestModel(unittest.TestCase):
@@ -88,6 +100,92 @@ class TestModel(unittest.TestCase):
                 params.prepend_bos = not params.prepend_bos
                 params.num_quantizers += 1
 
+    def test_nar_memory_kv(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        params.add_prenet = False
+        params.model_name = "VALL-F"
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.prepend_bos = False
+        params.num_quantizers = 8
+        params.prefix_mode = 1
+
+        x = torch.randn(2, 8, 64)
+        x_mask = torch.zeros(2, 8, dtype=torch.bool)
+        x_mask[0, 6:] = True
+        y = torch.randn(2, 16, 64)
+
+        for device in self.devices:
+            for norm_first in [True, False]:
+                params.norm_first = norm_first
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                memory_kv = model.nar_decoder.compute_memory_kv(x.to(device))
+                assert len(memory_kv) == 4
+                for stage in range(1, 8):
+                    stage_embedding = model.nar_stage_embeddings[stage - 1]
+                    outputs = [
+                        model.nar_decoder(
+                            (y.to(device), stage_embedding.weight),
+                            x.to(device),
+                            memory_key_padding_mask=x_mask.to(device),
+                            memory_kv=kv,
+                        )[0]
+                        for kv in [None, memory_kv]
+                    ]
+                    assert torch.allclose(outputs[0], outputs[1], atol=1e-5)
+
+    def test_nar_stage_tables(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        params.add_prenet = False
+        params.model_name = "VALL-E"
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.prefix_mode = 1
+        params.prepend_bos = False
+
+        xy = torch.randn(1, 24, 64)
+        for device in self.devices:
+            for norm_first in [True, False]:
+                params.norm_first = norm_first
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                def nar_outputs():
+                    return [
+                        model.nar_decoder(
+                            (xy.to(device), stage_embedding.weight)
+                        )[0]
+                        for stage_embedding in model.nar_stage_embeddings
+                    ]
+
+                with torch.no_grad():
+                    expected = nar_outputs()
+                    model.freeze_nar_stages()
+                    for a, b in zip(expected, nar_outputs()):
+                        assert torch.allclose(a, b, atol=1e-6)
+
+                    # the stale entries are not used
+                    norm = model.nar_decoder.layers[0].norm1
+                    norm.project_layer.bias.add_(1.0)
+                    model.nar_stage_embeddings[0].weight.add_(1.0)
+                    expected = nar_outputs()
+                    model.freeze_nar_stages()
+                    for a, b in zip(expected, nar_outputs()):
+                        assert torch.allclose(a, b, atol=1e-6)
+
     def test_valle(self):
         params = AttributeDict()
         params.decoder_dim = 64
@@ -182,6 +280,1084 @@ class TestModel(unittest.TestCase):
                         x[-1:], x_lens[-1:], y[-1:], enroll_x_lens=enroll_x_lens
                     )
 
+    def test_kv_cache(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[1, 8]))
+        x_lens = torch.from_numpy(np.array([8]))
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[1, 16, 8]))
+
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.prefix_mode = 1
+
+        for device in self.devices:
+            for model_name, norm_first, prepend_bos in [
+                ("VALL-E", True, False),
+                ("VALL-E", False, True),
+                ("VALL-F", True, True),
+                ("VALL-F", False, False),
+            ]:
+                params.model_name = model_name
+                params.norm_first = norm_first
+                params.prepend_bos = prepend_bos
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                # top_k=1 is greedy decoding
+                codes = [
+                    model.inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y.to(device),
+                        enroll_x_lens=enroll_x_lens,
+                        top_k=1,
+                        use_kv_cache=use_kv_cache,
+                    )
+                    for use_kv_cache in [False, True]
+                ]
+                assert torch.equal(codes[0], codes[1])
+
+                codes = model.inference(
+                    x.to(device),
+                    x_lens.to(device),
+                    y.to(device),
+                    enroll_x_lens=enroll_x_lens,
+                    top_k=1,
+                    use_kv_cache=True,
+                    int8_kv_cache=True,
+                )
+                assert codes.ndim == 3 and codes.shape[2] == 8
+
+        # int8 keys/values with a scale per head and position
+        states = torch.randn(2, 16, 8, 4)
+        q, scale = quantize_int8(states)
+        assert q.dtype == torch.int8 and scale.shape == (2, 16, 8, 1)
+        error = (dequantize_int8(q, scale, torch.float32) - states).abs()
+        assert torch.all(error <= scale / 2 + 1e-6)
+
+    def test_attention_window(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[1, 8]))
+        x_lens = torch.from_numpy(np.array([8]))
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[1, 16, 8]))
+
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.prefix_mode = 1
+        params.model_name = "VALL-E"
+        params.ar_attention_window = 4
+
+        for device in self.devices:
+            for norm_first, prepend_bos in [(True, False), (False, True)]:
+                params.norm_first = norm_first
+                params.prepend_bos = prepend_bos
+                model = get_model(params)
+                model.to(device)
+
+                # trained with the band attention mask
+                _, loss, _ = model(
+                    x.to(device),
+                    x_lens.to(device),
+                    y.to(device),
+                    torch.from_numpy(np.array([16])).to(device),
+                    train_stage=1,
+                )
+                assert torch.isfinite(loss)
+
+                model.eval()
+                # the sliding cache matches the band attention mask
+                codes = [
+                    model.inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y.to(device),
+                        enroll_x_lens=enroll_x_lens,
+                        top_k=1,
+                        use_kv_cache=use_kv_cache,
+                        attention_window=3,
+                    )
+                    for use_kv_cache in [False, True]
+                ]
+                assert torch.equal(codes[0], codes[1])
+
+                # no silent fallback to full attention
+                with self.assertRaises(AssertionError):
+                    model.inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y.to(device),
+                        enroll_x_lens=enroll_x_lens,
+                        num_candidates=2,
+                    )
+                with self.assertRaises(AssertionError):
+                    model.batch_inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y.to(device),
+                        torch.from_numpy(np.array([16])).to(device),
+                    )
+
+                # the streaming AR Decoder slides over the trained window
+                codes = model.inference(
+                    x.to(device),
+                    x_lens.to(device),
+                    y.to(device),
+                    enroll_x_lens=enroll_x_lens,
+                    top_k=1,
+                    use_kv_cache=True,
+                )
+                stream_codes = torch.concat(
+                    list(
+                        model.inference_stream(
+                            x.to(device),
+                            x_lens.to(device),
+                            y.to(device),
+                            enroll_x_lens=enroll_x_lens,
+                            top_k=1,
+                            chunk_size=4,
+                        )
+                    ),
+                    dim=1,
+                )
+                assert torch.equal(stream_codes[..., 0], codes[..., 0])
+
+        cache = KVCache(1, max_len=8)
+        states = torch.arange(6.0).view(1, 1, 6, 1)
+        cache.update(0, states, states)
+        cache.drop(2, 4)
+        assert len(cache) == 4
+        assert cache.keys[0][0, 0, :4, 0].tolist() == [0.0, 1.0, 4.0, 5.0]
+
+    def test_runaway_guard(self):
+        guard = RunawayGuard(max_ngram_repeats=4, max_silence_frames=10)
+        guard.start(10)
+        assert guard.update(list(range(8)) + [7, 7, 7]) is None
+        # ABC looping, keep the first ABC
+        assert guard.update([1, 2, 3] * 4) == ("ngram", 14)
+        guard.start(10)
+        assert guard.update([1, 2, 3] + [0] * 12) == ("silence", 4)
+        guard = RunawayGuard(LengthBudget(2.0, margin=1), policy="retry")
+        assert guard.start(3) == 7
+        assert guard.update(list(range(8))) == ("length", 7)
+        assert guard.retry()
+        assert guard.stats()["runaway_length"] == 1
+
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[1, 8]))
+        x_lens = torch.from_numpy(np.array([8]))
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[1, 16, 8]))
+
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.prefix_mode = 1
+        params.norm_first = True
+        params.prepend_bos = True
+
+        for device in self.devices:
+            for model_name in ["VALL-E", "VALL-F"]:
+                params.model_name = model_name
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                # 6 text tokens to synthesize, at most 6 frames
+                guard = RunawayGuard(
+                    LengthBudget(1.0, margin=0), policy="retry", max_retries=1
+                )
+                for use_kv_cache in [False, True]:
+                    codes = model.inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y.to(device),
+                        enroll_x_lens=enroll_x_lens,
+                        top_k=-1,
+                        use_kv_cache=use_kv_cache,
+                        guard=guard,
+                    )
+                    assert codes.shape[1] <= 6
+                assert guard.stats()["utterances"] == 2
+
+    def test_sampler(self):
+        logits = torch.tensor(
+            [
+                [1.0, 3.0, 2.0, 0.0],
+                [0.0, 1.0, 2.0, 4.0],
+                [2.0, 2.5, 0.5, 3.0],
+            ]
+        )
+        # per-row parameters, the first row is greedy
+        sampler = Sampler(
+            top_k=torch.tensor([1, 2, -100]),
+            top_p=torch.tensor([1.0, 1.0, 0.5]),
+        )
+        probs = sampler.probs(logits)
+        assert (probs[0] > 0).tolist() == [False, True, False, False]
+        assert (probs[1] > 0).tolist() == [False, False, True, True]
+        # the nucleus of 0.5: 3.0 alone has less, with 2.5 it has more
+        assert (probs[2] > 0).tolist() == [False, True, False, True]
+        assert torch.allclose(probs.sum(-1), torch.ones(3))
+        assert torch.equal(logits[0], torch.tensor([1.0, 3.0, 2.0, 0.0]))
+
+        # the finished rows are dropped, the parameters follow the rows
+        rows = torch.tensor([1, 2])
+        assert torch.allclose(sampler.probs(logits[1:], rows), probs[1:])
+        for _ in range(10):
+            tokens = sampler(logits)
+            assert tokens[0, 0] == 1 and tokens[1, 0] in [2, 3]
+
+        # seeded per-request generators are reproducible
+        samples = []
+        for _ in range(2):
+            generators = [torch.Generator().manual_seed(b) for b in range(3)]
+            sampler = Sampler(top_k=-100, generators=generators)
+            samples.append(
+                torch.concat([sampler(logits) for _ in range(8)], dim=1)
+            )
+        assert torch.equal(samples[0], samples[1])
+
+    def test_early_exit(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[1, 8]))
+        x_lens = torch.from_numpy(np.array([8]))
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[1, 16, 8]))
+
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.prefix_mode = 1
+        params.model_name = "VALL-E"
+        params.ar_exit_layers = "2"
+
+        for device in self.devices:
+            for norm_first, prepend_bos in [(True, False), (False, True)]:
+                params.norm_first = norm_first
+                params.prepend_bos = prepend_bos
+                model = get_model(params)
+                model.to(device)
+
+                _, loss, _ = model(
+                    x.to(device),
+                    x_lens.to(device),
+                    y.to(device),
+                    torch.from_numpy(np.array([16])).to(device),
+                    train_stage=1,
+                )
+                assert torch.isfinite(loss)
+
+                model.eval()
+                codes = [
+                    model.inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y.to(device),
+                        enroll_x_lens=enroll_x_lens,
+                        top_k=1,
+                        use_kv_cache=True,
+                        early_exit_threshold=threshold,
+                    )
+                    for threshold in [0.0, 1.1]
+                ]
+                # never confident enough, all the layers are used
+                assert torch.equal(codes[0], codes[1])
+                stats = model.early_exit_stats
+                assert stats["layers"] == 4 * stats["frames"]
+
+                # always confident, every frame exits after 2 layers
+                model.early_exit_stats = {"frames": 0, "layers": 0}
+                model.inference(
+                    x.to(device),
+                    x_lens.to(device),
+                    y.to(device),
+                    enroll_x_lens=enroll_x_lens,
+                    top_k=1,
+                    early_exit_threshold=1e-6,
+                )
+                stats = model.early_exit_stats
+                assert stats["layers"] == 2 * stats["frames"]
+
+    def test_inference_stream(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[1, 8]))
+        x_lens = torch.from_numpy(np.array([8]))
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[1, 16, 8]))
+
+        params.model_name = "VALL-E"
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+
+        for device in self.devices:
+            for norm_first, prefix_mode, prepend_bos in [
+                (True, 1, False),
+                (False, 2, True),
+            ]:
+                params.norm_first = norm_first
+                params.prefix_mode = prefix_mode
+                params.prepend_bos = prepend_bos
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                codes = model.inference(
+                    x.to(device),
+                    x_lens.to(device),
+                    y.to(device),
+                    enroll_x_lens=enroll_x_lens,
+                    top_k=1,
+                    use_kv_cache=True,
+                )
+
+                for chunk_size in [4, codes.shape[1]]:
+                    chunks = list(
+                        model.inference_stream(
+                            x.to(device),
+                            x_lens.to(device),
+                            y.to(device),
+                            enroll_x_lens=enroll_x_lens,
+                            top_k=1,
+                            chunk_size=chunk_size,
+                            left_context=4,
+                        )
+                    )
+                    assert all(c.shape[1] <= chunk_size for c in chunks)
+                    stream_codes = torch.concat(chunks, dim=1)
+                    assert stream_codes.shape == codes.shape
+                    # the AR Decoder is not chunked
+                    assert torch.equal(stream_codes[..., 0], codes[..., 0])
+                    if chunk_size == codes.shape[1]:
+                        # a single chunk sees the whole output
+                        assert torch.equal(stream_codes, codes)
+
+    def test_nar_window(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[1, 8]))
+        x_lens = torch.from_numpy(np.array([8]))
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[1, 16, 8]))
+        codes = torch.from_numpy(np.random.randint(0, 1000, size=[1, 50]))
+
+        params.model_name = "VALL-E"
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+
+        for device in self.devices:
+            for norm_first, prefix_mode, prepend_bos in [
+                (True, 0, False),
+                (False, 1, True),
+                (True, 2, False),
+            ]:
+                params.norm_first = norm_first
+                params.prefix_mode = prefix_mode
+                params.prepend_bos = prepend_bos
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                nar_x, prompt_pos = model._nar_inputs(
+                    x.to(device), y.to(device), enroll_x_lens
+                )
+                full = model._nar_windowed(
+                    nar_x, y.to(device), prompt_pos, codes.to(device), 0, 0
+                )
+                assert full.shape == (1, 50, 7)
+                for window_size, context in [(50, 0), (20, 50)]:
+                    # the windows and their context cover all the frames
+                    windowed = model._nar_windowed(
+                        nar_x,
+                        y.to(device),
+                        prompt_pos,
+                        codes.to(device),
+                        window_size,
+                        context,
+                    )
+                    assert torch.equal(windowed, full)
+                windowed = model._nar_windowed(
+                    nar_x, y.to(device), prompt_pos, codes.to(device), 16, 4
+                )
+                assert windowed.shape == full.shape
+
+                for nar_window_size in [0, 8]:
+                    codes_ = model.inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y.to(device),
+                        enroll_x_lens=enroll_x_lens,
+                        top_k=1,
+                        nar_window_size=nar_window_size,
+                        nar_window_context=4,
+                    )
+                    assert codes_.shape[-1] == 8
+
+    def test_speculative_decoding(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[1, 8]))
+        x_lens = torch.from_numpy(np.array([8]))
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[1, 16, 8]))
+
+        params.model_name = "VALL-E"
+        params.norm_first = True
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.prefix_mode = 1
+
+        draft_params = AttributeDict(params)
+        draft_params.decoder_dim = 32
+        draft_params.nhead = 4
+        draft_params.num_decoder_layers = 2
+
+        for device in self.devices:
+            for prepend_bos in [False, True]:
+                params.prepend_bos = prepend_bos
+                draft_params.prepend_bos = prepend_bos
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+                draft_model = get_model(draft_params)
+                draft_model.to(device)
+                draft_model.eval()
+
+                # top_k=1 is greedy decoding, speculative decoding must not
+                # change the result
+                codes = [
+                    model.inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y.to(device),
+                        enroll_x_lens=enroll_x_lens,
+                        top_k=1,
+                        use_kv_cache=True,
+                        **kwargs,
+                    )
+                    for kwargs in [
+                        {},
+                        dict(draft_model=draft_model, num_draft_tokens=3),
+                    ]
+                ]
+                assert torch.equal(codes[0], codes[1])
+
+    def test_mtp_heads(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[4, 8]))
+        x_lens = torch.from_numpy(np.random.randint(4, 8, size=[4]))
+        x_lens[-1] = 8
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[4, 16, 8]))
+        y_lens = torch.from_numpy(np.random.randint(8, 16, size=[4]))
+        y_lens[-1] = 16
+
+        params.model_name = "VALL-E"
+        params.norm_first = True
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.prefix_mode = 1
+        params.num_mtp_heads = 3
+
+        for device in self.devices:
+            for prepend_bos in [False, True]:
+                params.prepend_bos = prepend_bos
+                model = get_model(params)
+                model.to(device)
+
+                # Training
+                codes, loss, metrics = model(
+                    x.to(device),
+                    x_lens.to(device),
+                    y.to(device),
+                    y_lens.to(device),
+                    train_stage=1,
+                )
+                loss.backward()
+                for mtp_layer in model.ar_mtp_layers:
+                    assert mtp_layer[0].weight.grad is not None
+
+                # Inference, top_k=1 is greedy decoding and the heads must not
+                # change the result
+                model.eval()
+                codes = [
+                    model.inference(
+                        x[-1:].to(device),
+                        x_lens[-1:].to(device),
+                        y[-1:].to(device),
+                        enroll_x_lens=enroll_x_lens,
+                        top_k=1,
+                        use_kv_cache=True,
+                        use_mtp_heads=use_mtp_heads,
+                    )
+                    for use_mtp_heads in [False, True]
+                ]
+                assert torch.equal(codes[0], codes[1])
+
+    def test_best_of_n(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[1, 8]))
+        x_lens = torch.from_numpy(np.array([8]))
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[1, 16, 8]))
+
+        params.model_name = "VALL-E"
+        params.norm_first = True
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.prefix_mode = 1
+
+        for device in self.devices:
+            for prepend_bos in [False, True]:
+                params.prepend_bos = prepend_bos
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                # top_k=1 is greedy decoding, all the candidates are the same
+                codes = [
+                    model.inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y.to(device),
+                        enroll_x_lens=enroll_x_lens,
+                        top_k=1,
+                        use_kv_cache=True,
+                        num_candidates=num_candidates,
+                    )
+                    for num_candidates in [1, 4]
+                ]
+                assert torch.equal(codes[0], codes[1])
+
+                codes = model.inference(
+                    x.to(device),
+                    x_lens.to(device),
+                    y.to(device),
+                    enroll_x_lens=enroll_x_lens,
+                    num_candidates=4,
+                )
+                assert codes.shape[0] == 1 and codes.shape[2] == 8
+
+    def test_prompt_cache(self):
+        cache = PromptCache(max_bytes=3 * 4 * 16)
+        for k in range(4):
+            cache.put(PromptCache.key("voice", k), torch.zeros(16))
+        assert len(cache) == 3 and cache.evictions == 1
+        assert cache.get(PromptCache.key("voice", 0)) is None
+        assert cache.get(PromptCache.key("voice", 1)) is not None
+        cache.put(PromptCache.key("voice", 4), torch.zeros(16))
+        # the least recently used one is evicted
+        assert PromptCache.key("voice", 1) in cache
+        assert PromptCache.key("voice", 2) not in cache
+
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[1, 8]))
+        x_lens = torch.from_numpy(np.array([8]))
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[1, 16, 8]))
+
+        params.norm_first = True
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.prefix_mode = 1
+        params.prepend_bos = False
+
+        for device in self.devices:
+            for model_name, add_prenet in [("VALL-E", False), ("VALL-F", True)]:
+                params.model_name = model_name
+                params.add_prenet = add_prenet
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                cache = PromptCache()
+                codes = [
+                    model.inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y.to(device),
+                        enroll_x_lens=enroll_x_lens,
+                        top_k=1,
+                        prompt_cache=prompt_cache,
+                    )
+                    for prompt_cache in [None, cache, cache]
+                ]
+                assert torch.equal(codes[0], codes[1])
+                assert torch.equal(codes[0], codes[2])
+                assert cache.hits == 1 and cache.misses == 1
+
+                if model_name == "VALL-E":
+                    codes = [
+                        model.continual(
+                            x.to(device),
+                            x_lens.to(device),
+                            y.to(device),
+                            prompt_cache=prompt_cache,
+                        )
+                        for prompt_cache in [None, cache, cache]
+                    ]
+                    assert torch.equal(codes[0], codes[1])
+                    assert torch.equal(codes[0], codes[2])
+                    assert cache.hits == 2 and cache.misses == 2
+
+                # the keys change with the model and its weights
+                def key(model):
+                    return model._prompt_cache_key(
+                        "nar_prompt_embedding",
+                        [model.nar_audio_embeddings],
+                        y.to(device),
+                    )
+
+                keys = [key(model)]
+                assert key(model) == keys[0]
+                model.load_state_dict(model.state_dict())
+                keys.append(key(model))
+                with torch.no_grad():
+                    model.nar_audio_embeddings[1].weight.add_(1.0)
+                keys.append(key(model))
+                model.to(device)
+                keys.append(key(model))
+                keys.append(key(get_model(params).to(device).eval()))
+                assert len(set(keys)) == len(keys)
+
+    def test_batch_inference(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[3, 8]))
+        x_lens = torch.from_numpy(np.array([8, 5, 6]))
+        enroll_x_lens = torch.from_numpy(np.array([2, 3, 2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[3, 16, 8]))
+        y_lens = torch.from_numpy(np.array([16, 9, 12]))
+
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+
+        for device in self.devices:
+            for model_name, prefix_mode, prepend_bos in [
+                ("VALL-E", 1, False),
+                ("VALL-E", 2, True),
+                ("VALL-F", 0, True),
+                ("VALL-F", 2, False),
+            ]:
+                params.model_name = model_name
+                params.prefix_mode = prefix_mode
+                params.norm_first = True
+                params.prepend_bos = prepend_bos
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                # one prompt per text, or a prompt shared by all the texts
+                for num_prompts in [x.shape[0], 1]:
+                    codes, code_lens = model.batch_inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y[:num_prompts].to(device),
+                        y_lens[:num_prompts].to(device),
+                        enroll_x_lens=enroll_x_lens,
+                        top_k=1,
+                    )
+                    for b in range(x.shape[0]):
+                        p = b if num_prompts > 1 else 0
+                        expected = model.inference(
+                            x[b : b + 1, : x_lens[b]].to(device),
+                            x_lens[b : b + 1].to(device),
+                            y[p : p + 1, : y_lens[p]].to(device),
+                            enroll_x_lens=enroll_x_lens[b : b + 1],
+                            top_k=1,
+                            use_kv_cache=True,
+                        )
+                        assert code_lens[b] == expected.shape[1]
+                        assert torch.equal(
+                            codes[b : b + 1, : code_lens[b]], expected
+                        )
+
+    def test_num_output_quantizers(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[1, 8]))
+        x_lens = torch.from_numpy(np.array([8]))
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[1, 16, 8]))
+
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.norm_first = True
+        params.prepend_bos = False
+
+        for device in self.devices:
+            for model_name, prefix_mode in [("VALL-E", 1), ("VALL-F", 0)]:
+                params.model_name = model_name
+                params.prefix_mode = prefix_mode
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                kwargs = dict(
+                    x=x.to(device),
+                    x_lens=x_lens.to(device),
+                    y=y.to(device),
+                    enroll_x_lens=enroll_x_lens,
+                    top_k=1,
+                    use_kv_cache=True,
+                )
+                expected = model.inference(**kwargs)
+                for k in [1, 2, 4, 8]:
+                    codes = model.inference(**kwargs, num_output_quantizers=k)
+                    # the first stages do not depend on the later ones
+                    assert torch.equal(codes, expected[..., :k])
+
+                    codes, code_lens = model.batch_inference(
+                        x.to(device),
+                        x_lens.to(device),
+                        y.to(device),
+                        torch.tensor([16], device=device),
+                        enroll_x_lens=enroll_x_lens,
+                        top_k=1,
+                        num_output_quantizers=k,
+                    )
+                    assert torch.equal(codes, expected[..., :k])
+
+    def test_nar_executor(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[3, 8]))
+        x_lens = torch.from_numpy(np.array([8, 5, 6]))
+        enroll_x_lens = torch.from_numpy(np.array([2, 3, 2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[3, 16, 8]))
+        y_lens = torch.from_numpy(np.array([16, 9, 12]))
+
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.norm_first = True
+        params.prepend_bos = False
+
+        for device in self.devices:
+            for model_name, prefix_mode in [("VALL-E", 1), ("VALL-F", 2)]:
+                params.model_name = model_name
+                params.prefix_mode = prefix_mode
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                executor = NarBatchExecutor(model, max_batch_size=2)
+                expected, results = {}, {}
+                for b in range(x.shape[0]):
+                    kwargs = dict(
+                        x=x[b : b + 1, : x_lens[b]].to(device),
+                        x_lens=x_lens[b : b + 1].to(device),
+                        y=y[b : b + 1, : y_lens[b]].to(device),
+                        enroll_x_lens=enroll_x_lens[b : b + 1],
+                        top_k=1,
+                        use_kv_cache=True,
+                    )
+                    codes = model.inference(**kwargs, ar_only=True)
+                    assert codes.shape[-1] == 1
+                    index = executor.submit(
+                        kwargs["x"],
+                        kwargs["y"],
+                        codes,
+                        enroll_x_lens[b : b + 1],
+                    )
+                    expected[index] = model.inference(**kwargs)
+                    results.update(executor.run())
+                # a single batch of 2, the last request is pending
+                assert len(results) == 2 and len(executor) == 1
+                results.update(executor.run(flush=True))
+                assert executor.num_batches == 2
+                for index, codes in expected.items():
+                    assert torch.equal(results[index], codes)
+
+    def test_nar_group_size(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[4, 8]))
+        x_lens = torch.from_numpy(np.random.randint(4, 8, size=[4]))
+        x_lens[-1] = 8
+        enroll_x_lens = torch.from_numpy(np.random.randint(1, 3, size=[4]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[4, 16, 8]))
+        y_lens = torch.from_numpy(np.random.randint(8, 16, size=[4]))
+        y_lens[-1] = 16
+
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.norm_first = True
+        params.prepend_bos = False
+
+        for device in self.devices:
+            for model_name, prefix_mode in [
+                ("VALL-E", 1),
+                ("VALL-E", 2),
+                ("VALL-F", 0),
+            ]:
+                for nar_group_size in [2, 3]:
+                    params.model_name = model_name
+                    params.prefix_mode = prefix_mode
+                    params.nar_group_size = nar_group_size
+                    model = get_model(params)
+                    model.to(device)
+
+                    # Training
+                    for _ in range(4):
+                        codes, loss, metrics = model(
+                            x.to(device),
+                            x_lens.to(device),
+                            y.to(device),
+                            y_lens.to(device),
+                            train_stage=2,
+                        )
+                        loss.backward()
+
+                    # Inference
+                    model.eval()
+                    kwargs = dict(
+                        x=x[-1:].to(device),
+                        x_lens=x_lens[-1:].to(device),
+                        y=y[-1:].to(device),
+                        enroll_x_lens=enroll_x_lens[-1:],
+                        top_k=1,
+                        use_kv_cache=True,
+                    )
+                    codes = model.inference(**kwargs)
+                    assert codes.shape[0] == 1 and codes.shape[-1] == 8
+                    codes = model.inference(**kwargs, num_output_quantizers=4)
+                    assert codes.shape[-1] == 4
+
+    def test_multi_token_embedding(self):
+        for device in self.devices:
+            embeddings = MultiTokenEmbedding(
+                [TokenEmbedding(16, 1025)]
+                + [TokenEmbedding(16, 1024) for _ in range(7)]
+            ).to(device)
+            codes = torch.randint(0, 1024, size=(2, 5, 8), device=device)
+            # same state dict as a nn.ModuleList of TokenEmbeddings
+            assert "7.word_embeddings.weight" in embeddings.state_dict()
+
+            for training in [True, False]:
+                embeddings.train(training)
+                for k in [1, 3, 8]:
+                    expected = sum(
+                        embeddings[j](codes[..., j]) for j in range(k)
+                    )
+                    X = embeddings(codes[..., :k])
+                    assert X.shape == (2, 5, 16)
+                    assert torch.allclose(X, expected, atol=1e-5)
+
+            # the fused table follows the updates of the tables
+            with torch.no_grad():
+                embeddings[3].weight.add_(1.0)
+            X = embeddings(codes[..., :4])
+            expected = sum(embeddings[j](codes[..., j]) for j in range(4))
+            assert torch.allclose(X, expected, atol=1e-5)
+
+    def test_quantize_dynamic(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[1, 8]))
+        x_lens = torch.from_numpy(np.array([8]))
+        enroll_x_lens = torch.from_numpy(np.array([2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[1, 16, 8]))
+
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.norm_first = True
+        params.prepend_bos = False
+
+        # the dynamically quantized layers run on CPU only
+        for model_name, prefix_mode in [("VALL-E", 1), ("VALL-F", 0)]:
+            params.model_name = model_name
+            params.prefix_mode = prefix_mode
+            model = get_model(params)
+            model.eval()
+            quantize_dynamic(model)
+            self_attn = model.ar_decoder.layers[0].self_attn
+            assert self_attn.in_proj_weight is None
+            # the queries and the keys/values are projected separately
+            assert self_attn.in_proj_q.out_features == params.decoder_dim
+            assert self_attn.in_proj_kv.out_features == 2 * params.decoder_dim
+
+            kwargs = dict(
+                x=x,
+                x_lens=x_lens,
+                y=y,
+                enroll_x_lens=enroll_x_lens,
+                top_k=1,
+            )
+            # the activations are quantized per call, so the cached decoding
+            # may differ slightly
+            codes = model.inference(**kwargs, use_kv_cache=True)
+            assert codes.shape[0] == 1 and codes.shape[-1] == 8
+            codes = model.inference(**kwargs, use_kv_cache=False)
+            assert codes.shape[0] == 1 and codes.shape[-1] == 8
+
+            # the quantized state dict is loaded by a quantized model
+            loaded = get_model(params)
+            loaded.eval()
+            quantize_dynamic(loaded)
+            loaded.load_state_dict(model.state_dict(), strict=True)
+            assert torch.equal(
+                loaded.inference(**kwargs, use_kv_cache=False), codes
+            )
+
+    def test_paged_kv_cache(self):
+        params = AttributeDict()
+        params.decoder_dim = 64
+        params.nhead = 16
+        params.num_decoder_layers = 4
+
+        x = torch.from_numpy(np.random.randint(0, 100, size=[3, 8]))
+        x_lens = torch.from_numpy(np.array([8, 5, 6]))
+        enroll_x_lens = torch.from_numpy(np.array([2, 3, 2]))
+        y = torch.from_numpy(np.random.randint(0, 1000, size=[3, 16, 8]))
+        y_lens = torch.from_numpy(np.array([16, 9, 12]))
+
+        params.model_name = "VALL-E"
+        params.add_prenet = False
+        params.share_embedding = True
+        params.scale_factor = 1.0
+        params.num_quantizers = 8
+        params.prefix_mode = 1
+        params.norm_first = True
+
+        for device in self.devices:
+            # the attention over the blocks in place
+            kv_pool = BlockPool(16, 1, 2, 4, block_size=4, device=device)
+            cache = PagedKVCache(kv_pool, 1)
+            for length in [7, 2, 9]:
+                row_cache = PagedKVCache(kv_pool, 1)
+                row_cache.add_sequence()
+                k = torch.randn(1, 2, length, 4, device=device)
+                row_cache.update(0, k, torch.randn_like(k))
+                cache.extend(row_cache)
+            k = torch.randn(3, 2, 1, 4, device=device)
+            q = torch.randn_like(k)
+            k, v = cache.update(0, k, torch.randn_like(k))
+            expected = torch.softmax(
+                torch.matmul(q, k.transpose(-2, -1)).masked_fill(
+                    cache.key_padding_mask(0)[:, None, None, :],
+                    float("-inf"),
+                ),
+                dim=-1,
+            )
+            assert torch.allclose(
+                cache.attend(0, q), torch.matmul(expected, v), atol=1e-5
+            )
+
+            for prepend_bos in [False, True]:
+                params.prepend_bos = prepend_bos
+                model = get_model(params)
+                model.to(device)
+                model.eval()
+
+                # small enough to preempt the sequences
+                kv_pool = BlockPool(48, 4, 16, 4, block_size=4, device=device)
+                codes, code_lens = model.batch_inference(
+                    x.to(device),
+                    x_lens.to(device),
+                    y.to(device),
+                    y_lens.to(device),
+                    enroll_x_lens=enroll_x_lens,
+                    top_k=1,
+                    kv_pool=kv_pool,
+                )
+                assert kv_pool.num_free_blocks == kv_pool.num_blocks
+                for b in range(x.shape[0]):
+                    expected = model.inference(
+                        x[b : b + 1, : x_lens[b]].to(device),
+                        x_lens[b : b + 1].to(device),
+                        y[b : b + 1, : y_lens[b]].to(device),
+                        enroll_x_lens=enroll_x_lens[b : b + 1],
+                        top_k=1,
+                        use_kv_cache=True,
+                    )
+                    assert code_lens[b] == expected.shape[1]
+                    assert torch.equal(
+                        codes[b : b + 1, : code_lens[b]], expected
+                    )
+
     def test_topmetric(self):
         metric_top10 = MulticlassAccuracy(1024, top_k=10, average="micro")
         metric_top1 = MulticlassAccuracy(1024, top_k=1, average="micro")